@@ -0,0 +1,101 @@
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from utils.reconstruction import write_trips_csv
+from utils.synthetic import generate
+from utils.trip_store import DATA_DIR, read_trips_csv
+
+BENCH_DIR = DATA_DIR / "cache" / "bench"
+TRIP_SCALES = (1, 10, 100)
+STATION_COUNTS = (254, 2000, 10000)
+# Copies of a trip are moved by up to this much, so they do not share snapshot times.
+JITTER_MIN = 30
+# Spread of a cloned station around the station it was cloned from, in degrees (~400 m).
+CLONE_SPREAD = (0.0036, 0.0054)
+# "shipped": scaled copies of the shipped trips; "synthetic": utils.synthetic
+# trips, as many as the copies, over the same days.
+SOURCES = ("shipped", "synthetic")
+
+
+def scale_dir(trip_scale, stations, root=BENCH_DIR, source="shipped"):
+    name = f"trips{trip_scale}x-stations{stations}"
+    return Path(root) / (name if source == "shipped" else f"{source}-{name}")
+
+
+def _clone_stations(table, stations, rng):
+    # Replaces the station columns so trips spread over `stations` stations:
+    # every shipped station gets clones nearby, and each trip end moves to a
+    # random clone of its station. The shipped stations keep their ids.
+    ids = np.concatenate([table.column(f"{end}_station_id").to_numpy() for end in ("origin", "destination")])
+    base, inverse = np.unique(ids, return_inverse=True)
+    n = len(base)
+    if stations <= n:
+        return table
+    clones = np.bincount(np.arange(stations) % n, minlength=n)
+    picked = inverse + n * (rng.random(len(inverse)) * clones[inverse]).astype(np.int64)
+    copy = picked // n
+    rows = table.num_rows
+    # One offset per clone, shared by both trip ends.
+    jitter = rng.normal(size=(2, stations))
+    for i, end in enumerate(("origin", "destination")):
+        part = slice(i * rows, (i + 1) * rows)
+        moved = copy[part] > 0
+        lat = table.column(f"{end}_lat").to_numpy() + np.where(moved, CLONE_SPREAD[0] * jitter[0, picked[part]], 0)
+        lon = table.column(f"{end}_lon").to_numpy() + np.where(moved, CLONE_SPREAD[1] * jitter[1, picked[part]], 0)
+        names = pc.cast(table.column(end), pa.string())
+        suffix = pa.array(np.where(moved, np.char.add(" #", copy[part].astype(str)), ""))
+        updates = {
+            f"{end}_station_id": pa.array(ids[part] + copy[part] * 10 ** 9),
+            f"{end}_lat": pa.array(lat, pa.float32()),
+            f"{end}_lon": pa.array(lon, pa.float32()),
+            end: pc.binary_join_element_wise(names, suffix, "").dictionary_encode(),
+        }
+        for name, column in updates.items():
+            table = table.set_column(table.schema.get_field_index(name), name, column)
+    return table
+
+
+def scaled_trips(trip_scale, stations, seed=0, source=None):
+    # The shipped trips `trip_scale` times over the same days, spread over
+    # `stations` stations. Copies get their own bike numbers and a few minutes
+    # of jitter; the hour-of-day and duration distributions are unchanged.
+    source = read_trips_csv() if source is None else source
+    rng = np.random.default_rng(seed)
+    copies = []
+    for copy in range(trip_scale):
+        table = source
+        if copy:
+            shift = pa.array(rng.integers(-JITTER_MIN, JITTER_MIN + 1, table.num_rows) * 60 * 10 ** 9, pa.duration("ns"))
+            for name in ("departure_time", "arrival_time"):
+                table = table.set_column(table.schema.get_field_index(name), name, pc.add(table.column(name), shift))
+            bikes = pc.add(table.column("bike_number"), pa.scalar(copy * 1_000_000, pa.int32()))
+            table = table.set_column(table.schema.get_field_index("bike_number"), "bike_number", bikes)
+        copies.append(table)
+    table = pa.concat_tables(copies, promote_options="permissive").combine_chunks()
+    return _clone_stations(table, stations, rng)
+
+
+def _synthetic_trips(trip_scale, stations, seed):
+    shipped = read_trips_csv()
+    times = shipped.column("departure_time")
+    first, last = (pc.min(times).as_py().date(), pc.max(times).as_py().date())
+    return generate(trip_scale * shipped.num_rows, stations, (last - first).days + 1, str(first), seed)
+
+
+def prepare(trip_scale, stations, root=BENCH_DIR, seed=0, source="shipped"):
+    # Writes the scaled trips as <scale dir>/trips.csv once; returns the path.
+    out_dir = scale_dir(trip_scale, stations, root, source)
+    csv_path = out_dir / "trips.csv"
+    if not csv_path.exists():
+        out_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = csv_path.with_name(csv_path.name + ".tmp")
+        if source == "synthetic":
+            tables = _synthetic_trips(trip_scale, stations, seed)
+        else:
+            tables = [scaled_trips(trip_scale, stations, seed)]
+        write_trips_csv(tables, tmp_path)
+        tmp_path.replace(csv_path)
+    return csv_path
@@ -0,0 +1,206 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.scale import BENCH_DIR, SOURCES, STATION_COUNTS, TRIP_SCALES, prepare, scale_dir
+from utils import aggregations
+from utils.autocorrelation import knn_weights, local_moran
+from utils.density import density_tiles
+from utils.flows import ALL, od_flows, select_flows
+from utils.map_cache import data_version
+from utils.network import betweenness, network_table, trip_network
+from utils.trip_store import build_trip_store
+
+RESULTS_DIR = Path(__file__).parent / "results"
+REPEAT = 3
+# Sampled sources for betweenness, the network page's default.
+PIVOTS = 64
+
+
+def _render(folium_map):
+    # Full HTML, as st_folium serializes it; returns its size.
+    return {"html_bytes": len(folium_map.get_root().render())}
+
+
+class Run:
+    # Times cases at one scale; every case is run `repeat` times after an
+    # untimed `setup`, and the last result is returned.
+
+    def __init__(self, trip_scale, stations, source="shipped", repeat=REPEAT, log=print):
+        self.scale = {"source": source, "trip_scale": trip_scale, "stations": stations}
+        self.repeat = repeat
+        self.log = log
+        self.records = []
+
+    def time(self, case, fn, phase="", setup=None, extra=None):
+        seconds, result = [], None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = fn()
+            seconds.append(time.perf_counter() - start)
+        record = {**self.scale, "case": case, "phase": phase, "seconds": seconds, "median_s": statistics.median(seconds)}
+        if extra is not None:
+            record.update(extra(result))
+        self.records.append(record)
+        self.log(f"  {case:<28} {phase:<5} {record['median_s'] * 1000:10.1f} ms")
+        return result
+
+    def loader(self, case, fn, args, disk=None):
+        # cold: nothing cached; disk: a restarted server, persisted files kept;
+        # warm: a cache hit. Loaders it depends on stay warm throughout.
+        def cold():
+            fn.clear()
+            if disk is not None and disk.exists():
+                shutil.rmtree(disk)
+
+        self.time(case, lambda: fn(*args), "cold", cold)
+        if disk is not None:
+            self.time(case, lambda: fn(*args), "disk", fn.clear)
+        return self.time(case, lambda: fn(*args), "warm")
+
+
+def run_scale(trip_scale, stations, root=BENCH_DIR, repeat=REPEAT, source="shipped"):
+    # All cases at one scale. Runs in a fresh process (see run_suite), so the
+    # peak RSS belongs to this scale alone.
+    from last_try.autocorrelation import build_lisa_map
+    from last_try.balance import build_balance_map, build_time_of_day_map, window_counts
+    from last_try.heatmap import build_hourly_heat_map
+    from last_try.introduction import build_station_map
+    from last_try.network import build_network_map
+    from last_try.trajectories import build_flow_map
+    from utils.data_loaders import load_balance_data, load_bezirke, load_bike_trips, load_od_flows, load_stations, load_time_cube
+
+    out_dir = scale_dir(trip_scale, stations, root, source)
+    csv_path = prepare(trip_scale, stations, root, source=source)
+    store_dir, cube_dir = out_dir / "trips", out_dir / "time_cube"
+    run = Run(trip_scale, stations, source, repeat)
+    run.log(f"{trip_scale}x {source} trips, {stations} stations")
+
+    run.time("ingest/trip_store", lambda: build_trip_store(csv_path, store_dir))
+    # The dashboard's own loaders, pointed at this scale's files.
+    version = data_version(store_dir)
+    trips = run.loader("loader/bike_trips", load_bike_trips, (store_dir,))
+    dimension = run.loader("loader/stations", load_stations, (version, store_dir))
+    cube = run.loader("loader/time_cube", load_time_cube, (version, store_dir, cube_dir), disk=cube_dir)
+    flows = run.loader("loader/od_flows", load_od_flows, (version, store_dir))
+    gdf = run.loader("loader/bezirke", load_bezirke, (11,))
+
+    balance = run.time("aggregate/balance", lambda: aggregations.station_balance(trips, dimension))
+    run.time("aggregate/time_of_day", lambda: aggregations.station_time_of_day(trips, dimension))
+    run.time("aggregate/cube_windows", lambda: [
+        window_counts(cube, start, end, "all") for start, end in aggregations.PERIOD_HOURS.values()
+    ])
+    run.time("aggregate/od_pairs", lambda: aggregations.od_aggregates(trips, dimension))
+    run.time("aggregate/od_flows", lambda: od_flows(trips, dimension))
+    network = run.time("aggregate/network", lambda: network_table(trips, dimension))
+    adjacency = trip_network(trips, dimension)[1]
+    run.time("aggregate/betweenness", lambda: betweenness(adjacency, PIVOTS), extra=lambda r: {"pivots": r.pivots})
+    w = knn_weights(network["lat"], network["lon"])
+    net = (network["trips_started"] - network["trips_ended"]).to_numpy()
+    lisa = run.time("aggregate/local_moran", lambda: local_moran(net, w, workers=1))
+
+    balance.to_csv(out_dir / "balance.csv", index=False)
+    run.loader("loader/balance_csv", load_balance_data, (out_dir / "balance.csv",))
+
+    balance = balance.assign(diff=balance["dep_count"] - balance["arr_count"]).dropna(subset=["lat", "lon"])
+    network = network.dropna(subset=["lat", "lon"])
+    durations = flows.loc[flows["window"] == ALL, "avg_duration_min"]
+    density_dir = out_dir / "density"
+    run.time("map/density", lambda: density_tiles(trips, version, density_dir), "cold",
+             lambda: shutil.rmtree(density_dir, ignore_errors=True))
+    run.time("map/density", lambda: density_tiles(trips, version, density_dir), "disk")
+    maps = {
+        "map/stations": lambda: build_station_map(dimension.dropna(subset=["lat", "lon"])),
+        "map/hourly_heat": lambda: build_hourly_heat_map(cube, "dep", cube.day_range(), gdf),
+        "map/network": lambda: build_network_map(network),
+        "map/balance": lambda: build_balance_map(balance),
+        "map/time_of_day": lambda: build_time_of_day_map(window_counts(cube, 7, 11, "all"), "Morning"),
+        "map/flows": lambda: build_flow_map(select_flows(flows), durations.min(), durations.max()),
+        "map/lisa": lambda: build_lisa_map(network, lisa, "Net balance"),
+    }
+    for case, build in maps.items():
+        run.time(case, lambda: _render(build()), extra=lambda r: r)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for record in run.records:
+        record.update(rows=len(trips), peak_rss_mb=round(peak, 1))
+    return run.records
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_suite(trip_scales=TRIP_SCALES, station_counts=STATION_COUNTS, root=BENCH_DIR, repeat=REPEAT, source="shipped"):
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for trip_scale in trip_scales:
+        for stations in station_counts:
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                results += pool.submit(run_scale, trip_scale, stations, root, repeat, source).result()
+    return {"environment": _environment(), "repeat": repeat, "results": results}
+
+
+def compare(old, new):
+    # Median time of every case in `new` relative to `old` (> 1 is slower).
+    key = lambda r: (r.get("source", "shipped"), r["trip_scale"], r["stations"], r["case"], r["phase"])
+    before = {key(r): r["median_s"] for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        if key(r) in before and before[key(r)] > 0:
+            rows.append({**dict(zip(("source", "trip_scale", "stations", "case", "phase"), key(r))),
+                         "before_ms": before[key(r)] * 1000, "after_ms": r["median_s"] * 1000,
+                         "ratio": r["median_s"] / before[key(r)]})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the dashboard's loaders, aggregations and map builds at scale.")
+    parser.add_argument("--trips", type=int, nargs="+", default=list(TRIP_SCALES), help="Trip multiples of the shipped data.")
+    parser.add_argument("--stations", type=int, nargs="+", default=list(STATION_COUNTS))
+    parser.add_argument("--source", default="shipped", choices=SOURCES,
+                        help="Scale copies of the shipped trips, or generate synthetic ones.")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--data", type=Path, default=BENCH_DIR, help="Where the scaled datasets are kept.")
+    parser.add_argument("--out", type=Path, help="Result JSON (default: benchmarks/results/<time>.json).")
+    parser.add_argument("--compare", type=Path, nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit.")
+    args = parser.parse_args()
+    if args.compare:
+        old, new = (json.loads(path.read_text()) for path in args.compare)
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(compare(old, new).round(2).to_string(index=False))
+        return
+    report = run_suite(args.trips, args.stations, args.data, args.repeat, args.source)
+    out = args.out or RESULTS_DIR / f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=1))
+    print(f"Wrote {len(report['results'])} timings to {out}")
+
+
+if __name__ == "__main__":
+    main()
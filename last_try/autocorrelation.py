@@ -1,7 +1,97 @@
-from PIL import Image
 import streamlit as st
+from utils.autocorrelation import distance_band_weights, knn_weights, local_moran, moran
+from utils.data_loaders import NETWORK_CSV, ROLLUP_DIR, load_network_data, load_occupancy_rollups, load_stations
+from utils.instrumentation import loader, timed
+from utils.map_cache import data_version, render_map
+from utils.map_layers import StationLayer, station_popups
+from utils.reconstruction import LOCAL_TZ
+from utils.registry import shared
+from utils.trip_store import STORE_DIR
+import datetime
+import folium
+import numpy as np
 import pandas as pd
 
+CLUSTER_COLORS = {"HH": "#d7191c", "LL": "#2c7bb6", "HL": "#fdae61", "LH": "#abd9e9", "Non-Significant": "#bababa"}
+METRICS = {
+    "trips": "Trips",
+    "trips_started": "Departures",
+    "trips_ended": "Arrivals",
+    "net_balance": "Departures minus arrivals",
+    "degree_centrality": "Degree centrality",
+    "connections_total": "Connections",
+}
+# Only offered once an occupancy history has been collected.
+OCCUPANCY_METRICS = {
+    "occupancy": "Mean occupancy",
+    "empty_frac": "Share of time empty",
+    "full_frac": "Share of time full",
+}
+
+def build_lisa_map(stations, lisa, label):
+    lisa_map = folium.Map(location=[stations["lat"].mean(), stations["lon"].mean()], zoom_start=12)
+    table = stations[["station", "lat", "lon"]].assign(
+        cluster=lisa["cluster"].astype(str).to_numpy(), local_i=lisa["local_i"].to_numpy(), p_sim=lisa["p_sim"].to_numpy()
+    )
+    significant = table["cluster"].to_numpy() != "Non-Significant"
+    StationLayer(
+        table["lat"],
+        table["lon"],
+        popup=station_popups(
+            "<b>{station}</b><br>Cluster: {cluster}<br>Local I: {local_i:.2f}<br>p: {p_sim:.3f}", table
+        ),
+        radius=np.where(significant, 7, 4),
+        color=table["cluster"].map(CLUSTER_COLORS).to_numpy(),
+        fill_opacity=0.8,
+        weight=1,
+        name=label,
+    ).add_to(lisa_map)
+    return lisa_map
+
+@timed("aggregate")
+def occupancy_stations(rollups, dimension, first_day, last_day):
+    # Occupancy stats per station between two local dates (inclusive), with coordinates.
+    start = pd.Timestamp(first_day).tz_localize(LOCAL_TZ)
+    end = pd.Timestamp(last_day + datetime.timedelta(days=1)).tz_localize(LOCAL_TZ)
+    stats = rollups.query(start, end).rename(columns={"mean": "occupancy"})
+    stations = dimension[["station_id", "station", "lat", "lon"]].merge(stats, on="station_id")
+    return stations.dropna(subset=["lat", "lon", "occupancy"]).reset_index(drop=True)
+
+def metric_stations(metric, period):
+    # The stations with `metric`: occupancy stats between the two local dates
+    # in `period`, or the trip network table.
+    if metric in OCCUPANCY_METRICS:
+        rollups = load_occupancy_rollups(data_version(ROLLUP_DIR))
+        return occupancy_stations(rollups, load_stations(data_version(STORE_DIR)), *period)
+    stations = load_network_data().dropna(subset=["lat", "lon"]).reset_index(drop=True)
+    return stations.assign(net_balance=stations["trips_started"] - stations["trips_ended"])
+
+# The permutation tests are too slow for every widget rerun, so each result is
+# cached per data version and parameters. `progress` is only called on a miss.
+@loader(shared(keep=16, ignore=("progress",)))
+def station_autocorrelation(version, metric, period, weights, size, permutations, progress=None):
+    stations = metric_stations(metric, period)
+    if weights == "k nearest":
+        w = knn_weights(stations["lat"], stations["lon"], size)
+    else:
+        w = distance_band_weights(stations["lat"], stations["lon"], size)
+    y = stations[metric].to_numpy()
+    lisa = local_moran(y, w, permutations, progress=progress)
+    return stations, moran(y, w, permutations), lisa
+
+def cluster_table(lisa):
+    counts = lisa["cluster"].value_counts()
+    labels = ["HH", "LL", "HL", "LH", "Non-Significant"]
+    return pd.DataFrame({"Label": labels, "Stations": [int(counts.get(label, 0)) for label in labels]})
+
+# What the first render loads (and the stations of the occupancy metrics),
+# warmed in the background by utils/warmup.py.
+WARMUP = (
+    lambda: load_occupancy_rollups(data_version(ROLLUP_DIR)),
+    lambda: load_stations(data_version(STORE_DIR)),
+    lambda: station_autocorrelation(data_version(NETWORK_CSV), next(iter(METRICS)), (), "k nearest", 8, 999),
+)
+
 def show_page():
     st.header("Capacity Analysis")
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -19,10 +109,43 @@ def show_page():
         High-high clusters can be observed in the first 1st and 4th district, while there are low-low clusters
         f.ex. between the Ring and the Gürtel, giving further interesting insights to the system.
         """)
+        st.write("""
+        The map runs the same analysis live on the station metrics of the trip data.
+        Choose a metric and how neighbouring stations are defined.
+        """)
 
     with col2:
-        image = Image.open("data/autocorrelation_capacity.png")
-        st.image(image, caption="Autocorrelation value per station", use_container_width=True)
+        occupancy_version = data_version(ROLLUP_DIR)
+        rollups = load_occupancy_rollups(occupancy_version)
+        metrics = dict(METRICS, **OCCUPANCY_METRICS) if rollups is not None else METRICS
+        metric = st.selectbox("Station metric", list(metrics), format_func=metrics.get)
+        if metric in OCCUPANCY_METRICS:
+            # Any period of the collected history, answered from the precomputed rollups.
+            first, last = (pd.Timestamp(t).tz_localize("UTC").tz_convert(LOCAL_TZ).date() for t in rollups.time_range())
+            first_day, last_day = first, last
+            if first < last:
+                first_day, last_day = st.slider("Dates", first, last, (first, last))
+            # The stations' names and coordinates come from the trip store.
+            version = data_version(ROLLUP_DIR, STORE_DIR)
+            period = (first_day, last_day)
+        else:
+            version = data_version(NETWORK_CSV)
+            period = ()
+        weights = st.radio("Neighbours", ["k nearest", "distance band"], horizontal=True)
+        if weights == "k nearest":
+            size = st.slider("Number of neighbours", 2, 20, 8)
+        else:
+            size = st.slider("Distance band (m)", 250, 3000, 1000, step=250)
+        permutations = st.select_slider("Permutations", [99, 999, 9999], value=999)
+        params = (metric, period, weights, size, permutations)
+        bar = st.empty()
+        progress = lambda done: bar.progress(done, text="Testing local significance")
+        stations, global_i, lisa = station_autocorrelation(version, *params, progress=progress)
+        bar.empty()
+        render_map(
+            "autocorrelation", "lisa", lambda: build_lisa_map(stations, lisa, metrics[metric]),
+            params=params, version=version, width=700, height=500,
+        )
 
     with col3:
         st.markdown("### Explanation")
@@ -42,10 +165,7 @@ def show_page():
         Values of LH and HL indicate spatial outliers, while values of HH and LL indicate clusters.
         """)
         
-        data_tabl = {
-            "Label": ["HH", "LL", "HL", "LH", "Non-Significant"],
-            "Stations": [14, 13, 4, 2, 161]
-        }
-        df_tabl = pd.DataFrame(data_tabl)
-        st.markdown("### Global Moran's I: 0.13")
+        df_tabl = cluster_table(lisa)
+        st.markdown(f"### Global Moran's I: {global_i.I:.2f}")
+        st.caption(f"p = {global_i.p_sim:.3f} ({global_i.permutations} permutations)")
         st.table(df_tabl)
@@ -1,10 +1,94 @@
-from PIL import Image
 import streamlit as st
-from utils.data_loaders import load_balance_data, load_time_of_day_data
+from last_try.autocorrelation import build_lisa_map, cluster_table
+from utils.aggregations import PERIOD_HOURS, compare_counts
+from utils.autocorrelation import knn_weights, local_moran, moran
+from utils.data_loaders import BALANCE_CSV, load_balance_data, load_time_cube
+from utils.instrumentation import loader, timed
+from utils.map_cache import data_version, render_map
+from utils.map_layers import StationLayer, station_popups
+from utils.registry import shared
+from utils.time_cube import DAY_TYPES
+from utils.trip_store import STORE_DIR
 import folium
-from streamlit_folium import st_folium
+import numpy as np
 import pandas as pd
 
+AUTOCORRELATION_PERIODS = list(PERIOD_HOURS) + ["all day"]
+
+def build_balance_map(balance_df):
+    map_center = [balance_df["lat"].mean(), balance_df["lon"].mean()]
+    balance_map = folium.Map(location=map_center, zoom_start=12)
+
+    diff = balance_df["diff"].to_numpy()
+    StationLayer(
+        balance_df["lat"],
+        balance_df["lon"],
+        popup=station_popups(
+            "<b>{station}</b><br>Departures: {dep_count:.0f}<br>Arrivals: {arr_count:.0f}<br>",
+            balance_df,
+        ),
+        radius=np.clip(np.abs(diff) / 3, 4, 12),
+        color=np.select([diff > 0, diff < 0], ["green", "blue"], "gray"),
+        popup_width=250,
+        name="Balance",
+    ).add_to(balance_map)
+    return balance_map
+
+@timed("aggregate")
+def window_counts(cube, start, end, day_type):
+    window_df = cube.stations[["station", "lat", "lon"]].copy()
+    window_df["dep"] = cube.window("dep", start, end, day_type)
+    window_df["arr"] = cube.window("arr", start, end, day_type)
+    window_df["status"] = compare_counts(window_df["dep"].to_numpy(), window_df["arr"].to_numpy())
+    return window_df
+
+def net_balance(cube, period):
+    # Departures minus arrivals per station in a period, or over the whole day.
+    hours = PERIOD_HOURS.get(period, ())
+    return cube.window("dep", *hours) - cube.window("arr", *hours)
+
+# Permutation tests are too slow for every widget rerun, so both are cached per
+# trip store version; the LISA of every period is kept for the current version.
+@loader(shared(keep=len(PERIOD_HOURS) + 1))
+def period_lisa(version, period, k=8):
+    cube = load_time_cube(version)
+    return local_moran(net_balance(cube, period), knn_weights(cube.stations["lat"], cube.stations["lon"], k))
+
+@loader(shared(keep=1))
+def period_moran(version, k=8):
+    cube = load_time_cube(version)
+    w = knn_weights(cube.stations["lat"], cube.stations["lon"], k)
+    return {period: moran(net_balance(cube, period), w, permutations=0).I for period in AUTOCORRELATION_PERIODS}
+
+def build_time_of_day_map(window_df, label):
+    temp_map = folium.Map(location=[window_df["lat"].mean(), window_df["lon"].mean()], zoom_start=12)
+
+    status = window_df["status"].to_numpy()
+    StationLayer(
+        window_df["lat"],
+        window_df["lon"],
+        popup=station_popups(
+            "<b>Station:</b> {station}<br><b>Departures:</b> {dep:.0f}<br>"
+            "<b>Arrivals:</b> {arr:.0f}",
+            window_df,
+        ),
+        radius=np.clip(np.abs(window_df["dep"] - window_df["arr"]).to_numpy() / 3, 4, 12),
+        color=np.select(
+            [status == "more_arrivals", status == "more_departures"], ["blue", "green"], "gray"
+        ),
+        popup_width=300,
+        name=label,
+    ).add_to(temp_map)
+    return temp_map
+
+# What the first render loads, warmed in the background by utils/warmup.py.
+WARMUP = (
+    load_balance_data,
+    lambda: load_time_cube(data_version(STORE_DIR)),
+    lambda: period_lisa(data_version(STORE_DIR), AUTOCORRELATION_PERIODS[0]),
+    lambda: period_moran(data_version(STORE_DIR)),
+)
+
 def show_page():
     st.header("Origin vs. Destination Balance")
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -48,86 +132,36 @@ def show_page():
         balance_df = load_balance_data()
         balance_df["diff"] = balance_df["dep_count"] - balance_df["arr_count"]
 
-        map_center = [balance_df["lat"].mean(), balance_df["lon"].mean()]
-        balance_map = folium.Map(location=map_center, zoom_start=12)
-
-        for _, row in balance_df.iterrows():
-            diff = row["diff"]
-            if diff > 0:
-                color = "green"
-            elif diff < 0:
-                color = "blue"
-            else:
-                color = "gray"
-
-            radius = max(4, min(12, abs(diff)/3))
-
-            popup_text = f"""
-            <b>{row['station']}</b><br>
-            Departures: {int(row['dep_count'])}<br>
-            Arrivals: {int(row['arr_count'])}<br>
-            """
-
-            folium.CircleMarker(
-                location=[row["lat"], row["lon"]],
-                radius=radius,
-                color=color,
-                fill=True,
-                fill_color=color,
-                fill_opacity=0.6,
-                popup=folium.Popup(popup_text, max_width=250)
-            ).add_to(balance_map)
-
-        st_folium(balance_map, width=700, height=500)
-
-        df_temp = load_time_of_day_data()
-        time_of_day = st.selectbox("Select time of day", ["morning", "midday", "evening", "night"])
-
-        dep_col = f"dep_{time_of_day}"
-        arr_col = f"arr_{time_of_day}"
-        status_col = f"status_{time_of_day}"
-
-        temp_map = folium.Map(location=[df_temp["lat"].mean(), df_temp["lon"].mean()], zoom_start=12)
-
-        for _, row in df_temp.iterrows():
-            dep = row[dep_col]
-            arr = row[arr_col]
-            status = row[status_col]
-            diff = dep - arr
-
-            if status == "more_arrivals":
-                color = "blue"
-            elif status == "more_departures":
-                color = "green"
-            else:
-                color = "gray"
-
-            radius = max(4, min(12, abs(diff)/3))
-
-            popup_text = f"""
-            <b>Station:</b> {row['station']}<br>
-            <b>Departures:</b> {int(dep)}<br>
-            <b>Arrivals:</b> {int(arr)}
-            """
-
-            folium.CircleMarker(
-                location=[row["lat"], row["lon"]],
-                radius=radius,
-                color=color,
-                fill=True,
-                fill_opacity=0.6,
-                popup=folium.Popup(popup_text, max_width=300)
-            ).add_to(temp_map)
-
-        st_folium(temp_map, width=700, height=500)
+        render_map(
+            "balance", "all_day", lambda: build_balance_map(balance_df),
+            version=data_version(BALANCE_CSV), width=700, height=500,
+        )
+
+        cube = load_time_cube(data_version(STORE_DIR))
+        time_of_day = st.selectbox("Select time of day", list(PERIOD_HOURS) + ["custom"], format_func=str.capitalize)
+        start, end = PERIOD_HOURS.get(time_of_day, (7, 11))
+        if time_of_day == "custom":
+            from_col, to_col = st.columns(2)
+            hours = list(range(24))
+            # A window ending at or before its start runs past midnight.
+            start = from_col.selectbox("From", hours, index=start, format_func="{:02d}:00".format)
+            end = to_col.selectbox("To", hours, index=end, format_func="{:02d}:00".format)
+        day_type = st.radio("Days", DAY_TYPES, horizontal=True, format_func=str.capitalize)
+        label = f"{start:02d}:00 - {end:02d}:00"
+        render_map(
+            "balance", "time_of_day", lambda: build_time_of_day_map(window_counts(cube, start, end, day_type), label),
+            params=(start, end, day_type), version=data_version(STORE_DIR), width=700, height=500,
+        )
         
         
-        time_of_day_auto = st.selectbox("Choose time of day", ["morning", "midday", "evening", "night"])
-        # Construct image path
-        image_path_auto = f"data/autocorrelation_{time_of_day_auto}.png"
-        # Load and show image
-        image_auto = Image.open(image_path_auto)
-        st.image(image_auto, caption=f"{time_of_day_auto.capitalize()} Autocorrelation Map", use_container_width=True)
+        # Departures minus arrivals per station, for each period and for the whole day.
+        time_of_day_auto = st.selectbox("Choose time of day", AUTOCORRELATION_PERIODS, format_func=str.capitalize)
+        lisa = period_lisa(data_version(STORE_DIR), time_of_day_auto)
+        render_map(
+            "balance", "autocorrelation", lambda: build_lisa_map(cube.stations, lisa, time_of_day_auto.capitalize()),
+            params=(time_of_day_auto,), version=data_version(STORE_DIR), width=700, height=500,
+        )
+        st.caption(f"{time_of_day_auto.capitalize()} Autocorrelation Map")
 
     with col3:
         st.markdown("### Data Summary")
@@ -162,11 +196,7 @@ def show_page():
         Values of LH and HL indicate spatial outliers, while values of HH and LL indicate clusters.
         """)
 
-        st.write("""
-        - Morning:	0.15
-        - Midday:	0.12
-        - Evening:	0.06
-        - Night:	0.33
-        	
-        - Average:	0.03
-        """)
+        st.table(cluster_table(lisa))
+        st.write("\n".join(
+            f"- {period.capitalize()}: {i:.2f}" for period, i in period_moran(data_version(STORE_DIR)).items()
+        ))
@@ -1,5 +1,7 @@
 import streamlit as st
 
+WARMUP = ()
+
 def show_page():
     st.title("Conclusion")
     st.markdown("""
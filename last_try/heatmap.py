@@ -1,10 +1,81 @@
 import streamlit as st
-from utils.data_loaders import load_bike_trips, load_bezirke
+from utils.boundaries import BEZIRKE_CSV, level_zoom
+from utils.data_loaders import load_bike_trips, load_bezirke, load_time_cube
+from utils.density import GRADIENT, TILE_URL, density_tiles
+from utils.map_cache import data_version, render_map
+from utils.map_layers import FramedHeatMap
+from utils.trip_store import STORE_DIR
 import folium
-from folium.plugins import HeatMap
-from streamlit_folium import st_folium
 import pandas as pd
 
+def add_districts(heat_map, gdf):
+    folium.GeoJson(
+        gdf,
+        name="Vienna Districts",
+        tooltip=folium.GeoJsonTooltip(fields=["NAMEK"], aliases=["District Name:"]),
+        style_function=lambda feature: {
+            "color": "#000000",
+            "weight": 0.5,
+            "fillOpacity": 0,
+            "opacity": 0.35
+        }
+    ).add_to(heat_map)
+
+def build_heat_map(df, gdf, zoom_start=11, location=None):
+    map_center = location or [df["origin_lat"].mean(), df["origin_lon"].mean()]
+    heat_map = folium.Map(location=map_center, zoom_start=zoom_start, min_zoom=10)
+    add_districts(heat_map, gdf)
+
+    # Density is binned and smoothed on the server into a tile pyramid; the
+    # browser fetches the tiles in view at the nearest prebuilt zoom.
+    meta = density_tiles(df, version=data_version(STORE_DIR))
+    folium.TileLayer(
+        tiles=f"{TILE_URL}?v={meta['version'][:12]}", attr="Trip density", name="Trip density", overlay=True,
+        min_native_zoom=meta["zooms"][0], max_native_zoom=meta["zooms"][-1], bounds=meta["bounds"], z_index=1,
+    ).add_to(heat_map)
+
+    folium.LayerControl().add_to(heat_map)
+    return heat_map
+
+def build_hourly_heat_map(cube, kind, days, gdf, zoom_start=11, location=None):
+    stations = cube.stations
+    map_center = location or [stations["lat"].mean(), stations["lon"].mean()]
+    heat_map = folium.Map(location=map_center, zoom_start=zoom_start, min_zoom=10)
+    add_districts(heat_map, gdf)
+
+    # Each frame is one hour-of-day slice of the cube summed over the selected days.
+    FramedHeatMap(
+        cube.frames(kind, days),
+        index=[f"{hour:02d}:00" for hour in range(24)],
+        name="Departures" if kind == "dep" else "Arrivals",
+        radius=25,
+        gradient=GRADIENT,
+        max_opacity=0.8,
+        auto_play=True,
+    ).add_to(heat_map)
+    return heat_map
+
+def follow_zoom(returned, view):
+    # District outlines are simplified for the zoom st_folium last reported.
+    # When the user zooms into another simplification level, the map is
+    # rebuilt with that level's outlines, opening where they left it.
+    if not returned or returned.get("zoom") is None:
+        return
+    zoom = returned["zoom"]
+    if level_zoom(zoom) != level_zoom(view["zoom"]):
+        center = returned.get("center") or {}
+        location = (center["lat"], center["lng"]) if "lat" in center else None
+        st.session_state["heatmap_view"] = {"zoom": zoom, "location": location}
+        st.rerun()
+
+# What the first render loads (and the hour-by-hour cube), warmed in the
+# background by utils/warmup.py.
+WARMUP = (
+    load_bike_trips,
+    lambda: load_bezirke(zoom=level_zoom(11)),
+    lambda: load_time_cube(data_version(STORE_DIR)),
+)
+
 def show_page():
     st.header("Heatmap")
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -17,37 +88,30 @@ def show_page():
         """)
 
     with col2:
-        df = load_bike_trips()
-        origins = df[["origin_lat", "origin_lon"]].copy()
-        destinations = df[["destination_lat", "destination_lon"]].copy()
-        origins.columns = ["lat", "lon"]
-        destinations.columns = ["lat", "lon"]
-        all_points = pd.concat([origins, destinations], ignore_index=True)
-        heat_data = all_points.groupby(["lat", "lon"]).size().reset_index(name="count")
-        heat_points = heat_data[["lat", "lon", "count"]].values.tolist()
-
-        map_center = [df["origin_lat"].mean(), df["origin_lon"].mean()]
-        heat_map = folium.Map(location=map_center, zoom_start=11, min_zoom=10)
-
-        gdf = load_bezirke()
-        folium.GeoJson(
-            gdf,
-            name="Vienna Districts",
-            tooltip=folium.GeoJsonTooltip(fields=["NAMEK"], aliases=["District Name:"]),
-            style_function=lambda feature: {
-                "color": "#000000",
-                "weight": 0.5,
-                "fillOpacity": 0,
-                "opacity": 0.35
-            }
-        ).add_to(heat_map)
-
-        HeatMap(heat_points, radius=15, blur=20, max_zoom=1, opacity=0.8, gradient={
-            0.0: '#ffffff', 0.333:'#ffd43b', 0.6667:'#ed6d0c', 1:'#910606'
-        }).add_to(heat_map)
-
-        folium.LayerControl().add_to(heat_map)
-        st_folium(heat_map, width=700, height=500)
+        mode = st.radio("View", ["All trips", "Hour by hour"], horizontal=True)
+        version = data_version(STORE_DIR, BEZIRKE_CSV)
+        view = st.session_state.get("heatmap_view", {"zoom": 11, "location": None})
+        gdf = lambda: load_bezirke(zoom=level_zoom(view["zoom"]))
+        where = {"zoom_start": view["zoom"], "location": view["location"]}
+        if mode == "All trips":
+            returned = render_map(
+                "heatmap", "density", lambda: build_heat_map(load_bike_trips(), gdf(), **where),
+                params=tuple(where.values()), version=version, width=700, height=500,
+            )
+        else:
+            cube = load_time_cube(data_version(STORE_DIR))
+            kind = st.radio("Show", ["Departures", "Arrivals"], horizontal=True)
+            kind = "dep" if kind == "Departures" else "arr"
+            dates = [day.item() for day in cube.days]
+            start, end = dates[0], dates[-1]
+            if len(dates) > 1:
+                start, end = st.select_slider("Days", options=dates, value=(start, end))
+            days = cube.day_range(start, end)
+            returned = render_map(
+                "heatmap", "hourly", lambda: build_hourly_heat_map(cube, kind, days, gdf(), **where),
+                params=(kind, start, end, *where.values()), version=version, width=700, height=500,
+            )
+        follow_zoom(returned, view)
 
     with col3:
         st.markdown("### More density info")
@@ -1,15 +1,35 @@
 import streamlit as st
-from utils.data_loaders import get_stations_data, load_bike_trips
+from utils.data_loaders import load_bike_trips, load_stations
+from utils.map_cache import data_version, render_map
+from utils.trip_store import STORE_DIR
+from utils.map_layers import StationLayer
 import folium
-from streamlit_folium import st_folium
 import pandas as pd
 
+def build_station_map(stations_df):
+    map_center = [48.21204, 16.37733]
+    bike_map = folium.Map(location=map_center, zoom_start=11, min_zoom=10)
+    StationLayer(
+        stations_df["lat"],
+        stations_df["lon"],
+        popup=stations_df["station"],
+        icon=folium.Icon(color="blue", icon="bicycle", prefix="fa"),
+        name="Stations",
+    ).add_to(bike_map)
+    return bike_map
+
+# What the first render loads, warmed in the background by utils/warmup.py.
+WARMUP = (
+    lambda: load_stations(data_version(STORE_DIR)),
+    load_bike_trips,
+)
+
 def show_page():
-    stations_df = get_stations_data()
-    stations_df = stations_df[~stations_df["place_name"].str.startswith("BIKE")]
+    version = data_version(STORE_DIR)
+    # Stations listed by the tracking export; free-floating bikes are not in the dimension.
+    stations_df = load_stations(version)
+    stations_df = stations_df[stations_df["tracked"]]
     df = load_bike_trips()
-    df["departure_time"] = pd.to_datetime(df["departure_time"])
-    df["arrival_time"] = pd.to_datetime(df["arrival_time"])
 
     st.header("Introduction")
     st.markdown(
@@ -43,15 +63,10 @@ def show_page():
         """)
 
     with col2:
-        map_center = [48.21204, 16.37733]
-        bike_map = folium.Map(location=map_center, zoom_start=11, min_zoom=10)
-        for _, row in stations_df.iterrows():
-            folium.Marker(
-                location=[row["lat"], row["long"]],
-                popup=row["place_name"],
-                icon=folium.Icon(color="blue", icon="bicycle", prefix="fa")
-            ).add_to(bike_map)
-        st_folium(bike_map, width=500, height=500)
+        render_map(
+            "introduction", "stations", lambda: build_station_map(stations_df),
+            version=version, width=500, height=500,
+        )
 
     with col3:
         st.markdown("### Statistics")
@@ -70,6 +85,5 @@ def show_page():
         st.metric("Avg Trip Duration (min)", f"{avg_duration:.1f}")
 
         st.markdown("#### Trips per Hour of Day")
-        df["hour"] = df["departure_time"].dt.hour
-        hour_counts = df["hour"].value_counts().sort_index()
+        hour_counts = df["departure_time"].dt.hour.value_counts().sort_index()
         st.bar_chart(hour_counts)
@@ -1,9 +1,57 @@
 import streamlit as st
-from utils.data_loaders import load_network_data
+from utils.aggregations import PERIOD_HOURS
+from utils.data_loaders import load_bike_trips, load_stations
+from utils.map_cache import data_version, render_map
+from utils.map_layers import StationLayer, station_popups
+from utils.network import betweenness, filter_trips, network_table, trip_network
+from utils.trip_store import STORE_DIR
 import folium
-from streamlit_folium import st_folium
 import pandas as pd
 
+SIZE_BY = {"degree_centrality": "Degree of Centrality", "pagerank": "PageRank", "betweenness": "Betweenness"}
+WINDOWS = {"all day": (0, 24), **PERIOD_HOURS}
+
+def build_network_map(network_df, size_by="degree_centrality"):
+    map_center = [network_df["lat"].mean(), network_df["lon"].mean()]
+    network_map = folium.Map(location=map_center, zoom_start=12)
+
+    min_c = network_df[size_by].min()
+    max_c = network_df[size_by].max()
+
+    def scale_radius(value, min_size=0.5, max_size=15):
+        if max_c == min_c:
+            return min_size
+        norm = (value - min_c) / (max_c - min_c)
+        return min_size + norm * (max_size - min_size)
+
+    betweenness_line = ""
+    if "betweenness" in network_df:
+        betweenness_line = "Betweenness: {betweenness:.4f} ({betweenness_lower:.4f} - {betweenness_upper:.4f})<br>"
+    popups = station_popups(
+        "<b>{station}</b><br>"
+        "Degree of Centrality: {degree_centrality:.3f}<br>"
+        "PageRank: {pagerank:.4f}<br>" + betweenness_line +
+        "Number of Trips: {trips:.0f}<br>"
+        "Number of Stations trips are going to: {connections_out:.0f}<br>"
+        "Number of stations trips are coming from : {connections_in:.0f}",
+        network_df,
+    )
+    StationLayer(
+        network_df["lat"],
+        network_df["lon"],
+        popup=popups,
+        radius=scale_radius(network_df[size_by].to_numpy()),
+        color="gray",
+        name="Stations",
+    ).add_to(network_map)
+    return network_map
+
+# What the first render loads, warmed in the background by utils/warmup.py.
+WARMUP = (
+    load_bike_trips,
+    lambda: load_stations(data_version(STORE_DIR)),
+)
+
 def show_page():
     st.header("Connectiveness of Stations")
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -16,50 +64,43 @@ def show_page():
         """)
 
     with col2:
-        network_df = load_network_data()
-        network_df = network_df.dropna(subset=["lat", "lon"])
-
-        map_center = [network_df["lat"].mean(), network_df["lon"].mean()]
-        network_map = folium.Map(location=map_center, zoom_start=12)
-
-        min_c = network_df["degree_centrality"].min()
-        max_c = network_df["degree_centrality"].max()
-        
-        def scale_radius(value, min_size=0.5, max_size=15):
-            if max_c == min_c:
-                return min_size
-            norm = (value - min_c) / (max_c - min_c)
-            return min_size + norm * (max_size - min_size)
-        
-        for _, row in network_df.iterrows():
-            centr = row["degree_centrality"]
-            radius = scale_radius(centr)
+        trips = load_bike_trips()
+        stations = load_stations(data_version(STORE_DIR))
+        window_col, size_col = st.columns(2)
+        window = window_col.selectbox("Time of day", list(WINDOWS), format_func=str.capitalize)
+        size_by = size_col.selectbox("Dot size", list(SIZE_BY), format_func=SIZE_BY.get)
+        days = trips["departure_time"].dt.date
+        first_day, last_day = days.min(), days.max()
+        if first_day < last_day:
+            first_day, last_day = st.slider("Dates", first_day, last_day, (first_day, last_day))
 
-            popup_text = f"""
-            <b>{row['station']}</b><br>
-            Degree of Centrality: {centr:.3f}<br>
-            Number of Trips: {int(row['trips'])}<br>
-            Number of Stations trips are going to: {int(row['connections_out'])}<br>
-            Number of stations trips are coming from : {int(row['connections_in'])}
-            """
-
-            folium.CircleMarker(
-                location=[row["lat"], row["lon"]],
-                radius=radius,
-                color="gray",
-                fill=True,
-                fill_color="gray",
-                fill_opacity=0.6,
-                popup=folium.Popup(popup_text, max_width=250)
-            ).add_to(network_map)
+        # Metrics are recomputed from the matching trips on every change.
+        selected = filter_trips(trips, *WINDOWS[window], first_day, last_day)
+        network_df = network_table(selected, stations)
+        pivots = None
+        if size_by == "betweenness":
+            exact = st.checkbox("Exact betweenness", False)
+            pivots = None if exact else st.slider("Sampled source stations", 16, 256, 64, step=16)
+            result = betweenness(trip_network(selected, stations)[1], pivots)
+            network_df["betweenness"] = result.value
+            network_df["betweenness_lower"] = result.lower
+            network_df["betweenness_upper"] = result.upper
+        network_df = network_df.dropna(subset=["lat", "lon"])
 
-        st_folium(network_map, width=700, height=500)
+        if len(network_df):
+            render_map(
+                "network", "centrality", lambda: build_network_map(network_df, size_by),
+                params=(window, first_day, last_day, size_by, pivots), version=data_version(STORE_DIR), width=700, height=500,
+            )
+        else:
+            st.info("No trips match the selected time of day and dates.")
 
     with col3:
         st.markdown("### Summary")
         st.markdown("<br><br>", unsafe_allow_html=True)
-        st.metric("Station with the most Centrality", 
-                  "Karlsplatz")
-        st. write("""
-        ...followed by Museumsquartier, Praterstern and Hauptbahnhof (Central station).
-        """)
+        ranked = network_df.nlargest(4, size_by)["station"].tolist()
+        st.metric("Station with the most Centrality", ranked[0] if ranked else "-")
+        if len(ranked) > 1:
+            runners_up = ranked[1:]
+            listed = runners_up[0] if len(runners_up) == 1 else ", ".join(runners_up[:-1]) + " and " + runners_up[-1]
+            st.write(f"...followed by {listed}.")
@@ -1,12 +1,58 @@
-from PIL import Image
 import streamlit as st
-from utils.data_loaders import load_trajectories_data
+from utils.data_loaders import load_od_flows
+from utils.flows import ALL, WINDOWS, select_flows
+from utils.map_cache import data_version, render_map
+from utils.map_layers import FlowLayer, station_popups
+from utils.trip_store import STORE_DIR
 import folium
-from streamlit_folium import st_folium
-import json
+import numpy as np
 import branca.colormap as cm
 import pandas as pd
 
+# Most lines drawn at once; the browser picks the strongest flows in view.
+VISIBLE_LINES = 500
+
+def build_flow_map(flows, min_dur, max_dur):
+    colormap = cm.linear.YlOrRd_09.scale(min_dur, max_dur)
+    colormap.caption = "Average Trip Duration (min)"
+
+    avg_lat = flows["origin_lat"].mean() if len(flows) else 48.2082
+    avg_lon = flows["origin_lon"].mean() if len(flows) else 16.3738
+    flow_map = folium.Map(location=[avg_lat, avg_lon], zoom_start=12)
+
+    # The colormap's colors at every duration at once, as "#rrggbb" (bytes
+    # truncated the way branca does), rather than one rgb_hex_str per flow.
+    durations = flows["avg_duration_min"].to_numpy(float)
+    # A scale of equal bounds has a repeated index; branca takes its first color.
+    index, first = np.unique(colormap.index, return_index=True)
+    rgb = np.column_stack([np.interp(durations, index, channel)
+                           for channel in np.array(colormap.colors)[first, :3].T])
+    hex_codes = np.array([(rgb * 255.9999).astype(np.uint8).tobytes().hex()]).view("U6")
+    counts = flows["trip_count"].to_numpy()
+    FlowLayer(
+        flows["origin_lat"],
+        flows["origin_lon"],
+        flows["destination_lat"],
+        flows["destination_lon"],
+        color=np.char.add("#", hex_codes),
+        weight=1 + 5 * np.sqrt(counts / max(counts.max(initial=0), 1)),
+        tooltip=station_popups(
+            "<b>{origin}</b> → <b>{destination}</b><br>Trips: {trip_count}<br>"
+            "Avg duration: {avg_duration_min:.1f} min",
+            flows,
+        ),
+        visible=VISIBLE_LINES,
+        name="Flows",
+    ).add_to(flow_map)
+    colormap.add_to(flow_map)
+    return flow_map
+
+
+# What the first render loads, warmed in the background by utils/warmup.py.
+WARMUP = (
+    lambda: load_od_flows(data_version(STORE_DIR)),
+)
+
 
 def show_page():
     st.header("In-depth Analysis")
@@ -35,28 +81,24 @@ def show_page():
         """)
 
     with col2:
-        geojson_data = load_trajectories_data()
-
-        durations = [feat["properties"]["avg_duration_min"] for feat in geojson_data["features"]]
-        min_dur = min(durations)
-        max_dur = max(durations)
-
-        colormap = cm.linear.YlOrRd_09.scale(min_dur, max_dur)
-        colormap.caption = "Average Trip Duration (min)"
-
-        origins = [(f["properties"]["origin_lat"], f["properties"]["origin_lon"]) for f in geojson_data["features"]]
-        avg_lat = sum([lat for lat, _ in origins]) / len(origins)
-        avg_lon = sum([lon for _, lon in origins]) / len(origins)
-
-        image = Image.open("data/aggregated_trajectories.png")
-        st.image(image, caption="Bike Usage Trajectories", use_container_width=True)
+        version = data_version(STORE_DIR)
+        flows = load_od_flows(version)
+        # One color scale for every window so durations stay comparable.
+        durations = flows.loc[flows["window"] == ALL, "avg_duration_min"]
+        min_dur, max_dur = durations.min(), durations.max()
 
-        time_of_day = st.selectbox("Select time of day", ["morning", "midday", "evening", "night"])
-        # Construct image path
-        image_path = f"data/{time_of_day}_traj.png"
-        # Load and show image
-        image = Image.open(image_path)
-        st.image(image, caption=f"{time_of_day.capitalize()} Trajectory Map", use_container_width=True)
+        time_of_day = st.selectbox(
+            "Select time of day", WINDOWS, format_func=lambda w: "All day" if w == ALL else w.capitalize()
+        )
+        min_trips = st.slider("Minimum trips per route", 1, int(flows["trip_count"].max()), 1)
+        selected = select_flows(flows, time_of_day, min_trips)
+        render_map(
+            "trajectories", "flows", lambda: build_flow_map(selected, min_dur, max_dur),
+            params=(time_of_day, min_trips), version=version, width=700, height=500,
+        )
+        st.caption(
+            f"{len(selected):,} routes loaded, the {VISIBLE_LINES} busiest in view are drawn."
+        )
     
     with col3:
         st.markdown("### Notes")
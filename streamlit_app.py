@@ -1,4 +1,6 @@
 import streamlit as st
+from utils import instrumentation, registry
+from utils.warmup import session_warmup
 
 st.set_page_config(
     page_title='Vienna’s share bike system',
@@ -17,27 +19,46 @@ page = st.sidebar.radio("Go to", [
     "Conclusion"
 ])
 
-if page == "Introduction":
-    from last_try.introduction import show_page
-    show_page()
-elif page == "Analysis: Heatmap":
-    from last_try.heatmap import show_page
-    show_page()
-elif page == "Analysis: Network":
-    from last_try.network import show_page
-    show_page()
-elif page == "Analysis: Balance":
-    from last_try.balance import show_page
-    show_page()
-elif page == "Analysis: Trajectories":
-    from last_try.trajectories import show_page
-    show_page()
-elif page == "Analysis: Autocorrelation":
-    from last_try.autocorrelation import show_page
-    show_page()
-elif page == "Conclusion":
-    from last_try.conclusion import show_page
-    show_page()
+# The other pages' datasets are loaded in the background once this page has
+# rendered; a new rerun (e.g. navigating) first stops what is still queued.
+warmup = session_warmup()
+warmup.cancel()
+
+# Every rerun's loader, cache, aggregation and map timings go to the JSONL
+# log; the panel shows the current one.
+show_timings = st.sidebar.checkbox("Show timings")
+timings = st.sidebar.container()
+show_memory = st.sidebar.checkbox("Show memory")
+memory = st.sidebar.container()
+
+with instrumentation.rerun(page) as run:
+    if page == "Introduction":
+        from last_try.introduction import show_page
+        show_page()
+    elif page == "Analysis: Heatmap":
+        from last_try.heatmap import show_page
+        show_page()
+    elif page == "Analysis: Network":
+        from last_try.network import show_page
+        show_page()
+    elif page == "Analysis: Balance":
+        from last_try.balance import show_page
+        show_page()
+    elif page == "Analysis: Trajectories":
+        from last_try.trajectories import show_page
+        show_page()
+    elif page == "Analysis: Autocorrelation":
+        from last_try.autocorrelation import show_page
+        show_page()
+    elif page == "Conclusion":
+        from last_try.conclusion import show_page
+        show_page()
+
+if show_timings:
+    instrumentation.show_panel(run, timings)
+if show_memory:
+    registry.show_panel(memory)
+warmup.schedule(page)
 
 st.markdown("""---""")
 st.caption("Project by Ballardini, Bonilla, Pauly and Tockner • Technical University of Vienna • 2025")
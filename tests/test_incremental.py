@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from utils import incremental, pipeline
+from utils.reconstruction import write_trips_csv
+from utils.trip_store import append_batch, open_trip_table, read_trips_csv
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "MANIFEST", tmp_path / "pipeline.json")
+    trips = read_trips_csv()
+    csv_path = tmp_path / "trips.csv"
+    write_trips_csv([trips.slice(0, 1000)], csv_path)
+    return {"trips": trips, "csv": csv_path, "dir": tmp_path / "store", "state": tmp_path / "aggregates.npz"}
+
+
+def _totals(store):
+    state = incremental.refresh(store["dir"], store["state"])
+    return int(state.dep.sum()), int(state.arr.sum()), int(state.od_count.sum())
+
+
+def test_appended_trips_survive_a_rebuild(store):
+    open_trip_table(store["csv"], store["dir"])
+    assert _totals(store) == (1000, 1000, 1000)
+    append_batch(store["trips"].slice(1000, 100), store["dir"])
+    assert _totals(store) == (1100, 1100, 1100)
+
+    # A newer CSV rebuilds the store; the appended batch is replayed into it.
+    stat = store["csv"].stat()
+    os.utime(store["csv"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert open_trip_table(store_dir=store["dir"]).num_rows == 1100
+    assert _totals(store) == (1100, 1100, 1100)
+
+
+def test_state_resets_when_the_csv_shrinks(store):
+    open_trip_table(store["csv"], store["dir"])
+    append_batch(store["trips"].slice(1000, 100), store["dir"])
+    assert _totals(store) == (1100, 1100, 1100)
+
+    write_trips_csv([store["trips"].slice(0, 500)], store["csv"])
+    assert open_trip_table(store["csv"], store["dir"]).num_rows == 600
+    assert _totals(store) == (600, 600, 600)
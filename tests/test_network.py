@@ -0,0 +1,32 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+from utils.network import betweenness, od_adjacency
+
+
+def _networkx_betweenness(adjacency):
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(adjacency.shape[0]))
+    coo = adjacency.tocoo()
+    graph.add_weighted_edges_from(zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist()))
+    values = nx.betweenness_centrality(graph, weight="weight", normalized=True)
+    return np.array([values[i] for i in range(adjacency.shape[0])])
+
+
+@pytest.mark.parametrize("integer", [True, False])
+def test_exact_betweenness_matches_networkx(integer):
+    rng = np.random.default_rng(1)
+    n, edges = 60, 400
+    origin, destination = rng.integers(0, n, (2, edges))
+    keep = origin != destination
+    weights = rng.integers(1, 6, edges) if integer else rng.uniform(0.5, 5.0, edges)
+    adjacency = od_adjacency(origin[keep], destination[keep], n, weights[keep])
+    np.testing.assert_allclose(betweenness(adjacency, workers=1).value, _networkx_betweenness(adjacency), atol=1e-12)
+
+
+def test_long_paths_are_not_tied_with_longer_ones():
+    # 0 -> 2 (100000) is shorter than 0 -> 1 -> 2 (100001), so 1 lies on no
+    # shortest path; a relative tolerance would count both paths.
+    adjacency = od_adjacency([0, 1, 0], [1, 2, 2], 3, [100000, 1, 100000])
+    np.testing.assert_array_equal(betweenness(adjacency, workers=1).value, np.zeros(3))
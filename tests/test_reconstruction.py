@@ -0,0 +1,63 @@
+import gzip
+import json
+
+import pytest
+
+from utils import reconstruction
+from utils.reconstruction import BikeStates, append_to_store, load_state, reconstruct, snapshot_files, write_trips_csv
+from utils.trip_store import open_trip_table, read_trips_csv
+
+STATIONS = [(1, "A", 48.20, 16.37), (2, "B", 48.21, 16.38), (3, "C", 48.22, 16.36)]
+
+
+def _write_snapshots(directory, minutes):
+    # Bike b is docked at station (b + minute // 2) % 3 at even minutes and
+    # riding at odd ones, so every bike makes a trip every two minutes.
+    directory.mkdir()
+    for minute in range(minutes):
+        docked = {} if minute % 2 else {uid: [] for uid, *_ in STATIONS}
+        for bike in range(6):
+            if docked:
+                docked[STATIONS[(bike + minute // 2) % 3][0]].append(100 + bike)
+        places = [{"uid": uid, "name": name, "lat": lat, "lng": lon, "bike_numbers": docked.get(uid, [])}
+                  for uid, name, lat, lon in STATIONS]
+        feed = {"countries": [{"cities": [{"places": places}]}]}
+        with gzip.open(directory / f"20240501T10{minute:02d}00Z.json.gz", "wt") as f:
+            json.dump(feed, f)
+
+
+@pytest.fixture
+def store(tmp_path):
+    _write_snapshots(tmp_path / "snapshots", 20)
+    paths = snapshot_files(tmp_path / "snapshots")
+    csv_path = tmp_path / "trips.csv"
+    state = BikeStates()
+    write_trips_csv(reconstruct(paths[:5], state), csv_path)
+    state_path = tmp_path / "bikes.npz"
+    state.save(state_path)
+    open_trip_table(csv_path, tmp_path / "store")
+    return {"paths": paths, "csv": csv_path, "dir": tmp_path / "store", "state": state_path}
+
+
+def test_a_crash_between_batch_and_state_repeats_no_trips(store, monkeypatch):
+    expected = read_trips_csv(store["csv"]).num_rows + 6 * 7
+
+    state = load_state(store["state"], store["dir"])
+    tables = append_to_store(reconstruct(store["paths"], state, batch_trips=6), store["dir"], state, store["state"])
+    next(tables)
+    # Crash after the second batch is written, before its states are promoted.
+    append_batch = reconstruction.append_batch
+
+    def crash(table, store_dir):
+        append_batch(table, store_dir)
+        raise SystemExit
+
+    monkeypatch.setattr(reconstruction, "append_batch", crash)
+    with pytest.raises(SystemExit):
+        next(tables)
+    monkeypatch.undo()
+
+    state = load_state(store["state"], store["dir"])
+    for _ in append_to_store(reconstruct(store["paths"], state, batch_trips=6), store["dir"], state, store["state"]):
+        pass
+    assert open_trip_table(store_dir=store["dir"]).num_rows == expected
@@ -0,0 +1,29 @@
+import pandas as pd
+
+from utils.registry import shared
+
+
+def test_positional_keyword_and_default_arguments_share_an_entry():
+    builds = []
+
+    @shared()
+    def load(zoom=11):
+        builds.append(zoom)
+        return zoom
+
+    assert load() == load(11) == load(zoom=11) == 11
+    assert builds == [11]
+    load.clear()
+
+
+def test_views_do_not_write_through_to_the_shared_frame():
+    @shared()
+    def load():
+        return pd.DataFrame({"a": [1, 2]})
+
+    frame = load()
+    frame["a"] = frame["a"] * 10
+    frame["b"] = 1
+    assert load().columns.tolist() == ["a"]
+    assert load()["a"].tolist() == [1, 2]
+    load.clear()
@@ -0,0 +1,62 @@
+import gzip
+import json
+
+import numpy as np
+
+from utils.occupancy import ingest_snapshots
+from utils.reconstruction import snapshot_files
+from utils.rollups import open_rollups
+
+# Polls every 2 min from 2024-05-01 10:00 UTC; station 2 leaves the feed at 40 min.
+POLLS = 60
+
+
+def _write_snapshots(directory):
+    directory.mkdir()
+    for poll in range(POLLS):
+        minute = 600 + 2 * poll
+        places = [{"uid": 1, "name": "A", "lat": 48.2, "lng": 16.37, "bike_racks": 10,
+                   "bikes": poll % 5, "free_racks": 10 - poll % 5}]
+        if poll < 20:
+            places.append({"uid": 2, "name": "B", "lat": 48.21, "lng": 16.38, "bikes": 3, "free_racks": 1})
+        feed = {"countries": [{"cities": [{"places": places}]}]}
+        with gzip.open(directory / f"20240501T{minute // 60:02d}{minute % 60:02d}00Z.json.gz", "wt") as f:
+            json.dump(feed, f)
+
+
+def _query(store_dir, *args):
+    return open_rollups(store_dir).query(*args).sort_values("station_id").reset_index(drop=True)
+
+
+def test_incremental_ingest_matches_one_ingest(tmp_path):
+    _write_snapshots(tmp_path / "snapshots")
+    paths = snapshot_files(tmp_path / "snapshots")
+    ingest_snapshots(paths, tmp_path / "once", segment_polls=7)
+    for lo, hi in ((0, 11), (11, 12), (12, 45), (45, POLLS)):
+        ingest_snapshots(paths[lo:hi], tmp_path / "steps", segment_polls=7)
+    for period in ((None, None), ("2024-05-01T10:15", "2024-05-01T11:30"), ("2024-05-01T10:45", "2024-05-01T10:47")):
+        once, steps = _query(tmp_path / "once", *period), _query(tmp_path / "steps", *period)
+        np.testing.assert_allclose(steps.to_numpy(float), once.to_numpy(float), rtol=1e-6)
+
+
+def test_query_weights_polls_by_their_hold(tmp_path):
+    _write_snapshots(tmp_path / "snapshots")
+    ingest_snapshots(snapshot_files(tmp_path / "snapshots"), tmp_path / "store", segment_polls=7)
+    stats = _query(tmp_path / "store")
+    # Every poll but the last holds for 2 minutes.
+    occupancy = np.arange(POLLS - 1) % 5 / 10
+    np.testing.assert_allclose(stats.loc[0, "mean"], occupancy.mean(), rtol=1e-6)
+    np.testing.assert_allclose(stats.loc[0, "observed_h"], (POLLS - 1) * 2 / 60)
+    # Station 2 is seen for 20 polls; it counts as absent after that.
+    np.testing.assert_allclose(stats.loc[1, ["mean", "observed_h"]].to_numpy(float), [0.75, 40 / 60])
+
+
+def test_rollups_wait_for_a_held_poll(tmp_path):
+    _write_snapshots(tmp_path / "snapshots")
+    paths = snapshot_files(tmp_path / "snapshots")
+    # A single poll holds for no time, so there is nothing to roll up yet.
+    ingest_snapshots(paths[:1], tmp_path / "store")
+    assert open_rollups(tmp_path / "store") is None
+    ingest_snapshots(paths[1:3], tmp_path / "store")
+    stats = _query(tmp_path / "store")
+    np.testing.assert_allclose(stats["observed_h"], [4 / 60, 4 / 60])
@@ -0,0 +1,20 @@
+import pyarrow as pa
+
+from utils.synthetic import generate
+
+
+def _trips(**kwargs):
+    return pa.concat_tables(generate(20_000, stations=50, days=3, **kwargs)).to_pandas()
+
+
+def test_no_bike_makes_two_trips_at_once():
+    trips = _trips().sort_values(["bike_number", "departure_time"], kind="stable")
+    same_bike = trips["bike_number"].to_numpy()[1:] == trips["bike_number"].to_numpy()[:-1]
+    back = trips["arrival_time"].to_numpy()[:-1]
+    leaves = trips["departure_time"].to_numpy()[1:]
+    # A bike back at a snapshot may leave again at the same snapshot.
+    assert (leaves[same_bike] >= back[same_bike]).all()
+
+
+def test_output_does_not_depend_on_the_batch_size():
+    assert _trips(batch_trips=1_000).equals(_trips())
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+from utils.instrumentation import timed
+from utils.trip_store import read_stations
+
+PERIODS = ["morning", "midday", "evening", "night"]
+# Hour-of-day -> index into PERIODS, matching the notebook's get_period:
+# morning 7-11, midday 11-16, evening 16-20, night 20-7.
+PERIOD_OF_HOUR = np.array([3] * 7 + [0] * 4 + [1] * 5 + [2] * 4 + [3] * 4, dtype=np.int8)
+# The same windows as [start, end) hours; night wraps past midnight.
+PERIOD_HOURS = {"morning": (7, 11), "midday": (11, 16), "evening": (16, 20), "night": (20, 7)}
+
+
+def station_index(trips, stations=None):
+    # Stations that occur in `trips`, in code order, and the trips' origin and
+    # destination positions in that table. `stations` is the station dimension
+    # the trip codes refer to, by default the trip store's.
+    if stations is None:
+        stations = read_stations()
+    n = len(trips)
+    codes = np.concatenate([trips["origin_code"].to_numpy(), trips["destination_code"].to_numpy()])
+    used, positions = np.unique(codes, return_inverse=True)
+    table = stations.iloc[used][["station", "lat", "lon"]].reset_index(drop=True)
+    return table, positions[:n], positions[n:]
+
+
+def trip_periods(trips):
+    dep_period = PERIOD_OF_HOUR[trips["departure_time"].dt.hour.to_numpy()]
+    arr_period = PERIOD_OF_HOUR[trips["arrival_time"].dt.hour.to_numpy()]
+    return dep_period, arr_period
+
+
+def hour_mask(hours, start, end):
+    # Hours in [start, end); a window with end <= start wraps past midnight.
+    if start < end:
+        return (hours >= start) & (hours < end)
+    return (hours >= start) | (hours < end)
+
+
+def od_keys(origin, destination, n):
+    return origin.astype(np.int64) * n + destination
+
+
+def compare_counts(dep, arr):
+    return np.where(arr > dep, "more_arrivals", np.where(dep > arr, "more_departures", "equal"))
+
+
+def balance_frame(stations, dep, arr):
+    frame = stations[["station", "lat", "lon"]].copy()
+    frame["dep_count"] = dep
+    frame["arr_count"] = arr
+    frame["activity_type"] = compare_counts(dep, arr)
+    return frame
+
+
+def time_of_day_frame(stations, dep, arr):
+    frame = stations[["station", "lat", "lon"]].copy()
+    for i, period in enumerate(PERIODS):
+        frame[f"dep_{period}"] = dep[:, i]
+    for i, period in enumerate(PERIODS):
+        frame[f"arr_{period}"] = arr[:, i]
+    for i, period in enumerate(PERIODS):
+        frame[f"status_{period}"] = compare_counts(dep[:, i], arr[:, i])
+    return frame
+
+
+def network_frame(stations, started, ended, out_degree, in_degree):
+    n = len(stations)
+    # Same definition as networkx.degree_centrality on the directed OD graph.
+    centrality = (in_degree + out_degree) / max(n - 1, 1)
+    return pd.DataFrame({
+        "station": stations["station"].to_numpy(),
+        "degree_centrality": centrality,
+        "lat": stations["lat"].to_numpy(),
+        "lon": stations["lon"].to_numpy(),
+        "trips_started": started,
+        "trips_ended": ended,
+        "trips": started + ended,
+        "connections_total": in_degree + out_degree,
+        "connections_out": out_degree,
+        "connections_in": in_degree,
+    })
+
+
+def od_frame(stations, origin, destination, trip_count, avg_duration):
+    lat = stations["lat"].to_numpy()
+    lon = stations["lon"].to_numpy()
+    od = pd.DataFrame({
+        "origin_lat": lat[origin],
+        "origin_lon": lon[origin],
+        "destination_lat": lat[destination],
+        "destination_lon": lon[destination],
+        "trip_count": trip_count,
+        "avg_duration_min": avg_duration,
+    })
+    return od.sort_values(
+        ["origin_lat", "origin_lon", "destination_lat", "destination_lon"], ignore_index=True
+    )
+
+
+@timed("aggregate")
+def station_balance(trips, stations=None):
+    stations, origin, destination = station_index(trips, stations)
+    n = len(stations)
+    return balance_frame(stations, np.bincount(origin, minlength=n), np.bincount(destination, minlength=n))
+
+
+@timed("aggregate")
+def station_time_of_day(trips, stations=None):
+    stations, origin, destination = station_index(trips, stations)
+    n, k = len(stations), len(PERIODS)
+    dep_period, arr_period = trip_periods(trips)
+    dep = np.bincount(origin * k + dep_period, minlength=n * k).reshape(n, k)
+    arr = np.bincount(destination * k + arr_period, minlength=n * k).reshape(n, k)
+    return time_of_day_frame(stations, dep, arr)
+
+
+@timed("aggregate")
+def network_metrics(trips, stations=None):
+    stations, origin, destination = station_index(trips, stations)
+    n = len(stations)
+    pairs = np.unique(od_keys(origin, destination, n))
+    return network_frame(
+        stations,
+        np.bincount(origin, minlength=n),
+        np.bincount(destination, minlength=n),
+        np.bincount(pairs // n, minlength=n),
+        np.bincount(pairs % n, minlength=n),
+    )
+
+
+@timed("aggregate")
+def od_aggregates(trips, stations=None):
+    stations, origin, destination = station_index(trips, stations)
+    n = len(stations)
+    keys, inverse = np.unique(od_keys(origin, destination, n), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(keys))
+    sums = np.bincount(inverse, weights=trips["duration_min"].to_numpy(np.float64), minlength=len(keys))
+    return od_frame(stations, keys // n, keys % n, counts, sums / counts)
+
+
+def od_geojson(od, name="agg_dur_traj"):
+    columns = ["origin_lat", "origin_lon", "destination_lat", "destination_lon"]
+    coords = od[columns].to_numpy().tolist()
+    counts = od["trip_count"].to_numpy().tolist()
+    durations = od["avg_duration_min"].to_numpy().tolist()
+    features = [
+        {
+            "type": "Feature",
+            "properties": {
+                "origin_lat": o_lat, "origin_lon": o_lon,
+                "destination_lat": d_lat, "destination_lon": d_lon,
+                "trip_count": count, "avg_duration_min": duration,
+            },
+            "geometry": {"type": "LineString", "coordinates": [[o_lon, o_lat], [d_lon, d_lat]]},
+        }
+        for (o_lat, o_lon, d_lat, d_lon), count, duration in zip(coords, counts, durations)
+    ]
+    return {
+        "type": "FeatureCollection",
+        "name": name,
+        "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
+        "features": features,
+    }
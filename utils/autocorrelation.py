@@ -0,0 +1,209 @@
+import os
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from utils.instrumentation import timed
+from utils.workers import process_pool
+
+EARTH_RADIUS_M = 6371008.8
+CLUSTERS = ["Non-Significant", "HH", "LH", "LL", "HL"]
+# Keeps the (stations, permutations, neighbours) draw array of a batch small.
+BATCH_ELEMENTS = 2 ** 22
+# Local permutations run in fixed station chunks, each with its own seed, so
+# results depend only on the seed and never on the number of workers.
+CHUNK_STATIONS = 256
+# Below this many (station, permutation, neighbour) draws a process pool
+# costs more than it saves.
+PARALLEL_ELEMENTS = 2 ** 25
+
+
+@dataclass(frozen=True)
+class Moran:
+    I: float
+    expected: float
+    z_sim: float
+    p_sim: float
+    permutations: int
+
+
+def _project(lat, lon):
+    # Local equirectangular projection in metres; exact enough at city scale.
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    x = EARTH_RADIUS_M * lon * np.cos(lat.mean())
+    y = EARTH_RADIUS_M * lat
+    return np.column_stack([x, y])
+
+
+def _row_standardize(w):
+    sums = np.asarray(w.sum(axis=1)).ravel()
+    scale = np.divide(1.0, sums, out=np.zeros_like(sums), where=sums > 0)
+    return sparse.diags(scale) @ w
+
+
+@timed("aggregate")
+def knn_weights(lat, lon, k=8):
+    # Row-standardised CSR weights linking every station to its k nearest neighbours.
+    points = _project(lat, lon)
+    n = len(points)
+    k = min(k, n - 1)
+    _, neighbours = cKDTree(points).query(points, k=k + 1)
+    rows = np.repeat(np.arange(n), k)
+    # The first hit is usually the station itself, but not for duplicate
+    # coordinates, so drop self-links explicitly and keep the k closest others.
+    keep = neighbours != np.arange(n)[:, None]
+    keep[keep.sum(axis=1) > k, -1] = False
+    cols = neighbours[keep]
+    w = sparse.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(n, n))
+    return _row_standardize(w)
+
+
+@timed("aggregate")
+def distance_band_weights(lat, lon, threshold_m=1000.0):
+    # Row-standardised CSR weights linking stations closer than threshold_m.
+    # Stations without neighbours get an empty row.
+    pairs = cKDTree(_project(lat, lon)).query_pairs(threshold_m, output_type="ndarray")
+    n = len(lat)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    w = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    return _row_standardize(w)
+
+
+def _deviations(y):
+    y = np.asarray(y, dtype=np.float64)
+    return y - y.mean()
+
+
+@timed("aggregate")
+def moran(y, w, permutations=999, seed=0):
+    z = _deviations(y)
+    n = len(z)
+    expected = -1.0 / (n - 1)
+    # I is undefined for a constant variable.
+    if not z.any():
+        return Moran(np.nan, expected, np.nan, np.nan, 0)
+    scale = n / w.sum() / (z @ z)
+    observed = float(z @ (w @ z) * scale)
+    if not permutations:
+        return Moran(observed, expected, np.nan, np.nan, 0)
+    rng = np.random.default_rng(seed)
+    batch = max(1, BATCH_ELEMENTS // n)
+    simulated = []
+    for start in range(0, permutations, batch):
+        zs = rng.permuted(np.broadcast_to(z, (min(batch, permutations - start), n)), axis=1)
+        # (w @ zs.T) is one sparse product for the whole batch of permutations.
+        simulated.append(np.einsum("pn,np->p", zs, w @ zs.T) * scale)
+    simulated = np.concatenate(simulated)
+    larger = int((simulated >= observed).sum())
+    larger = min(larger, permutations - larger)
+    return Moran(
+        observed, expected,
+        float((observed - simulated.mean()) / simulated.std()),
+        (larger + 1) / (permutations + 1),
+        permutations,
+    )
+
+
+def _neighbour_table(w):
+    # CSR rows padded to the largest cardinality; padded slots have weight 0.
+    w = w.tocsr()
+    counts = np.diff(w.indptr)
+    width = max(int(counts.max(initial=0)), 1)
+    weights = np.zeros((w.shape[0], width))
+    slot = np.arange(w.nnz) - np.repeat(w.indptr[:-1], counts)
+    weights[np.repeat(np.arange(w.shape[0]), counts), slot] = w.data
+    return weights, counts
+
+
+def _draw_neighbours(rng, n, width, permutations):
+    # `width` distinct values from range(n) per permutation. Redrawing the
+    # rare rows with a repeat is far cheaper than a full shuffle per row.
+    if width * 4 > n:
+        return np.stack([rng.choice(n, size=width, replace=False) for _ in range(permutations)])
+    draws = rng.integers(0, n, size=(permutations, width))
+    while True:
+        ordered = np.sort(draws, axis=1)
+        repeated = (ordered[:, 1:] == ordered[:, :-1]).any(axis=1)
+        if not repeated.any():
+            return draws
+        draws[repeated] = rng.integers(0, n, size=(int(repeated.sum()), width))
+
+
+def _local_chunk(z, weights, local_i, scale, stations, permutations, seed):
+    # Conditional randomisation for one chunk of stations: every station keeps
+    # its own value and gets its neighbour slots filled from the other n - 1
+    # stations. The chunk shares one set of draws, shifted past each station.
+    rng = np.random.default_rng(seed)
+    draws = _draw_neighbours(rng, len(z) - 1, weights.shape[1], permutations)
+    larger = np.zeros(len(stations), dtype=np.int64)
+    batch = max(1, BATCH_ELEMENTS // (permutations * weights.shape[1]))
+    for start in range(0, len(stations), batch):
+        rows = slice(start, start + batch)
+        chunk = stations[rows]
+        ids = draws[None, :, :] + (draws[None, :, :] >= chunk[:, None, None])
+        lag = np.einsum("cpk,ck->cp", z[ids], weights[rows])
+        simulated = (z[chunk] * scale)[:, None] * lag
+        larger[rows] = (simulated >= local_i[chunk, None]).sum(axis=1)
+    return larger
+
+
+def _local_p_values(z, weights, local_i, scale, stations, permutations, seed, workers, progress):
+    chunks = [stations[i:i + CHUNK_STATIONS] for i in range(0, len(stations), CHUNK_STATIONS)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks = [
+        (z, weights[chunk], local_i, scale, chunk, permutations, chunk_seed)
+        for chunk, chunk_seed in zip(chunks, seeds)
+    ]
+    workers = workers or os.cpu_count() or 1
+    results = [None] * len(tasks)
+    if workers > 1 and len(tasks) > 1 and len(stations) * permutations * weights.shape[1] >= PARALLEL_ELEMENTS:
+        pool = process_pool(workers)
+        futures = {pool.submit(_local_chunk, *task): i for i, task in enumerate(tasks)}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            if progress:
+                progress(done / len(tasks))
+    else:
+        for i, task in enumerate(tasks):
+            results[i] = _local_chunk(*task)
+            if progress:
+                progress((i + 1) / len(tasks))
+    return np.concatenate(results)
+
+
+@timed("aggregate")
+def local_moran(y, w, permutations=999, seed=0, significance=0.05, workers=None, progress=None):
+    # One row per station: local I, spatial lag, quadrant and pseudo p-value,
+    # with `cluster` set to the quadrant where p_sim <= significance. Large
+    # runs are spread over `workers` processes (default: all cores);
+    # `progress` is called with the finished fraction, e.g. st.progress(...).progress.
+    z = _deviations(y)
+    n = len(z)
+    lag = w @ z
+    # Same scaling as PySAL's esda.Moran_Local. A constant variable has no
+    # deviations: every local I is 0 and no station is tested.
+    scale = (n - 1) / (z @ z) if z.any() else 0.0
+    local_i = z * lag * scale
+    quadrant = np.select([(z > 0) & (lag > 0), (z < 0) & (lag > 0), (z < 0) & (lag < 0), (z > 0) & (lag < 0)],
+                         [1, 2, 3, 4], 0)
+    p_sim = np.ones(len(z))
+    weights, counts = _neighbour_table(w)
+    stations = np.flatnonzero(counts > 0) if z.any() else np.zeros(0, dtype=np.int64)
+    if permutations and len(stations):
+        larger = _local_p_values(z, weights, local_i, scale, stations, permutations, seed, workers, progress)
+        larger = np.minimum(larger, permutations - larger)
+        p_sim[stations] = (larger + 1) / (permutations + 1)
+    significant = (p_sim <= significance) & (quadrant > 0)
+    return pd.DataFrame({
+        "local_i": local_i,
+        "lag": lag,
+        "quadrant": quadrant,
+        "p_sim": p_sim,
+        "cluster": pd.Categorical.from_codes(np.where(significant, quadrant, 0), CLUSTERS),
+    })
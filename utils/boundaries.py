@@ -0,0 +1,89 @@
+import argparse
+import shutil
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from utils.trip_store import DATA_DIR, source_fingerprint
+
+BEZIRKE_CSV = DATA_DIR / "BEZIRKSGRENZEOGD.csv"
+BOUNDARY_DIR = DATA_DIR / "cache" / "bezirke"
+SOURCE_CRS = 31256
+KEEP_COLUMNS = ["NAMEK", "BEZNR"]
+
+# (tolerance in metres, deepest zoom it is used for). At Vienna's latitude a
+# screen pixel is ~50 m at zoom 11 and halves with every zoom step, so each
+# level stays below about half a pixel of error.
+LEVELS = [(25.0, 11), (6.0, 13), (1.5, 15), (0.0, None)]
+
+
+def level_for_zoom(zoom):
+    # Without a zoom the caller gets the original, unsimplified geometry.
+    if zoom is not None:
+        for tolerance, max_zoom in LEVELS:
+            if max_zoom is not None and zoom <= max_zoom:
+                return tolerance
+    return LEVELS[-1][0]
+
+
+def level_zoom(zoom):
+    # The deepest zoom of the level `zoom` falls in (None for the unsimplified
+    # one), so that every zoom of a level loads the same boundaries.
+    tolerance = level_for_zoom(zoom)
+    return next(max_zoom for t, max_zoom in LEVELS if t == tolerance)
+
+
+def _level_path(tolerance, out_dir=BOUNDARY_DIR):
+    return Path(out_dir) / f"bezirke_{tolerance:g}m.parquet"
+
+
+def build_boundaries(csv_path=BEZIRKE_CSV, out_dir=BOUNDARY_DIR):
+    df = pd.read_csv(csv_path, usecols=["SHAPE", *KEEP_COLUMNS])
+    df = df[df["SHAPE"].str.startswith("POLYGON")]
+    geometry = shapely.from_wkt(df["SHAPE"].to_numpy())
+    out_dir = Path(out_dir)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True)
+    for tolerance, _ in LEVELS:
+        # Districts share edges, so they are simplified as one coverage to keep
+        # neighbours from drifting apart or overlapping.
+        simplified = shapely.coverage_simplify(geometry, tolerance) if tolerance else geometry
+        gdf = gpd.GeoDataFrame(
+            df[KEEP_COLUMNS].reset_index(drop=True),
+            geometry=gpd.GeoSeries(simplified, crs=SOURCE_CRS).to_crs(epsg=4326).values,
+        )
+        # ~0.1 m in WGS84; trims the GeoJSON sent to the browser.
+        gdf.geometry = shapely.set_precision(gdf.geometry.values, 1e-6)
+        gdf.to_parquet(_level_path(tolerance, out_dir))
+    (out_dir / "SOURCE").write_text(source_fingerprint(csv_path))
+    return out_dir
+
+
+def boundaries_are_current(csv_path=BEZIRKE_CSV, out_dir=BOUNDARY_DIR):
+    marker = Path(out_dir) / "SOURCE"
+    return marker.exists() and marker.read_text() == source_fingerprint(csv_path)
+
+
+def load_boundaries(zoom=None, csv_path=BEZIRKE_CSV, out_dir=BOUNDARY_DIR):
+    if not boundaries_are_current(csv_path, out_dir):
+        build_boundaries(csv_path, out_dir)
+    return gpd.read_parquet(_level_path(level_for_zoom(zoom), out_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build simplified district boundaries for each zoom range.")
+    parser.add_argument("--csv", type=Path, default=BEZIRKE_CSV)
+    parser.add_argument("--out", type=Path, default=BOUNDARY_DIR)
+    args = parser.parse_args()
+    build_boundaries(args.csv, args.out)
+    for tolerance, max_zoom in LEVELS:
+        gdf = gpd.read_parquet(_level_path(tolerance, args.out))
+        vertices = shapely.get_num_coordinates(gdf.geometry.values).sum()
+        print(f"{tolerance:g} m (zoom <= {max_zoom or 'max'}): {vertices:,} vertices")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import gzip
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+import aiohttp
+
+from utils.reconstruction import SNAPSHOT_TIME_FORMAT
+from utils.trip_store import DATA_DIR
+
+API_URL = "https://api.nextbike.net"
+LIVE_PATH = "/maps/nextbike-live.json"
+SNAPSHOT_DIR = DATA_DIR / "snapshots"
+INTERVAL_S = 30.0
+# Requests per second across all cities, with a small burst for the start of a tick.
+RATE = 4.0
+BURST = 4
+MAX_RETRIES = 4
+BACKOFF_S = 1.0
+TIMEOUT_S = 20.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    # Token bucket shared by every city's poller.
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SnapshotStore:
+    # Append-only <root>/<city>/<YYYYmmddTHHMMSSZ>.json.gz files, the layout
+    # utils.reconstruction reads. Existing files are never rewritten.
+
+    def __init__(self, root=SNAPSHOT_DIR):
+        self.root = Path(root)
+        self._last = {}
+
+    def path(self, city, when):
+        return self.root / city / f"{when.strftime(SNAPSHOT_TIME_FORMAT)}.json.gz"
+
+    def append(self, city, when, body):
+        path = self.path(city, when)
+        if path.exists():
+            return path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(gzip.compress(body, compresslevel=6))
+        os.replace(tmp_path, path)
+        self._last[city] = path
+        return path
+
+    def repeat(self, city, when):
+        # An unchanged feed still needs a file at this time, or the trips
+        # rebuilt from the store would depart at the last *changed* snapshot.
+        # A hard link costs no space.
+        previous = self._last.get(city)
+        if previous is None:
+            # After a restart, the newest file written by the previous run.
+            previous = max((self.root / city).glob("*.json.gz"), default=None)
+            if previous is None:
+                return None
+            self._last[city] = previous
+        path = self.path(city, when)
+        if not path.exists():
+            try:
+                os.link(previous, path)
+            except OSError:
+                path.write_bytes(previous.read_bytes())
+        return path
+
+
+@dataclass
+class CityStats:
+    fetched: int = 0
+    not_modified: int = 0
+    retries: int = 0
+    failed: int = 0
+    # Ticks dropped because the previous poll was still running.
+    skipped: int = 0
+    latency_s: list = field(default_factory=list)
+
+
+class CityPoller:
+    # Polls one city on a fixed tick with conditional requests: the ETag and
+    # Last-Modified of the last response are sent back, so an unchanged feed
+    # costs a 304 instead of the full body.
+
+    def __init__(self, name, uid, session, limiter, store, base_url=API_URL, interval_s=INTERVAL_S):
+        self.name = name
+        self.uid = uid
+        self.session = session
+        self.limiter = limiter
+        self.store = store
+        self.url = base_url.rstrip("/") + LIVE_PATH
+        self.interval_s = interval_s
+        self.etag = None
+        self.last_modified = None
+        self.stats = CityStats()
+
+    async def fetch(self):
+        # (status, body) after retrying transient failures with full-jitter
+        # exponential backoff; a Retry-After header takes precedence.
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        for attempt in range(MAX_RETRIES + 1):
+            await self.limiter.acquire()
+            delay = BACKOFF_S * 2 ** attempt * random.random()
+            try:
+                async with self.session.get(self.url, params={"city": str(self.uid)}, headers=headers) as response:
+                    if response.status not in RETRY_STATUS:
+                        response.raise_for_status()
+                        body = await response.read() if response.status == 200 else None
+                        self.etag = response.headers.get("ETag", self.etag)
+                        self.last_modified = response.headers.get("Last-Modified", self.last_modified)
+                        return response.status, body
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = float(retry_after)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                pass
+            if attempt == MAX_RETRIES:
+                break
+            self.stats.retries += 1
+            await asyncio.sleep(delay)
+        return None, None
+
+    async def poll(self, when):
+        start = time.monotonic()
+        try:
+            status, body = await self.fetch()
+        except aiohttp.ClientResponseError:
+            status, body = None, None
+        if status == 200:
+            await asyncio.to_thread(self.store.append, self.name, when, body)
+            self.stats.fetched += 1
+        elif status == 304:
+            await asyncio.to_thread(self.store.repeat, self.name, when)
+            self.stats.not_modified += 1
+        else:
+            self.stats.failed += 1
+        self.stats.latency_s.append(time.monotonic() - start)
+
+    async def run(self, until=None):
+        # Ticks are aligned to the start time. A poll that overruns its tick
+        # makes the poller skip the ticks it missed rather than queue them up.
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tick = 0
+        while until is None or loop.time() < until:
+            await self.poll(datetime.now(timezone.utc))
+            elapsed = int((loop.time() - start) // self.interval_s)
+            self.stats.skipped += max(elapsed - tick, 0)
+            tick = max(tick, elapsed) + 1
+            await asyncio.sleep(max(start + tick * self.interval_s - loop.time(), 0))
+
+
+async def collect(cities, store=None, base_url=API_URL, interval_s=INTERVAL_S, duration_s=None,
+                  rate=RATE, burst=BURST):
+    # Polls {name: city uid} concurrently over one pooled session until
+    # duration_s has passed (forever when None). Returns {name: CityStats}.
+    store = store or SnapshotStore()
+    limiter = RateLimiter(rate, burst)
+    connector = aiohttp.TCPConnector(limit=max(len(cities), 1), ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT_S)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=True) as session:
+        pollers = [
+            CityPoller(name, uid, session, limiter, store, base_url, interval_s)
+            for name, uid in cities.items()
+        ]
+        until = None if duration_s is None else asyncio.get_running_loop().time() + duration_s
+        await asyncio.gather(*(poller.run(until) for poller in pollers))
+    return {poller.name: poller.stats for poller in pollers}
+
+
+def report(stats):
+    for name, s in stats.items():
+        latency = sorted(s.latency_s) or [0.0]
+        print(f"{name}: {s.fetched} fetched, {s.not_modified} not modified, {s.failed} failed, "
+              f"{s.retries} retries, {s.skipped} ticks skipped, "
+              f"p50 {latency[len(latency) // 2] * 1000:.0f} ms, max {latency[-1] * 1000:.0f} ms")
+
+
+async def _collect_from_fake(cities, store, interval_s, duration_s, **fake_kwargs):
+    from utils.fake_nextbike import fake_server
+
+    async with fake_server({uid: name for name, uid in cities.items()}, **fake_kwargs) as (url, app):
+        stats = await collect(cities, store, url, interval_s, duration_s)
+        print(f"fake server: {app['counts']}")
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll the Nextbike live feed into the snapshot store.")
+    parser.add_argument("cities", nargs="+", help="name=uid pairs, e.g. wien=<nextbike city uid>.")
+    parser.add_argument("--out", type=Path, default=SNAPSHOT_DIR)
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--interval", type=float, default=INTERVAL_S)
+    parser.add_argument("--duration", type=float, help="Stop after this many seconds.")
+    parser.add_argument("--fake", action="store_true", help="Poll a local fake API instead (offline runs).")
+    parser.add_argument("--fake-tick", type=float, default=INTERVAL_S)
+    parser.add_argument("--fake-latency", type=float, default=0.0)
+    parser.add_argument("--fake-failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    cities = {name: int(uid) for name, uid in (city.split("=") for city in args.cities)}
+    store = SnapshotStore(args.out)
+    if args.fake:
+        run = _collect_from_fake(cities, store, args.interval, args.duration, tick_s=args.fake_tick,
+                                 latency_s=args.fake_latency, failure_rate=args.fake_failure_rate)
+    else:
+        run = collect(cities, store, args.url, args.interval, args.duration)
+    try:
+        report(asyncio.run(run))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+
+from utils.instrumentation import timed
+
+_build_lock = threading.Lock()
+
+# Streamlit serves the app's ./static directory at /app/static
+# (server.enableStaticServing in .streamlit/config.toml), so the browser
+# fetches density tiles straight from disk, only those in view.
+DENSITY_DIR = Path(__file__).parent.parent / "static" / "density"
+TILE_URL = "/app/static/density/{z}/{x}/{y}.png"
+TILE_SIZE = 256
+# Coarsest to finest. Only the finest level is binned from trips; every other
+# level is a 2x2 sum of the one below it.
+ZOOMS = (10, 11, 12, 13)
+VIENNA_BOUNDS = ((48.10, 16.15), (48.34, 16.60))
+GRADIENT = {0.0: "#ffffff", 0.333: "#ffd43b", 0.6667: "#ed6d0c", 1.0: "#910606"}
+
+
+def _pixel_xy(lat, lon, zoom):
+    scale = TILE_SIZE * 2 ** zoom
+    x = (np.asarray(lon, dtype=np.float64) + 180.0) / 360.0 * scale
+    s = np.sin(np.radians(np.asarray(lat, dtype=np.float64)))
+    y = (0.5 - np.log((1 + s) / (1 - s)) / (4 * np.pi)) * scale
+    return x, y
+
+
+def _lat_lon(x, y, zoom):
+    scale = TILE_SIZE * 2 ** zoom
+    lon = x / scale * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi - 2 * np.pi * y / scale)))
+    return float(lat), float(lon)
+
+
+def _grid_origin(bounds, zoom):
+    # Snapped so that every coarser level's pixels are whole 2x2 blocks.
+    step = 2 ** (zoom - ZOOMS[0])
+    (south, west), (north, east) = bounds
+    x0, y0 = _pixel_xy(north, west, zoom)
+    x1, y1 = _pixel_xy(south, east, zoom)
+    x0, y0 = np.floor(x0 / step) * step, np.floor(y0 / step) * step
+    x1, y1 = np.ceil(x1 / step) * step, np.ceil(y1 / step) * step
+    return int(x0), int(y0), int(x1 - x0), int(y1 - y0)
+
+
+def bin_points(lat, lon, zoom, bounds=VIENNA_BOUNDS, weights=None):
+    x0, y0, width, height = _grid_origin(bounds, zoom)
+    x, y = _pixel_xy(lat, lon, zoom)
+    col = np.floor(x - x0).astype(np.int64)
+    row = np.floor(y - y0).astype(np.int64)
+    inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+    flat = row[inside] * width + col[inside]
+    w = None if weights is None else np.asarray(weights, dtype=np.float64)[inside]
+    counts = np.bincount(flat, weights=w, minlength=width * height)
+    return counts.reshape(height, width).astype(np.float32)
+
+
+def pyramid(lat, lon, bounds=VIENNA_BOUNDS, zooms=ZOOMS, weights=None):
+    levels = {zooms[-1]: bin_points(lat, lon, zooms[-1], bounds, weights)}
+    for zoom in reversed(zooms[:-1]):
+        finer = levels[zoom + 1]
+        h, w = finer.shape
+        levels[zoom] = finer.reshape(h // 2, 2, w // 2, 2).sum(axis=(1, 3))
+    return levels
+
+
+def _gradient_table(gradient=GRADIENT):
+    stops = np.array(sorted(gradient))
+    colors = np.array([
+        [int(gradient[s][i:i + 2], 16) for i in (1, 3, 5)] for s in stops
+    ], dtype=np.float64)
+    return stops, colors
+
+
+def colorize(density, gradient=GRADIENT, opacity=0.8):
+    peak = density.max()
+    value = np.sqrt(density / peak) if peak > 0 else density
+    stops, colors = _gradient_table(gradient)
+    rgba = np.empty(density.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(value, stops, colors[:, channel])
+    # Fade the low end out so the basemap shows through empty areas.
+    rgba[..., 3] = np.clip(value * 3, 0, 1) * opacity * 255
+    return rgba
+
+
+def render_tiles(counts, zoom, out_dir, bounds=VIENNA_BOUNDS, sigma=8.0, gradient=GRADIENT, opacity=0.8):
+    # Writes the level as <out_dir>/<zoom>/<x>/<y>.png map tiles. The kernel is
+    # fixed in screen pixels, so it covers the same area on screen at every zoom.
+    rgba = colorize(gaussian_filter(counts, sigma=sigma, mode="constant"), gradient, opacity)
+    x0, y0, width, height = _grid_origin(bounds, zoom)
+    tx0, ty0 = x0 // TILE_SIZE, y0 // TILE_SIZE
+    tx1, ty1 = -(-(x0 + width) // TILE_SIZE), -(-(y0 + height) // TILE_SIZE)
+    canvas = np.zeros(((ty1 - ty0) * TILE_SIZE, (tx1 - tx0) * TILE_SIZE, 4), dtype=np.uint8)
+    top, left = y0 - ty0 * TILE_SIZE, x0 - tx0 * TILE_SIZE
+    canvas[top:top + height, left:left + width] = rgba
+    for tx in range(tx0, tx1):
+        column = Path(out_dir) / str(zoom) / str(tx)
+        column.mkdir(parents=True)
+        for ty in range(ty0, ty1):
+            i, j = (ty - ty0) * TILE_SIZE, (tx - tx0) * TILE_SIZE
+            tile = canvas[i:i + TILE_SIZE, j:j + TILE_SIZE]
+            Image.fromarray(tile, mode="RGBA").save(column / f"{ty}.png", format="PNG")
+    return (tx1 - tx0) * (ty1 - ty0)
+
+
+def build_density_pyramid(lat, lon, version, out_dir=DENSITY_DIR, bounds=VIENNA_BOUNDS, **style):
+    # Built in a directory of its own next to out_dir and swapped in, so a
+    # browser never fetches a half-written pyramid and concurrent builds
+    # never share files.
+    out_dir = Path(out_dir)
+    out_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=out_dir.name + ".tmp-", dir=out_dir.parent))
+    levels = pyramid(lat, lon, bounds)
+    tiles = {str(zoom): render_tiles(counts, zoom, tmp_dir, bounds, **style) for zoom, counts in levels.items()}
+    x0, y0, width, height = _grid_origin(bounds, ZOOMS[-1])
+    meta = {
+        "version": version,
+        "zooms": sorted(levels),
+        "bounds": [_lat_lon(x0, y0 + height, ZOOMS[-1]), _lat_lon(x0 + width, y0, ZOOMS[-1])],
+        "tiles": tiles,
+    }
+    (tmp_dir / "meta.json").write_text(json.dumps(meta))
+    old_dir = tmp_dir.with_name(tmp_dir.name + ".old")
+    if out_dir.exists():
+        out_dir.replace(old_dir)
+    tmp_dir.replace(out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return meta
+
+
+def _read_meta(out_dir):
+    try:
+        return json.loads((Path(out_dir) / "meta.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+
+@timed("aggregate")
+def density_tiles(trips, version, out_dir=DENSITY_DIR):
+    # `version` identifies the trips, e.g. map_cache.data_version(STORE_DIR);
+    # the tiles are only rebuilt when it changes, by one session at a time;
+    # the others wait and read its pyramid. Returns the pyramid's meta: its
+    # zooms, the bounds its tiles cover and the tile count per zoom.
+    version = hashlib.sha256(version.encode()).hexdigest()
+    meta = _read_meta(out_dir)
+    if meta is not None and meta["version"] == version:
+        return meta
+    with _build_lock:
+        meta = _read_meta(out_dir)
+        if meta is None or meta["version"] != version:
+            lat = np.concatenate([trips["origin_lat"].to_numpy(), trips["destination_lat"].to_numpy()])
+            lon = np.concatenate([trips["origin_lon"].to_numpy(), trips["destination_lon"].to_numpy()])
+            meta = build_density_pyramid(lat, lon, version, out_dir)
+    return meta
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timezone
+
+import numpy as np
+from aiohttp import web
+
+from utils.collector import LIVE_PATH
+
+# Feed changes this often, like the real API's ~30 s refresh.
+TICK_S = 30.0
+CENTER = (48.2082, 16.3738)
+
+
+class FakeCity:
+    # Bikes docked at random stations; every tick a share of them starts
+    # riding and riders dock at a random other station. The state only depends
+    # on the seed and the tick, so two servers with the same seed agree.
+
+    def __init__(self, uid, name, stations=250, bikes=3000, seed=0):
+        self.uid = uid
+        self.name = name
+        rng = np.random.default_rng([seed, uid])
+        self.station_uid = uid * 100_000 + np.arange(stations)
+        self.lat = (CENTER[0] + rng.normal(0, 0.03, stations)).round(6)
+        self.lon = (CENTER[1] + rng.normal(0, 0.05, stations)).round(6)
+        self.racks = rng.integers(10, 30, stations)
+        self.bike_number = 100_000 + uid * 10_000 + np.arange(bikes)
+        # -1 while riding.
+        self.station = rng.integers(0, stations, bikes)
+        self.rng = rng
+        self.tick = 0
+
+    def advance(self, tick):
+        while self.tick < tick:
+            riding = self.station < 0
+            docking = riding & (self.rng.random(len(riding)) < 0.3)
+            self.station[docking] = self.rng.integers(0, len(self.station_uid), int(docking.sum()))
+            leaving = ~riding & (self.rng.random(len(riding)) < 0.02)
+            self.station[leaving] = -1
+            self.tick += 1
+
+    def feed(self):
+        order = np.argsort(self.station, kind="stable")
+        docked = order[self.station[order] >= 0]
+        bounds = np.searchsorted(self.station[docked], np.arange(len(self.station_uid) + 1))
+        numbers = self.bike_number[docked].astype(str).tolist()
+        places = [
+            {
+                "uid": int(self.station_uid[i]), "name": f"Station {i}",
+                "lat": float(self.lat[i]), "lng": float(self.lon[i]),
+                "bike": False, "spot": True, "bikes": int(bounds[i + 1] - bounds[i]),
+                "bike_racks": int(self.racks[i]), "free_racks": max(int(self.racks[i] - bounds[i + 1] + bounds[i]), 0),
+                "bike_numbers": numbers[bounds[i]:bounds[i + 1]],
+            }
+            for i in range(len(self.station_uid))
+        ]
+        return {"countries": [{"name": "Fake", "cities": [{"uid": self.uid, "name": self.name, "places": places}]}]}
+
+
+def make_app(cities, tick_s=TICK_S, latency_s=0.0, failure_rate=0.0, seed=0):
+    # aiohttp app serving LIVE_PATH?city=<uid> with ETag / Last-Modified
+    # validators. `failure_rate` of requests get a 503 and every response is
+    # delayed by `latency_s`, to exercise the collector's retries and pacing.
+    state = {uid: FakeCity(uid, name, seed=seed) for uid, name in cities.items()}
+    bodies = {}
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    counts = {"requests": 0, "not_modified": 0, "failed": 0}
+
+    async def live(request):
+        counts["requests"] += 1
+        if latency_s:
+            await asyncio.sleep(latency_s)
+        if failure_rate and rng.random() < failure_rate:
+            counts["failed"] += 1
+            return web.Response(status=503)
+        try:
+            city = state[int(request.query["city"])]
+        except (KeyError, ValueError):
+            raise web.HTTPNotFound()
+        tick = int((time.time() - start) // tick_s)
+        changed = datetime.fromtimestamp(start + tick * tick_s, timezone.utc).replace(microsecond=0)
+        etag = f'"{city.uid}-{tick}"'
+        headers = {"ETag": etag, "Last-Modified": format_datetime(changed, usegmt=True)}
+        since = request.headers.get("If-Modified-Since")
+        if request.headers.get("If-None-Match") == etag or (since and parsedate_to_datetime(since) >= changed):
+            counts["not_modified"] += 1
+            return web.Response(status=304, headers=headers)
+        if bodies.get(city.uid, (None,))[0] != tick:
+            city.advance(tick)
+            bodies[city.uid] = (tick, json.dumps(city.feed()).encode())
+        return web.Response(body=bodies[city.uid][1], content_type="application/json", headers=headers)
+
+    app = web.Application()
+    app.router.add_get(LIVE_PATH, live)
+    app["counts"] = counts
+    return app
+
+
+@asynccontextmanager
+async def fake_server(cities, host="127.0.0.1", port=0, **kwargs):
+    # Runs the fake API for the duration of the block and yields (base url, app).
+    app = make_app(cities, **kwargs)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        yield f"http://{host}:{port}", app
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Nextbike live API.")
+    parser.add_argument("cities", nargs="*", default=["wien=1"], help="name=uid pairs.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tick", type=float, default=TICK_S)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    cities = {int(uid): name for name, uid in (city.split("=") for city in args.cities)}
+    app = make_app(cities, args.tick, args.latency, args.failure_rate)
+    web.run_app(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+from utils import aggregations
+from utils.instrumentation import timed
+
+ALL = "all"
+WINDOWS = [ALL] + aggregations.PERIODS
+# Upper bound on the flows sent to the browser; the map draws a smaller,
+# viewport-dependent subset of these.
+MAX_LINES = 5000
+
+
+@timed("aggregate")
+def od_flows(trips, stations=None):
+    # One row per (time window, origin, destination), windows taken from the
+    # departure hour. Rows are sorted by window, then by trip_count descending,
+    # so the top k flows of a window are a prefix of its block.
+    stations, origin, destination = aggregations.station_index(trips, stations)
+    n, k = len(stations), len(aggregations.PERIODS)
+    dep_period, _ = aggregations.trip_periods(trips)
+    pair = aggregations.od_keys(origin, destination, n)
+    window = np.concatenate([np.zeros(len(trips), dtype=np.int64), dep_period.astype(np.int64) + 1])
+    keys, inverse = np.unique(window * n * n + np.concatenate([pair, pair]), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(keys))
+    durations = np.tile(trips["duration_min"].to_numpy(np.float64), 2)
+    sums = np.bincount(inverse, weights=durations, minlength=len(keys))
+    window, pair = np.divmod(keys, n * n)
+    lat = stations["lat"].to_numpy()
+    lon = stations["lon"].to_numpy()
+    flows = pd.DataFrame({
+        "window": pd.Categorical.from_codes(window, WINDOWS),
+        "origin": stations["station"].to_numpy()[pair // n],
+        "destination": stations["station"].to_numpy()[pair % n],
+        "origin_lat": lat[pair // n],
+        "origin_lon": lon[pair // n],
+        "destination_lat": lat[pair % n],
+        "destination_lon": lon[pair % n],
+        "trip_count": counts,
+        "avg_duration_min": sums / counts,
+    })
+    order = np.lexsort((-counts, window))
+    return flows.iloc[order].reset_index(drop=True)
+
+
+@timed("aggregate")
+def select_flows(flows, window=ALL, min_trips=1, limit=MAX_LINES):
+    keep = (flows["window"].to_numpy() == window) & (flows["trip_count"].to_numpy() >= min_trips)
+    return flows.iloc[np.flatnonzero(keep)[:limit]]
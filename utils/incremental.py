@@ -0,0 +1,171 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from utils import aggregations, pipeline
+from utils.trip_store import STORE_DIR, append_batch, open_trip_table, read_part, read_stations, read_trips_csv, trips_to_frame
+
+STATE_PATH = pipeline.CACHE_DIR / "aggregates.npz"
+K = len(aggregations.PERIODS)
+
+
+class AggregateState:
+    # Everything here is a sum or a count, so a batch is folded in without
+    # touching earlier trips. Mean durations are kept as sums and divided on
+    # output. Per-station arrays are indexed by station code.
+
+    def __init__(self, arrays=None):
+        arrays = arrays or {}
+        self.dep = arrays.get("dep", np.zeros(0, dtype=np.int64))
+        self.arr = arrays.get("arr", np.zeros(0, dtype=np.int64))
+        self.dep_period = arrays.get("dep_period", np.zeros((0, K), dtype=np.int64))
+        self.arr_period = arrays.get("arr_period", np.zeros((0, K), dtype=np.int64))
+        self.out_degree = arrays.get("out_degree", np.zeros(0, dtype=np.int64))
+        self.in_degree = arrays.get("in_degree", np.zeros(0, dtype=np.int64))
+        # OD pairs are kept sorted by (origin << 32 | destination).
+        self.od_key = arrays.get("od_key", np.zeros(0, dtype=np.int64))
+        self.od_count = arrays.get("od_count", np.zeros(0, dtype=np.int64))
+        self.od_duration = arrays.get("od_duration", np.zeros(0, dtype=np.float64))
+        # The store's SOURCE and the hashes of the parts absorbed, in order.
+        self.source = str(arrays.get("source", ""))
+        self.parts = list(arrays.get("parts", np.array([], dtype=str)))
+
+    @classmethod
+    def load(cls, path=STATE_PATH):
+        try:
+            with np.load(path) as data:
+                # State saved before station codes was keyed by name; start over.
+                if "station" in data.files:
+                    return cls()
+                return cls({name: data[name] for name in data.files})
+        except (OSError, ValueError):
+            return cls()
+
+    def save(self, path=STATE_PATH):
+        arrays = {name: value for name, value in vars(self).items() if name not in ("source", "parts")}
+        arrays["source"] = np.array(self.source, dtype=str)
+        arrays["parts"] = np.array(self.parts, dtype=str)
+        tmp_path = Path(path).with_suffix(".tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    def _grow(self, n):
+        grow = n - len(self.dep)
+        if grow <= 0:
+            return
+        for name in ("dep", "arr", "out_degree", "in_degree"):
+            setattr(self, name, np.concatenate([getattr(self, name), np.zeros(grow, dtype=np.int64)]))
+        for name in ("dep_period", "arr_period"):
+            setattr(self, name, np.vstack([getattr(self, name), np.zeros((grow, K), dtype=np.int64)]))
+
+    def absorb(self, trips):
+        if len(trips) == 0:
+            return
+        origin = trips["origin_code"].to_numpy()
+        destination = trips["destination_code"].to_numpy()
+        self._grow(int(max(origin.max(), destination.max())) + 1)
+        dep_period, arr_period = aggregations.trip_periods(trips)
+        np.add.at(self.dep, origin, 1)
+        np.add.at(self.arr, destination, 1)
+        np.add.at(self.dep_period, (origin, dep_period), 1)
+        np.add.at(self.arr_period, (destination, arr_period), 1)
+
+        keys, inverse = np.unique((origin.astype(np.int64) << 32) | destination, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(keys))
+        durations = np.bincount(inverse, weights=trips["duration_min"].to_numpy(np.float64), minlength=len(keys))
+        pos = np.searchsorted(self.od_key, keys)
+        known = pos < len(self.od_key)
+        known[known] = self.od_key[pos[known]] == keys[known]
+        self.od_count[pos[known]] += counts[known]
+        self.od_duration[pos[known]] += durations[known]
+
+        fresh = ~known
+        np.add.at(self.out_degree, keys[fresh] >> 32, 1)
+        np.add.at(self.in_degree, keys[fresh] & 0xFFFFFFFF, 1)
+        self.od_key = np.insert(self.od_key, pos[fresh], keys[fresh])
+        self.od_count = np.insert(self.od_count, pos[fresh], counts[fresh])
+        self.od_duration = np.insert(self.od_duration, pos[fresh], durations[fresh])
+
+    def frames(self, stations):
+        # Only stations that occur in some trip, like aggregations.station_index.
+        used = np.flatnonzero(self.dep + self.arr > 0)
+        table = stations.iloc[used][["station", "lat", "lon"]].reset_index(drop=True)
+        return {
+            "balance": aggregations.balance_frame(table, self.dep[used], self.arr[used]),
+            "time_of_day": aggregations.time_of_day_frame(table, self.dep_period[used], self.arr_period[used]),
+            "network": aggregations.network_frame(
+                table, self.dep[used], self.arr[used], self.out_degree[used], self.in_degree[used]
+            ),
+            "od_pairs": aggregations.od_frame(
+                stations, self.od_key >> 32, self.od_key & 0xFFFFFFFF,
+                self.od_count, self.od_duration / self.od_count,
+            ),
+        }
+
+
+def refresh(store_dir=STORE_DIR, state_path=STATE_PATH):
+    # Parts after the ones the state has absorbed are exactly the batches
+    # appended since the last run; on first use that is the whole store. A store
+    # rebuilt from another CSV, or whose parts no longer match, starts over.
+    open_trip_table(store_dir=store_dir)
+    marker = Path(store_dir) / "SOURCE"
+    source = marker.read_text() if marker.exists() else ""
+    manifest = pipeline.load_manifest()
+    hashes = pipeline.part_hashes(manifest, store_dir)
+    pipeline.save_manifest(manifest)
+    state = AggregateState.load(state_path)
+    if state.source != source or hashes[:len(state.parts)] != state.parts:
+        state = AggregateState()
+        state.source = source
+    parts = sorted(Path(store_dir).glob("part-*.arrow"))
+    for path, part_hash in zip(parts[len(state.parts):], hashes[len(state.parts):]):
+        state.absorb(trips_to_frame(read_part(path)))
+        state.parts.append(part_hash)
+    state.save(state_path)
+    return state
+
+
+def publish(state, store_dir=STORE_DIR):
+    frames = state.frames(read_stations(store_dir))
+    pipeline.write_csv(frames["balance"], pipeline.BALANCE_CSV)
+    pipeline.write_csv(frames["time_of_day"], pipeline.TIME_OF_DAY_CSV)
+    pipeline.write_csv(frames["network"], pipeline.NETWORK_CSV)
+    pipeline.write_od_pairs(frames["od_pairs"])
+    pipeline.write_trajectories(frames["od_pairs"])
+    manifest = pipeline.load_manifest()
+    pipeline.mark_current(manifest, pipeline.store_key(manifest, store_dir))
+    pipeline.save_manifest(manifest)
+
+
+def append_trips(batch, store_dir=STORE_DIR, state_path=STATE_PATH):
+    if isinstance(batch, pd.DataFrame):
+        batch = pa.Table.from_pandas(batch, preserve_index=False)
+    append_batch(batch, store_dir)
+    state = refresh(store_dir, state_path)
+    publish(state, store_dir)
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Append trip batches to the trip store and update the derived datasets in place."
+    )
+    parser.add_argument("batches", nargs="*", type=Path, help="CSV files in the bike_journeys_noOutliers.csv layout.")
+    parser.add_argument("--store", type=Path, default=STORE_DIR)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    for path in args.batches:
+        append_batch(read_trips_csv(path), args.store)
+    state = refresh(args.store)
+    publish(state, args.store)
+    print(f"{int(state.dep.sum()):,} trips across {int((state.dep + state.arr > 0).sum())} stations, "
+          f"updated in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
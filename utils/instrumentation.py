@@ -0,0 +1,245 @@
+import argparse
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+
+from utils.trip_store import DATA_DIR
+
+# One JSON line per rerun: page, session, total time and every span. Once the
+# log passes LOG_MAX_BYTES it is moved to timings.jsonl.1 (and older ones up
+# to .LOG_BACKUPS, the oldest dropped), so it never takes more than
+# (LOG_BACKUPS + 1) * LOG_MAX_BYTES.
+LOG_PATH = DATA_DIR / "cache" / "timings.jsonl"
+LOG_MAX_BYTES = 16 << 20
+LOG_BACKUPS = 3
+
+# Spans are collected per script thread; Streamlit runs each session's
+# reruns on its own thread, and cached functions run on the caller's.
+_state = threading.local()
+_log_lock = threading.Lock()
+
+
+class Rerun:
+    def __init__(self, page, session=""):
+        self.page = page
+        self.session = session
+        self.started = time.perf_counter()
+        self.ms = None
+        self.spans = []
+        self.stack = []
+
+    def record(self):
+        return {
+            "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "session": self.session,
+            "page": self.page,
+            "ms": self.ms,
+            "spans": self.spans,
+        }
+
+
+def current():
+    return getattr(_state, "run", None)
+
+
+@contextmanager
+def span(kind, name, **fields):
+    # Times the block as one step of the current rerun and yields its record,
+    # to which the block may add fields (e.g. cache="hit", bytes=...). A no-op
+    # outside a rerun, e.g. in the pipeline CLIs.
+    run = current()
+    if run is None:
+        yield {}
+        return
+    entry = {"kind": kind, "name": name, "depth": len(run.stack), **fields}
+    run.spans.append(entry)
+    run.stack.append(entry)
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry["ms"] = round((time.perf_counter() - start) * 1000, 3)
+        run.stack.pop()
+
+
+def timed(kind):
+    # Decorator form of span, named <module>.<function>.
+    def wrap(fn):
+        name = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            if current() is None:
+                return fn(*args, **kwargs)
+            with span(kind, name):
+                return fn(*args, **kwargs)
+
+        return call
+
+    return wrap
+
+
+def loader(cache):
+    # Wraps st.cache_data / st.cache_resource so that each call is a "loader"
+    # span marked as a cache hit or miss: the body only runs on a miss.
+    def wrap(fn):
+        @functools.wraps(fn)
+        def body(*args, **kwargs):
+            run = current()
+            if run is not None and run.stack:
+                run.stack[-1]["cache"] = "miss"
+            return fn(*args, **kwargs)
+
+        cached = cache(body)
+        name = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            if current() is None:
+                return cached(*args, **kwargs)
+            with span("loader", name) as entry:
+                result = cached(*args, **kwargs)
+            entry.setdefault("cache", "hit")
+            return result
+
+        call.clear = cached.clear
+        return call
+
+    return wrap
+
+
+def _session_id():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+        # Warm-up threads have no script run; that is not worth a warning.
+        ctx = get_script_run_ctx(suppress_warning=True)
+        return ctx.session_id if ctx is not None else ""
+    except ImportError:
+        return ""
+
+
+def _backup(path, i):
+    return Path(f"{path}.{i}")
+
+
+def _rotate(path):
+    for i in range(LOG_BACKUPS - 1, 0, -1):
+        if _backup(path, i).exists():
+            os.replace(_backup(path, i), _backup(path, i + 1))
+    if LOG_BACKUPS:
+        os.replace(path, _backup(path, 1))
+    else:
+        os.remove(path)
+
+
+def append_log(record, path=LOG_PATH):
+    # Best effort: a read-only deployment just does not keep the log.
+    line = json.dumps(record, default=str) + "\n"
+    try:
+        with _log_lock:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) + len(line) > LOG_MAX_BYTES:
+                _rotate(path)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError:
+        pass
+
+
+@contextmanager
+def rerun(page, log_path=LOG_PATH):
+    # Collects the spans of one script run and appends them to the log.
+    run = Rerun(page, _session_id())
+    _state.run = run
+    try:
+        yield run
+    finally:
+        _state.run = None
+        run.ms = round((time.perf_counter() - run.started) * 1000, 3)
+        if log_path is not None:
+            append_log(run.record(), log_path)
+
+
+def spans_frame(spans):
+    frame = pd.DataFrame(spans, columns=["kind", "name", "depth", "ms", "cache", "bytes"])
+    frame["step"] = [" " * int(depth) + name for depth, name in zip(frame["depth"], frame["name"])]
+    frame["kb"] = frame["bytes"] / 1024
+    return frame[["step", "kind", "ms", "cache", "kb"]]
+
+
+def show_panel(run, container):
+    # The rerun's spans in the order they started, nested steps indented.
+    import streamlit as st
+
+    container.caption(f"{run.page}: {run.ms:,.0f} ms this rerun")
+    if run.spans:
+        number = st.column_config.NumberColumn(format="%.1f")
+        container.dataframe(spans_frame(run.spans), hide_index=True, column_config={"ms": number, "kb": number})
+
+
+def summarize(records):
+    # Per (page, kind, name): calls, cache hit rate and time percentiles.
+    rows = [dict(span, page=r["page"]) for r in records for span in r["spans"]]
+    if not rows:
+        return pd.DataFrame()
+    spans = pd.DataFrame(rows)
+    for column in ("cache", "bytes"):
+        if column not in spans:
+            spans[column] = None
+    spans["hit"] = spans["cache"].map({"hit": 1.0, "miss": 0.0})
+    grouped = spans.groupby(["page", "kind", "name"], sort=True)
+    summary = grouped.agg(
+        calls=("ms", "size"), hit_rate=("hit", "mean"), p50_ms=("ms", "median"),
+        p95_ms=("ms", lambda ms: ms.quantile(0.95)), max_ms=("ms", "max"), mean_kb=("bytes", "mean"),
+    )
+    summary["mean_kb"] /= 1024
+    return summary.reset_index()
+
+
+def read_log(path=LOG_PATH, since=None):
+    # The log and its rotated backups, oldest first.
+    paths = [_backup(path, i) for i in range(LOG_BACKUPS, 0, -1)] + [Path(path)]
+    records = []
+    for path in paths:
+        if not path.exists():
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or record["time"] >= since:
+                    records.append(record)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the dashboard's per-rerun timing log.")
+    parser.add_argument("log", nargs="?", type=Path, default=LOG_PATH)
+    parser.add_argument("--since", help="Only reruns at or after this UTC time, e.g. 2025-05-12T08:00.")
+    parser.add_argument("--page", help="Only this page.")
+    args = parser.parse_args()
+    records = read_log(args.log, args.since)
+    if args.page:
+        records = [r for r in records if r["page"] == args.page]
+    reruns = pd.DataFrame([{"page": r["page"], "ms": r["ms"]} for r in records])
+    if reruns.empty:
+        print("No reruns logged.")
+        return
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(reruns.groupby("page")["ms"].describe(percentiles=[0.5, 0.95])[["count", "50%", "95%", "max"]].round(1))
+        print()
+        print(summarize(records).round(2).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import streamlit as st
+import streamlit_folium
+from streamlit_folium import st_folium
+
+from utils.instrumentation import span
+
+MAX_BYTES = 64 * 1024 * 1024
+MAX_ENTRIES = 64
+
+# Held at import so cache hits never see the recorder swapped in by _serialize.
+_component = streamlit_folium._component_func
+_capture_lock = threading.Lock()
+
+
+class MapCache:
+    # Serialized st_folium payloads keyed by (page, map id, params, data version),
+    # evicted least-recently-used first once the byte or entry budget is exceeded.
+
+    def __init__(self, max_bytes=MAX_BYTES, max_entries=MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, payload, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (payload, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > 1 and (
+                self.nbytes > self.max_bytes or len(self._entries) > self.max_entries
+            ):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@st.cache_resource
+def get_map_cache():
+    return MapCache()
+
+
+def data_version(*paths):
+    parts = []
+    for path in map(Path, paths):
+        if not path.exists():
+            continue
+        files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+        for file in files:
+            stat = file.stat()
+            parts.append(f"{file.name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(parts)
+
+
+def _serialize(folium_map, **kwargs):
+    # Let st_folium do its own rendering once, but record the component
+    # arguments instead of sending them, so they can be replayed on later reruns.
+    captured = {}
+
+    def record(**args):
+        captured.update(args)
+        return args.get("default")
+
+    with _capture_lock:
+        streamlit_folium._component_func = record
+        try:
+            st_folium(folium_map, **kwargs)
+        finally:
+            streamlit_folium._component_func = _component
+    # Relies on st_folium's private component hook (pinned in requirements.txt);
+    # fail loudly rather than cache empty maps if it changes.
+    if "script" not in captured:
+        raise RuntimeError("streamlit_folium.st_folium no longer renders through _component_func")
+    return captured
+
+
+def payload_size(payload):
+    return sum(len(payload.get(field) or "") for field in ("script", "header", "html"))
+
+
+def render_map(page, map_id, build, params=(), version="", **kwargs):
+    cache = get_map_cache()
+    key = (page, map_id, tuple(params), version, tuple(sorted(kwargs.items())))
+    with span("map", f"{page}.{map_id}") as entry:
+        payload = cache.get(key)
+        entry["cache"] = "miss" if payload is None else "hit"
+        if payload is None:
+            with span("map", "build"):
+                folium_map = build()
+            with span("map", "serialize"):
+                payload = _serialize(folium_map, **kwargs)
+            cache.put(key, payload, payload_size(payload))
+        entry["bytes"] = payload_size(payload)
+        with span("map", "send"):
+            return _component(**payload)
@@ -0,0 +1,196 @@
+import json
+
+import numpy as np
+import pandas as pd
+from folium.map import Layer
+from folium.plugins import HeatMapWithTime
+from folium.template import Template
+
+
+def _column(values, n, decimals=None):
+    if np.ndim(values) == 0:
+        return values
+    values = np.asarray(values)
+    if len(values) != n:
+        raise ValueError(f"expected {n} values, got {len(values)}")
+    if decimals is not None:
+        values = values.astype(np.float64).round(decimals)
+    return values.tolist()
+
+
+class StationLayer(Layer):
+    """All stations as one GeoJSON layer assembled in the browser from column arrays.
+
+    Every style argument is either a scalar applied to all stations or an array
+    with one value per station; per-station values end up as feature properties
+    and ``pointToLayer`` reads them from there. Pass a ``folium.Icon`` to draw
+    pins instead of circles; it is created once and shared by every marker.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var columns = {{ this.columns }};
+                var shared = {{ this.shared|tojson }};
+                var renderer = L.canvas({padding: 0.5});
+                var features = new Array(columns.lat.length);
+                for (var i = 0; i < features.length; i++) {
+                    var properties = {};
+                    for (var key in columns) {
+                        properties[key] = columns[key][i];
+                    }
+                    features[i] = {
+                        type: "Feature",
+                        properties: properties,
+                        geometry: {type: "Point", coordinates: [columns.lon[i], columns.lat[i]]}
+                    };
+                }
+                function style(p, key) {
+                    return p[key] !== undefined ? p[key] : shared[key];
+                }
+                {% if this.icon %}
+                var icon = L.AwesomeMarkers.icon({{ this.icon.options|tojavascript }});
+                {% endif %}
+                return L.geoJSON({type: "FeatureCollection", features: features}, {
+                    pointToLayer: function(feature, latlng) {
+                        var p = feature.properties;
+                        {% if this.icon %}
+                        return L.marker(latlng, {icon: icon});
+                        {% else %}
+                        return L.circleMarker(latlng, {
+                            renderer: renderer,
+                            radius: style(p, "radius"),
+                            color: style(p, "color"),
+                            fill: true,
+                            fillColor: style(p, "fill_color") || style(p, "color"),
+                            fillOpacity: style(p, "fill_opacity"),
+                            weight: style(p, "weight")
+                        });
+                        {% endif %}
+                    },
+                    onEachFeature: function(feature, layer) {
+                        var popup = style(feature.properties, "popup");
+                        if (popup) {
+                            layer.bindPopup(popup, {maxWidth: shared.popup_width});
+                        }
+                    }
+                });
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, lat, lon, popup=None, radius=6, color="gray", fill_color=None,
+                 fill_opacity=0.6, weight=3, icon=None, popup_width=250,
+                 name=None, overlay=True, control=True, show=True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "StationLayer"
+        n = len(lat)
+        styles = {
+            "popup": popup, "radius": radius, "color": color, "fill_color": fill_color,
+            "fill_opacity": fill_opacity, "weight": weight,
+        }
+        columns = {"lat": _column(lat, n, 6), "lon": _column(lon, n, 6)}
+        self.shared = {"popup_width": popup_width}
+        for key, value in styles.items():
+            if value is None or np.ndim(value) == 0:
+                self.shared[key] = value
+            else:
+                columns[key] = _column(value, n, 2 if key in ("radius", "fill_opacity", "weight") else None)
+        # Escaped so that "</script>" inside a popup cannot end the inline script.
+        self.columns = json.dumps(columns, separators=(",", ":")).replace("</", "<\\/")
+        self.icon = icon
+        self.n = n
+
+
+class FlowLayer(Layer):
+    """Origin-destination flows as canvas polylines with a fixed line budget.
+
+    Flows must be sorted by importance. After every pan or zoom the layer is
+    redrawn with the first ``visible`` flows that have an end inside the
+    viewport, so the number of lines on screen never exceeds the budget.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var columns = {{ this.columns }};
+                var visible = {{ this.visible }};
+                var map = {{ this._parent.get_name() }};
+                var renderer = L.canvas({padding: 0.5});
+                var group = L.layerGroup();
+                function redraw() {
+                    var bounds = map.getBounds();
+                    group.clearLayers();
+                    for (var i = 0, shown = 0; i < columns.o_lat.length && shown < visible; i++) {
+                        var origin = [columns.o_lat[i], columns.o_lon[i]];
+                        var destination = [columns.d_lat[i], columns.d_lon[i]];
+                        if (!bounds.contains(origin) && !bounds.contains(destination)) {
+                            continue;
+                        }
+                        var line = L.polyline([origin, destination], {
+                            renderer: renderer,
+                            color: columns.color[i],
+                            weight: columns.weight[i],
+                            opacity: {{ this.opacity }}
+                        });
+                        if (columns.tooltip) {
+                            line.bindTooltip(columns.tooltip[i], {sticky: true});
+                        }
+                        group.addLayer(line);
+                        shown++;
+                    }
+                }
+                map.on("moveend", redraw);
+                map.whenReady(redraw);
+                return group;
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, o_lat, o_lon, d_lat, d_lon, color, weight, tooltip=None, visible=500,
+                 opacity=0.7, name=None, overlay=True, control=True, show=True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "FlowLayer"
+        n = len(o_lat)
+        columns = {
+            "o_lat": _column(o_lat, n, 6), "o_lon": _column(o_lon, n, 6),
+            "d_lat": _column(d_lat, n, 6), "d_lon": _column(d_lon, n, 6),
+            "color": _column(np.broadcast_to(color, n), n),
+            "weight": _column(np.broadcast_to(weight, n), n, 2),
+        }
+        if tooltip is not None:
+            columns["tooltip"] = _column(tooltip, n)
+        self.columns = json.dumps(columns, separators=(",", ":")).replace("</", "<\\/")
+        self.visible = int(visible)
+        self.opacity = opacity
+        self.n = n
+
+
+class FramedHeatMap(HeatMapWithTime):
+    # HeatMapWithTime computes its bounds as if `data` were a flat list of
+    # points, which breaks st_folium; take them over the points of every frame.
+
+    def _get_self_bounds(self):
+        points = np.array([point[:2] for frame in self.data for point in frame], dtype=np.float64)
+        if len(points) == 0:
+            return [[None, None], [None, None]]
+        return [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+
+
+def station_popups(template, df):
+    # Builds one HTML popup string per row with vectorized string ops,
+    # e.g. station_popups("<b>{station}</b><br>Trips: {trips}", df).
+    parts = template.replace("}", "{").split("{")
+    text = pd.Series("", index=df.index, dtype=object)
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            text = text + part
+        else:
+            field, _, spec = part.partition(":")
+            column = df[field]
+            text = text + (column.map(("{:" + spec + "}").format) if spec else column.astype(str))
+    return text.to_numpy()
@@ -0,0 +1,170 @@
+import os
+from dataclasses import dataclass
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.stats import t as student_t
+
+from utils import aggregations
+from utils.instrumentation import timed
+from utils.workers import process_pool
+
+# Sources handed to one worker at a time.
+CHUNK_SOURCES = 32
+# Below this many source x edge visits a process pool costs more than it saves.
+PARALLEL_WORK = 2 ** 24
+# Slack for "d(u) + length == d(v)" with fractional lengths; integer lengths
+# (trip counts) add up exactly in float64 and are compared exactly.
+TIE_TOLERANCE = 1e-9
+
+
+@dataclass(frozen=True)
+class Betweenness:
+    value: np.ndarray
+    lower: np.ndarray
+    upper: np.ndarray
+    pivots: int
+
+
+def od_adjacency(origin, destination, n, weights=None):
+    # Weighted directed adjacency, entry (o, d) = number of trips (or summed
+    # weights) from station o to station d. Duplicate pairs are summed by scipy.
+    values = np.ones(len(origin)) if weights is None else np.asarray(weights, dtype=np.float64)
+    return sparse.csr_matrix((values, (origin, destination)), shape=(n, n))
+
+
+def pagerank(adjacency, damping=0.85, tol=1e-6, max_iter=100):
+    # Power iteration on the weighted graph; rank of dangling stations is
+    # spread uniformly, as in networkx.pagerank.
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    strength = np.asarray(adjacency.sum(axis=1)).ravel()
+    scale = np.divide(1.0, strength, out=np.zeros_like(strength), where=strength > 0)
+    transition_t = (sparse.diags(scale) @ adjacency).T.tocsr()
+    dangling = strength == 0
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        previous = rank
+        rank = damping * (transition_t @ rank + previous[dangling].sum() / n) + (1 - damping) / n
+        if np.abs(rank - previous).sum() < n * tol:
+            break
+    return rank
+
+
+def _dependencies(adjacency, sources):
+    # Brandes' dependency accumulation for each source, on edge lengths taken
+    # from the adjacency values (trip counts, as the notebook's
+    # betweenness_centrality(weight="weight") did). With positive lengths no
+    # shortest-path edge joins two nodes at the same distance, so each distance
+    # level is settled in one vectorised step.
+    coo = adjacency.tocoo()
+    keep = coo.row != coo.col
+    tail, head, length = coo.row[keep], coo.col[keep], coo.data[keep]
+    n = adjacency.shape[0]
+    tolerance = 0.0 if np.array_equal(length, np.round(length)) else TIE_TOLERANCE
+    distances = dijkstra(adjacency, directed=True, indices=sources)
+    deltas = np.zeros((len(sources), n))
+    for i, source in enumerate(sources):
+        d = distances[i]
+        with np.errstate(invalid="ignore"):  # unreachable tails give inf - inf
+            on_path = np.isfinite(d[tail]) & (np.abs(d[tail] + length - d[head]) <= tolerance)
+        u, v = tail[on_path], head[on_path]
+        order = np.argsort(d[v], kind="stable")
+        u, v = u[order], v[order]
+        levels = np.flatnonzero(np.diff(d[v], prepend=-np.inf) > 0)
+        bounds = list(zip(levels, np.append(levels[1:], len(v))))
+        sigma = np.zeros(n)
+        sigma[source] = 1.0
+        for lo, hi in bounds:
+            np.add.at(sigma, v[lo:hi], sigma[u[lo:hi]])
+        delta = deltas[i]
+        for lo, hi in reversed(bounds):
+            uu, vv = u[lo:hi], v[lo:hi]
+            np.add.at(delta, uu, sigma[uu] / sigma[vv] * (1.0 + delta[vv]))
+        delta[source] = 0.0
+    return deltas
+
+
+def _dependency_moments(adjacency, sources):
+    deltas = _dependencies(adjacency, sources)
+    return deltas.sum(axis=0), (deltas ** 2).sum(axis=0)
+
+
+@timed("aggregate")
+def betweenness(adjacency, pivots=None, seed=0, confidence=0.95, workers=None):
+    # Normalised directed betweenness, exact when pivots is None or >= n.
+    # Otherwise Brandes-Pich sampling: dependencies from `pivots` random
+    # sources scaled by n / pivots, with a Student t confidence interval that
+    # includes the finite-population correction for sampling without
+    # replacement. Dependencies are heavy-tailed, so the interval is optimistic
+    # for small samples: on the Vienna network a 95% interval covered ~77% of
+    # exact values at 64 pivots and ~84% at 128.
+    n = adjacency.shape[0]
+    if n < 3:
+        zeros = np.zeros(n)
+        return Betweenness(zeros, zeros, zeros, n)
+    k = n if pivots is None else int(min(max(pivots, 1), n))
+    sources = np.arange(n) if k == n else np.sort(np.random.default_rng(seed).choice(n, k, replace=False))
+    chunks = [sources[i:i + CHUNK_SOURCES] for i in range(0, k, CHUNK_SOURCES)]
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(chunks) > 1 and k * adjacency.nnz >= PARALLEL_WORK:
+        moments = list(process_pool(workers).map(_dependency_moments, [adjacency] * len(chunks), chunks))
+    else:
+        moments = [_dependency_moments(adjacency, chunk) for chunk in chunks]
+    total = sum(m[0] for m in moments)
+    squares = sum(m[1] for m in moments)
+    scale = 1.0 / ((n - 1) * (n - 2))
+    value = total * n / k * scale
+    if k == n:
+        return Betweenness(value, value, value, k)
+    mean = total / k
+    variance = np.maximum(squares / k - mean ** 2, 0) * k / max(k - 1, 1)
+    error = n * np.sqrt(variance / k * (n - k) / (n - 1)) * scale
+    q = student_t.ppf(0.5 + confidence / 2, k - 1)
+    return Betweenness(value, np.maximum(value - q * error, 0), value + q * error, k)
+
+
+def network_metrics(adjacency):
+    binary = adjacency.astype(bool).astype(np.int64)
+    return {
+        "out_degree": np.asarray(binary.sum(axis=1)).ravel(),
+        "in_degree": np.asarray(binary.sum(axis=0)).ravel(),
+        "out_strength": np.asarray(adjacency.sum(axis=1)).ravel().astype(np.int64),
+        "in_strength": np.asarray(adjacency.sum(axis=0)).ravel().astype(np.int64),
+        "pagerank": pagerank(adjacency),
+    }
+
+
+def trip_network(trips, stations=None):
+    # Station table plus adjacency for a (possibly filtered) set of trips.
+    stations, origin, destination = aggregations.station_index(trips, stations)
+    return stations, od_adjacency(origin, destination, len(stations))
+
+
+@timed("aggregate")
+def network_table(trips, stations=None):
+    # The network_extended.csv columns for any subset of trips, plus PageRank.
+    # trips_started/ended are the out/in strengths of the adjacency.
+    stations, adjacency = trip_network(trips, stations)
+    metrics = network_metrics(adjacency)
+    frame = aggregations.network_frame(
+        stations, metrics["out_strength"], metrics["in_strength"], metrics["out_degree"], metrics["in_degree"]
+    )
+    frame["pagerank"] = metrics["pagerank"]
+    return frame
+
+
+@timed("aggregate")
+def filter_trips(trips, start_hour=0, end_hour=24, first_day=None, last_day=None):
+    # Trips departing within [start_hour, end_hour) (wrapping past midnight
+    # when end_hour <= start_hour) and between two inclusive dates.
+    departure = trips["departure_time"]
+    keep = aggregations.hour_mask(departure.dt.hour.to_numpy(), start_hour, end_hour)
+    days = departure.to_numpy("datetime64[ns]").astype("datetime64[D]")
+    if first_day is not None:
+        keep &= days >= np.datetime64(first_day, "D")
+    if last_day is not None:
+        keep &= days <= np.datetime64(last_day, "D")
+    return trips.iloc[np.flatnonzero(keep)]
@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.reconstruction import read_snapshot_feed, snapshot_files, snapshot_time
+from utils.stations import FREE_BIKE_PREFIX
+from utils.trip_store import DATA_DIR
+
+OCCUPANCY_DIR = DATA_DIR / "cache" / "occupancy"
+FIELDS = ("bikes", "free_racks")
+# Polls per segment, about a day at 30 s. Every segment starts with the full
+# state, so a lookup never reads further back than its segment.
+SEGMENT_POLLS = 2880
+# Value of every field while a station is missing from the feed.
+ABSENT = -1
+
+# Raw little-endian columns, appended in place and memory-mapped for reads.
+# A change is one (station << 32 | poll) key plus one int16 per field; keys
+# are sorted station-major within each segment.
+KEY_FILE = "key.bin"
+VALUE_FILE = "value.bin"
+POLL_FILE = "poll_time.bin"
+SEGMENT_FILE = "segments.bin"
+STATION_FILE = "stations.npy"
+SEGMENT_DTYPE = np.dtype([("first_poll", "<i8"), ("end_poll", "<i8"), ("first_change", "<i8"), ("end_change", "<i8")])
+
+
+def station_counts(feed, fields=FIELDS):
+    # (station uids, (stations, fields) int16 values) from one live feed
+    # response. Places without a value for a field count as 0.
+    uids, values = [], []
+    for country in feed.get("countries", ()):
+        for city in country.get("cities", ()):
+            for place in city.get("places", ()):
+                if place.get("bike") or str(place.get("name", "")).strip().startswith(FREE_BIKE_PREFIX):
+                    continue
+                uids.append(int(place["uid"]))
+                values.append([int(place.get(name) or 0) for name in fields])
+    return np.array(uids, dtype=np.int64), np.array(values, dtype=np.int16).reshape(len(uids), len(fields))
+
+
+def _read(path, dtype, shape=None):
+    # Memory-mapped view of a raw column; empty files cannot be mapped.
+    count = Path(path).stat().st_size // np.dtype(dtype).itemsize if Path(path).exists() else 0
+    if count == 0:
+        return np.zeros((0,) + tuple(shape or ()), dtype=dtype)
+    data = np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+    return data if shape is None else data.reshape((-1,) + tuple(shape))
+
+
+class OccupancyStore:
+    # Read side: per-station values at any time and change history of one
+    # station, from sealed segments only.
+
+    def __init__(self, path=OCCUPANCY_DIR):
+        self.path = Path(path)
+        meta = json.loads((self.path / "meta.json").read_text())
+        self.fields = tuple(meta["fields"])
+        segments = _read(self.path / SEGMENT_FILE, SEGMENT_DTYPE)
+        self.segments = np.array(segments)
+        polls = int(self.segments["end_poll"][-1]) if len(segments) else 0
+        changes = int(self.segments["end_change"][-1]) if len(segments) else 0
+        self.poll_time = _read(self.path / POLL_FILE, "<i8")[:polls].view("datetime64[ns]")
+        self.key = _read(self.path / KEY_FILE, "<i8")[:changes]
+        self.value = _read(self.path / VALUE_FILE, "<i2", (len(self.fields),))[:changes]
+        self.stations = np.load(self.path / STATION_FILE) if (self.path / STATION_FILE).exists() else np.zeros(0, np.int64)
+        self._order = np.argsort(self.stations)
+
+    def __len__(self):
+        return len(self.poll_time)
+
+    def nbytes(self):
+        return sum(f.stat().st_size for f in self.path.iterdir() if f.is_file())
+
+    def station_index(self, uid):
+        if len(self.stations) == 0:
+            raise KeyError(uid)
+        pos = self._order[min(int(np.searchsorted(self.stations[self._order], uid)), len(self._order) - 1)]
+        if self.stations[pos] != uid:
+            raise KeyError(uid)
+        return int(pos)
+
+    def _poll(self, when):
+        return int(np.searchsorted(self.poll_time, np.datetime64(when, "ns"), "right")) - 1
+
+    def _segment(self, poll):
+        return int(np.searchsorted(self.segments["first_poll"], poll, "right")) - 1
+
+    def state_at(self, when):
+        # One row per station with the values of the last poll at or before
+        # `when`; stations first seen later are ABSENT.
+        poll = self._poll(when)
+        values = np.full((len(self.stations), len(self.fields)), ABSENT, dtype=np.int16)
+        if poll >= 0:
+            segment = self.segments[self._segment(poll)]
+            lo, hi = int(segment["first_change"]), int(segment["end_change"])
+            keys = self.key[lo:hi]
+            station = np.arange(len(self.stations), dtype=np.int64)
+            last = np.searchsorted(keys, (station << 32) | poll, "right") - 1
+            found = last >= 0
+            found[found] = (keys[last[found]] >> 32) == station[found]
+            values[found] = self.value[lo + last[found]]
+        frame = pd.DataFrame(values, columns=list(self.fields))
+        frame.insert(0, "station_id", self.stations)
+        return frame
+
+    def segment_values(self, i):
+        # (poll times, (polls, stations, fields) values) of segment i, with
+        # every station's value carried forward to each poll.
+        segment = self.segments[i]
+        first, end = int(segment["first_poll"]), int(segment["end_poll"])
+        lo, hi = int(segment["first_change"]), int(segment["end_change"])
+        keys = np.asarray(self.key[lo:hi])
+        rows = (keys & 0xFFFFFFFF) - first
+        cols = keys >> 32
+        values = np.full((end - first, len(self.stations), len(self.fields)), ABSENT, dtype=np.int16)
+        values[rows, cols] = self.value[lo:hi]
+        source = np.zeros((end - first, len(self.stations)), dtype=np.int64)
+        source[rows, cols] = rows
+        np.maximum.accumulate(source, axis=0, out=source)
+        return self.poll_time[first:end], values[source, np.arange(len(self.stations))]
+
+    def changes(self, uid, start=None, end=None):
+        # Values of one station from `start` to `end` (inclusive), one row per
+        # poll where they changed plus a first row with the value at `start`.
+        station = np.int64(self.station_index(uid))
+        first = max(self._poll(start), 0) if start is not None else 0
+        last = self._poll(end) if end is not None else len(self) - 1
+        polls, values = [], []
+        for i in range(max(self._segment(first), 0), self._segment(last) + 1):
+            segment = self.segments[i]
+            lo, hi = int(segment["first_change"]), int(segment["end_change"])
+            keys = self.key[lo:hi]
+            begin = np.searchsorted(keys, (station << 32) | max(first, int(segment["first_poll"])), "right") - 1
+            begin = max(begin, int(np.searchsorted(keys, station << 32)))
+            stop = np.searchsorted(keys, (station << 32) | last, "right")
+            polls.append(keys[begin:stop] & 0xFFFFFFFF)
+            values.append(self.value[lo + begin:lo + stop])
+        polls = np.concatenate(polls) if polls else np.zeros(0, np.int64)
+        values = np.concatenate(values) if values else np.zeros((0, len(self.fields)), np.int16)
+        if len(polls) == 0 or polls[0] > first:
+            # The station was not known yet at `start`.
+            polls = np.concatenate([[first], polls])
+            values = np.vstack([np.full((1, len(self.fields)), ABSENT, dtype=np.int16), values])
+        # Each segment restates every station at its first poll; keep real changes only.
+        keep = np.ones(len(polls), dtype=bool)
+        keep[1:] = (values[1:] != values[:-1]).any(axis=1)
+        polls = np.maximum(polls[keep], first)
+        frame = pd.DataFrame(values[keep], columns=list(self.fields))
+        frame.insert(0, "time", self.poll_time[polls])
+        return frame
+
+
+class OccupancyWriter:
+    # Write side. Polls are buffered until a segment is full (or the writer
+    # is closed), then the segment's changes are sorted station-major and
+    # appended. The segment record is written last, so a crash mid-seal leaves
+    # bytes past the recorded end, which the next writer cuts off.
+
+    def __init__(self, path=OCCUPANCY_DIR, fields=FIELDS, segment_polls=SEGMENT_POLLS):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            fields = tuple(json.loads(meta_path.read_text())["fields"])
+        else:
+            meta_path.write_text(json.dumps({"fields": list(fields)}))
+        self.fields = fields
+        self.segment_polls = segment_polls
+        store = OccupancyStore(self.path)
+        self._truncate(store)
+        self.stations = list(store.stations)
+        self._index = {int(uid): i for i, uid in enumerate(self.stations)}
+        self.polls = len(store)
+        self.changes = len(store.key)
+        self.last_time = store.poll_time[-1] if len(store) else None
+        self.state = store.state_at(self.last_time)[list(fields)].to_numpy() if len(store) else np.zeros((0, len(fields)), np.int16)
+        self._reset()
+
+    def _truncate(self, store):
+        for name, size in ((KEY_FILE, len(store.key) * 8), (VALUE_FILE, store.value.nbytes),
+                           (POLL_FILE, len(store) * 8), (SEGMENT_FILE, store.segments.nbytes)):
+            path = self.path / name
+            if path.exists() and path.stat().st_size > size:
+                os.truncate(path, size)
+
+    def _reset(self):
+        self._first_poll = self.polls
+        self._times, self._keys, self._values = [], [], []
+
+    def append(self, when, uids, values):
+        # One poll: station uids and their (stations, fields) values. Stations
+        # missing from the poll become ABSENT.
+        when = np.datetime64(when, "ns")
+        if self.last_time is not None and when <= self.last_time:
+            return False
+        codes = np.array([self._index.setdefault(int(uid), len(self._index)) for uid in uids], dtype=np.int64)
+        if len(self._index) > len(self.stations):
+            self.stations.extend(np.array(list(self._index), dtype=np.int64)[len(self.stations):])
+            grow = np.full((len(self.stations) - len(self.state), len(self.fields)), ABSENT, dtype=np.int16)
+            self.state = np.vstack([self.state, grow])
+        current = np.full_like(self.state, ABSENT)
+        current[codes] = values
+        if self.polls == self._first_poll:
+            changed = np.arange(len(current))
+        else:
+            changed = np.flatnonzero((current != self.state).any(axis=1))
+        self._keys.append((changed.astype(np.int64) << 32) | self.polls)
+        self._values.append(current[changed])
+        self._times.append(when)
+        self.state = current
+        self.polls += 1
+        self.last_time = when
+        if self.polls - self._first_poll >= self.segment_polls:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self._times:
+            return
+        keys = np.concatenate(self._keys)
+        values = np.concatenate(self._values)
+        order = np.argsort(keys, kind="stable")
+        tmp_path = self.path / (STATION_FILE + ".tmp.npy")
+        np.save(tmp_path, np.array(self.stations, dtype=np.int64))
+        os.replace(tmp_path, self.path / STATION_FILE)
+        with open(self.path / KEY_FILE, "ab") as f:
+            f.write(keys[order].astype("<i8").tobytes())
+        with open(self.path / VALUE_FILE, "ab") as f:
+            f.write(values[order].astype("<i2").tobytes())
+        with open(self.path / POLL_FILE, "ab") as f:
+            f.write(np.array(self._times, dtype="datetime64[ns]").view("<i8").tobytes())
+        segment = np.array([(self._first_poll, self.polls, self.changes, self.changes + len(keys))], dtype=SEGMENT_DTYPE)
+        with open(self.path / SEGMENT_FILE, "ab") as f:
+            f.write(segment.tobytes())
+        self.changes += len(keys)
+        self._reset()
+
+    def close(self):
+        self.flush()
+
+
+def ingest_snapshots(paths, out_dir=OCCUPANCY_DIR, segment_polls=SEGMENT_POLLS):
+    # Adds snapshot files newer than the store's last poll and rolls up the
+    # segments sealed since the last ingest. Returns the number of polls added.
+    from utils.rollups import update_rollups  # utils.rollups reads this module's store
+
+    writer = OccupancyWriter(out_dir, segment_polls=segment_polls)
+    added = 0
+    try:
+        for path in paths:
+            when = snapshot_time(path)
+            if writer.last_time is not None and when <= writer.last_time:
+                continue
+            added += writer.append(when, *station_counts(read_snapshot_feed(path), writer.fields))
+    finally:
+        writer.close()
+    update_rollups(out_dir)
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold Nextbike snapshots into the station occupancy store.")
+    parser.add_argument("snapshots", type=Path, help="Directory of <YYYYmmddTHHMMSSZ>.json.gz snapshots for one city.")
+    parser.add_argument("--out", type=Path, default=OCCUPANCY_DIR)
+    parser.add_argument("--segment-polls", type=int, default=SEGMENT_POLLS)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    added = ingest_snapshots(snapshot_files(args.snapshots), args.out, args.segment_polls)
+    store = OccupancyStore(args.out)
+    print(f"{added:,} polls added, {len(store):,} polls of {len(store.stations)} stations "
+          f"in {store.nbytes() / 1e6:.1f} MB, {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import argparse
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+from utils.reconstruction import write_trips_csv
+from utils.trip_store import iter_trips_csv
+
+EARTH_RADIUS_KM = 6371.0088
+RULES = ("missing_coordinates", "duration", "speed", "round_trip", "duplicate", "shared_times")
+
+
+@dataclass(frozen=True)
+class OutlierRules:
+    # Thresholds of the filter; None switches a rule off.
+    min_duration_min: float = 2.0
+    max_duration_min: float = 120.0
+    # Straight-line speed between the stations; snapshot-quantised durations
+    # make short trips look fast, so this is generous.
+    max_speed_kmh: float = 30.0
+    drop_round_trips: bool = True
+    # The same bike with the same departure and arrival more than once.
+    drop_duplicates: bool = True
+    # Bikes leaving one station in the same snapshot and docking in the same
+    # later snapshot; more than this many at once are taken as a rebalancing
+    # van or a feed glitch, not rides.
+    max_shared_times: int = 5
+
+
+@dataclass
+class FilterReport:
+    rows: int = 0
+    kept: int = 0
+    # Rows flagged by each rule; a row can be flagged by several.
+    flagged: dict = field(default_factory=lambda: dict.fromkeys(RULES, 0))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(h))
+
+
+def _column(table, name, dtype=None):
+    return table.column(name).to_numpy(zero_copy_only=False) if dtype is None else \
+        table.column(name).cast(dtype).to_numpy(zero_copy_only=False)
+
+
+def _group_sizes(*keys):
+    # Size of each row's group of equal keys, and whether it is the group's first row.
+    order = np.lexsort(keys[::-1])
+    starts = np.ones(len(order), dtype=bool)
+    for key in keys:
+        ordered = key[order]
+        starts[1:] &= ordered[1:] == ordered[:-1]
+    starts = ~starts
+    starts[0] = True
+    bounds = np.flatnonzero(starts)
+    counts = np.diff(np.append(bounds, len(order)))
+    sizes = np.empty(len(order), dtype=np.int64)
+    sizes[order] = np.repeat(counts, counts)
+    is_first = np.zeros(len(order), dtype=bool)
+    is_first[order[bounds]] = True
+    return sizes, is_first
+
+
+def flag_trips(table, rules=OutlierRules()):
+    # {rule: bool mask} for a table in the trip CSV layout. Group rules only
+    # see the rows of this table, so callers hand over whole groups.
+    departure = _column(table, "departure_time", pa.int64())
+    arrival = _column(table, "arrival_time", pa.int64())
+    duration = (arrival - departure) / 6e10
+    coords = [_column(table, name, pa.float64()) for name in ("origin_lat", "origin_lon", "destination_lat", "destination_lon")]
+    missing = np.isnan(coords).any(axis=0)
+    flags = {rule: np.zeros(table.num_rows, dtype=bool) for rule in RULES}
+    flags["missing_coordinates"] = missing
+    if rules.min_duration_min is not None:
+        flags["duration"] |= duration < rules.min_duration_min
+    if rules.max_duration_min is not None:
+        flags["duration"] |= duration > rules.max_duration_min
+    if rules.max_speed_kmh is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speed = haversine_km(*coords) / (duration / 60)
+        flags["speed"] = ~missing & (speed > rules.max_speed_kmh)
+    if rules.drop_round_trips:
+        flags["round_trip"] = _column(table, "origin_station_id") == _column(table, "destination_station_id")
+    if table.num_rows and (rules.drop_duplicates or rules.max_shared_times is not None):
+        if rules.drop_duplicates:
+            _, first = _group_sizes(_column(table, "bike_number", pa.int64()), departure, arrival)
+            flags["duplicate"] = ~first
+        if rules.max_shared_times is not None:
+            shared, _ = _group_sizes(departure, arrival, _column(table, "origin_station_id", pa.int64()))
+            flags["shared_times"] = shared > rules.max_shared_times
+    return flags
+
+
+def filter_trips(tables, rules=OutlierRules(), order_by="departure_time", report=None):
+    # Streams trip tables (sorted by `order_by`) through the rules and yields
+    # the kept rows. Rows tied with the last `order_by` value of a chunk are
+    # held back for the next one, so every group rule sees whole groups: both
+    # group keys contain the departure and arrival time. Memory is one chunk
+    # plus those ties.
+    report = report if report is not None else FilterReport()
+    carry, last_key = None, None
+    for table in tables:
+        if carry is not None:
+            table = pa.concat_tables([carry, table])
+        keys = _column(table, order_by, pa.int64())
+        if len(keys) and ((np.diff(keys) < 0).any() or (last_key is not None and keys[0] < last_key)):
+            raise ValueError(f"trips must be sorted by {order_by}")
+        done = int(np.searchsorted(keys, keys[-1])) if len(keys) else 0
+        carry = table.slice(done)
+        if done:
+            last_key = keys[done - 1]
+            yield _apply(table.slice(0, done), rules, report)
+    if carry is not None and carry.num_rows:
+        yield _apply(carry, rules, report)
+
+
+def _apply(table, rules, report):
+    flags = flag_trips(table, rules)
+    drop = np.zeros(table.num_rows, dtype=bool)
+    for rule, mask in flags.items():
+        report.flagged[rule] += int(mask.sum())
+        drop |= mask
+    report.rows += table.num_rows
+    report.kept += int((~drop).sum())
+    return table.filter(pa.array(~drop))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter implausible trips out of a raw trip CSV, in chunks.")
+    parser.add_argument("raw", type=Path, help="Raw trips in the bike_journeys CSV layout, sorted by --order-by.")
+    parser.add_argument("--out", type=Path, required=True)
+    parser.add_argument("--report", type=Path, help="Write the per-rule counts here as JSON.")
+    parser.add_argument("--order-by", default="departure_time", choices=["departure_time", "arrival_time"])
+    parser.add_argument("--block-mb", type=int, default=64)
+    defaults = OutlierRules()
+    parser.add_argument("--min-duration", type=float, default=defaults.min_duration_min)
+    parser.add_argument("--max-duration", type=float, default=defaults.max_duration_min)
+    parser.add_argument("--max-speed", type=float, default=defaults.max_speed_kmh)
+    parser.add_argument("--max-shared", type=int, default=defaults.max_shared_times)
+    parser.add_argument("--keep-round-trips", action="store_true")
+    parser.add_argument("--keep-duplicates", action="store_true")
+    args = parser.parse_args()
+    rules = OutlierRules(args.min_duration, args.max_duration, args.max_speed,
+                         not args.keep_round_trips, not args.keep_duplicates, args.max_shared)
+    start = time.perf_counter()
+    report = FilterReport()
+    tables = filter_trips(iter_trips_csv(args.raw, args.block_mb << 20), rules, args.order_by, report)
+    write_trips_csv(tables, args.out)
+    summary = {"rules": asdict(rules), **asdict(report), "seconds": round(time.perf_counter() - start, 2)}
+    if args.report:
+        args.report.write_text(json.dumps(summary, indent=2))
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
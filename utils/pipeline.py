@@ -0,0 +1,238 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+import pyarrow.feather as feather
+
+from utils import aggregations
+from utils.trip_store import DATA_DIR, STORE_DIR, open_trip_table, read_stations, trips_to_frame
+
+CACHE_DIR = DATA_DIR / "cache"
+MANIFEST = CACHE_DIR / "pipeline.json"
+
+BALANCE_CSV = DATA_DIR / "station_dep_vs_arr (1).csv"
+TIME_OF_DAY_CSV = DATA_DIR / "station_arr_dep_time (1).csv"
+NETWORK_CSV = DATA_DIR / "network_extended.csv"
+OD_PAIRS = CACHE_DIR / "od_pairs.arrow"
+TRAJECTORIES_GEOJSON = DATA_DIR / "agg_dur_traj (1).geojson"
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    deps: tuple
+    outputs: tuple
+    build: object
+    # Bump when the stage logic changes so memoized outputs are rebuilt.
+    version: int = 1
+
+
+class Context:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._lock = threading.Lock()
+        self._trips = None
+        self._stations = None
+
+    def trips(self):
+        with self._lock:
+            if self._trips is None:
+                self._trips = trips_to_frame(open_trip_table(store_dir=self.store_dir))
+                self._stations = read_stations(self.store_dir)
+            return self._trips
+
+    def stations(self):
+        self.trips()
+        return self._stations
+
+
+def _replace_atomic(path, write):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_csv(df, path):
+    _replace_atomic(path, lambda tmp: df.to_csv(tmp, index=False))
+
+
+def write_od_pairs(od):
+    _replace_atomic(OD_PAIRS, lambda tmp: feather.write_feather(od, tmp, compression="uncompressed"))
+
+
+def write_trajectories(od):
+    geojson = aggregations.od_geojson(od)
+
+    def write(tmp):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(geojson, f)
+
+    _replace_atomic(TRAJECTORIES_GEOJSON, write)
+
+
+def _build_balance(ctx):
+    write_csv(aggregations.station_balance(ctx.trips(), ctx.stations()), BALANCE_CSV)
+
+
+def _build_time_of_day(ctx):
+    write_csv(aggregations.station_time_of_day(ctx.trips(), ctx.stations()), TIME_OF_DAY_CSV)
+
+
+def _build_network(ctx):
+    write_csv(aggregations.network_metrics(ctx.trips(), ctx.stations()), NETWORK_CSV)
+
+
+def _build_od(ctx):
+    write_od_pairs(aggregations.od_aggregates(ctx.trips(), ctx.stations()))
+
+
+def _build_trajectories(ctx):
+    write_trajectories(feather.read_feather(OD_PAIRS))
+
+
+STAGES = {stage.name: stage for stage in [
+    Stage("balance", ("trips",), (BALANCE_CSV,), _build_balance, version=2),
+    Stage("time_of_day", ("trips",), (TIME_OF_DAY_CSV,), _build_time_of_day, version=2),
+    Stage("network", ("trips",), (NETWORK_CSV,), _build_network, version=2),
+    Stage("od_pairs", ("trips",), (OD_PAIRS,), _build_od),
+    Stage("trajectories", ("od_pairs",), (TRAJECTORIES_GEOJSON,), _build_trajectories),
+]}
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def part_hashes(manifest, store_dir=STORE_DIR):
+    # Store parts are immutable once written, so each one is hashed only once.
+    known = manifest.setdefault("parts", {})
+    hashes = []
+    for path in sorted(Path(store_dir).glob("part-*.arrow")):
+        stat = path.stat()
+        fingerprint = f"{stat.st_size}:{stat.st_mtime_ns}"
+        entry = known.get(str(path))
+        if entry is None or entry[0] != fingerprint:
+            entry = known[str(path)] = [fingerprint, hash_file(path)]
+        hashes.append(entry[1])
+    return hashes
+
+
+def store_key(manifest, store_dir=STORE_DIR):
+    digest = hashlib.sha256()
+    for part_hash in part_hashes(manifest, store_dir):
+        digest.update(part_hash.encode())
+    return digest.hexdigest()
+
+
+def stage_key(stage, dep_keys):
+    payload = json.dumps([stage.name, stage.version, [dep_keys[d] for d in stage.deps]])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _closure(targets):
+    selected = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name in STAGES and name not in selected:
+            selected.add(name)
+            stack.extend(STAGES[name].deps)
+    return selected
+
+
+def load_manifest():
+    try:
+        return json.loads(MANIFEST.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    _replace_atomic(MANIFEST, lambda tmp: Path(tmp).write_text(json.dumps(manifest, indent=2)))
+
+
+def mark_current(manifest, trips_key, names=None):
+    keys = {"trips": trips_key}
+    built = manifest.setdefault("stages", {})
+    selected = _closure(names or STAGES)
+    # STAGES is declared in dependency order.
+    for name in (name for name in STAGES if name in selected):
+        keys[name] = stage_key(STAGES[name], keys)
+        built[name] = keys[name]
+
+
+def run_pipeline(targets=None, force=False, jobs=None, store_dir=STORE_DIR, log=print):
+    # Make sure the trip store reflects the CSV before hashing it.
+    open_trip_table(store_dir=store_dir)
+    manifest = load_manifest()
+    built = manifest.setdefault("stages", {})
+    keys = {"trips": store_key(manifest, store_dir)}
+    ctx = Context(store_dir)
+    pending = _closure(targets or STAGES)
+    done = {"trips"}
+    results = {}
+
+    def run(stage):
+        start = time.perf_counter()
+        stage.build(ctx)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        while pending or running:
+            for name in sorted(pending):
+                stage = STAGES[name]
+                if not set(stage.deps) <= done:
+                    continue
+                pending.discard(name)
+                keys[name] = stage_key(stage, keys)
+                fresh = built.get(name) == keys[name] and all(Path(p).exists() for p in stage.outputs)
+                if fresh and not force:
+                    done.add(name)
+                    results[name] = None
+                    log(f"{name}: up to date")
+                else:
+                    running[pool.submit(run, stage)] = name
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                built[name] = keys[name]
+                done.add(name)
+                log(f"{name}: built in {results[name]:.2f}s")
+
+    save_manifest(manifest)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the derived datasets used by the dashboard.")
+    parser.add_argument("stages", nargs="*", help=f"Stages to build (default: all of {', '.join(STAGES)}).")
+    parser.add_argument("--force", action="store_true", help="Ignore memoized outputs.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of stages to run in parallel.")
+    parser.add_argument("--store", type=Path, default=STORE_DIR)
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    start = time.perf_counter()
+    run_pipeline(args.stages, force=args.force, jobs=args.jobs, store_dir=args.store)
+    print(f"Done in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import argparse
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from utils.stations import FREE_BIKE_PREFIX
+from utils.trip_store import CSV_RENAMES, append_batch, appended_batches, conform_table, store_source
+
+# Snapshots are stored as <city>/<YYYYmmddTHHMMSSZ>.json.gz, one Nextbike
+# live feed response per file, named by the UTC time it was fetched.
+SNAPSHOT_GLOB = "*.json.gz"
+SNAPSHOT_TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+LOCAL_TZ = "Europe/Vienna"
+# Trips are handed out in tables of about this many rows.
+BATCH_TRIPS = 50_000
+
+
+def snapshot_time(path):
+    # UTC time encoded in a snapshot file name, as datetime64[ns].
+    stamp = datetime.strptime(Path(path).name.split(".")[0], SNAPSHOT_TIME_FORMAT)
+    return np.datetime64(stamp, "ns")
+
+
+def snapshot_files(city_dir):
+    # File names sort in time order, so the directory listing is the only thing held in memory.
+    return sorted(Path(city_dir).glob(SNAPSHOT_GLOB))
+
+
+def parse_snapshot(feed):
+    # (bike numbers, station uids) of the bikes docked at stations, plus
+    # {uid: (name, lat, lon)} for those stations. Free-floating bikes are
+    # listed as pseudo places and count as not docked.
+    bikes, uids, places = [], [], {}
+    for country in feed.get("countries", ()):
+        for city in country.get("cities", ()):
+            for place in city.get("places", ()):
+                name = str(place.get("name", "")).strip()
+                if place.get("bike") or name.startswith(FREE_BIKE_PREFIX):
+                    continue
+                numbers = place.get("bike_numbers") or [bike["number"] for bike in place.get("bike_list", ())]
+                if not numbers:
+                    continue
+                uid = int(place["uid"])
+                places[uid] = (name, float(place["lat"]), float(place["lng"]))
+                bikes.extend(numbers)
+                uids.extend([uid] * len(numbers))
+    return np.array(bikes, dtype=np.int64), np.array(uids, dtype=np.int64), places
+
+
+def read_snapshot_feed(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_snapshot(path):
+    return parse_snapshot(read_snapshot_feed(path))
+
+
+class BikeStates:
+    # One row per bike seen so far, sorted by bike number: the station it was
+    # last docked at, when it was last seen there and the index of that stay.
+    # A bike that is missing from a snapshot is riding (or off the network);
+    # the trip is emitted when it shows up docked at a different station, with
+    # the last sighting at the origin as departure and the first sighting at
+    # the destination as arrival. Reappearing at the same station is not a
+    # trip, as in the exported table. Memory grows with the fleet, not with time.
+
+    def __init__(self, arrays=None):
+        arrays = arrays or {}
+        self.bike = arrays.get("bike", np.zeros(0, dtype=np.int64))
+        self.station = arrays.get("station", np.zeros(0, dtype=np.int64))
+        self.last_seen = arrays.get("last_seen", np.zeros(0, dtype="datetime64[ns]"))
+        self.stay = arrays.get("stay", np.zeros(0, dtype=np.int64))
+        self.stays = int(arrays.get("stays", 0))
+        # Time of the last snapshot fed; older snapshots are skipped on resume.
+        self.time = arrays.get("time", np.datetime64("NaT", "ns"))
+        # Batches appended to the store once these states were reached.
+        self.batches = int(arrays.get("batches", 0))
+        uids = arrays.get("place_uid", np.zeros(0, dtype=np.int64))
+        names = arrays.get("place_name", np.zeros(0, dtype=str))
+        lats = arrays.get("place_lat", np.zeros(0))
+        lons = arrays.get("place_lon", np.zeros(0))
+        self.places = {int(u): (str(n), float(a), float(o)) for u, n, a, o in zip(uids, names, lats, lons)}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with np.load(path) as data:
+                return cls({name: data[name] for name in data.files})
+        except (OSError, ValueError):
+            return cls()
+
+    def save(self, path):
+        uids = np.fromiter(self.places, dtype=np.int64, count=len(self.places))
+        info = [self.places[uid] for uid in uids.tolist()]
+        tmp_path = Path(path).with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            bike=self.bike, station=self.station, last_seen=self.last_seen, stay=self.stay,
+            stays=self.stays, time=self.time, batches=self.batches, place_uid=uids,
+            place_name=np.array([i[0] for i in info], dtype=str),
+            place_lat=np.array([i[1] for i in info]), place_lon=np.array([i[2] for i in info]),
+        )
+        os.replace(tmp_path, path)
+
+    def _slots(self, bikes):
+        pos = np.searchsorted(self.bike, bikes)
+        new = pos >= len(self.bike)
+        new[~new] = self.bike[pos[~new]] != bikes[~new]
+        if new.any():
+            fresh = np.unique(bikes[new])
+            at = np.searchsorted(self.bike, fresh)
+            self.bike = np.insert(self.bike, at, fresh)
+            self.station = np.insert(self.station, at, -1)
+            self.last_seen = np.insert(self.last_seen, at, np.datetime64("NaT", "ns"))
+            self.stay = np.insert(self.stay, at, -1)
+            pos = np.searchsorted(self.bike, bikes)
+        return pos
+
+    def feed(self, when, bikes, uids, places):
+        # Advances every bike docked in the snapshot taken at `when` (UTC) and
+        # returns the finished trips as a dict of columns.
+        self.places.update(places)
+        # A bike listed twice in one response keeps its first station.
+        bikes, first = np.unique(bikes, return_index=True)
+        uids = uids[first]
+        pos = self._slots(bikes)
+        previous = self.station[pos]
+        arrived = previous != uids
+        moved = arrived & (previous >= 0)
+        stays = self.stays + np.arange(int(arrived.sum()))
+        trips = {
+            "bike_number": bikes[moved],
+            "origin_uid": previous[moved],
+            "destination_uid": uids[moved],
+            "departure_time": self.last_seen[pos[moved]],
+            "arrival_time": np.full(int(moved.sum()), when, dtype="datetime64[ns]"),
+            "origin_index": self.stay[pos[moved]],
+            "destination_index": stays[moved[arrived]],
+        }
+        self.stay[pos[arrived]] = stays
+        self.stays += len(stays)
+        self.station[pos] = uids
+        self.last_seen[pos] = when
+        self.time = np.datetime64(when, "ns")
+        return trips
+
+
+def trip_table(trips, places, tz=LOCAL_TZ):
+    # Trip columns from BikeStates.feed -> a table in the exported CSV layout,
+    # with times converted from UTC to naive local time like the export.
+    columns = {name: np.concatenate([t[name] for t in trips]) for name in trips[0]}
+    table = {"origin_index": columns["origin_index"], "destination_index": columns["destination_index"],
+             "bike_number": columns["bike_number"]}
+    for end in ("origin", "destination"):
+        uid = columns[f"{end}_uid"]
+        info = [places[u] for u in uid.tolist()]
+        table[end] = [i[0] for i in info]
+        table[f"{end}_station_id"] = uid
+        table[f"{end}_lat"] = np.array([i[1] for i in info])
+        table[f"{end}_lon"] = np.array([i[2] for i in info])
+    for name in ("departure_time", "arrival_time"):
+        utc = pd.DatetimeIndex(columns[name]).tz_localize("UTC")
+        table[name] = utc.tz_convert(tz).tz_localize(None).as_unit("ns")
+    table["duration_min"] = (columns["arrival_time"] - columns["departure_time"]) / np.timedelta64(1, "m")
+    return conform_table(pa.table(table))
+
+
+def reconstruct(paths, state=None, batch_trips=BATCH_TRIPS, tz=LOCAL_TZ):
+    # Streams snapshot files (in time order) through the per-bike states and
+    # yields trip tables of about `batch_trips` rows. Only one snapshot and one
+    # batch are in memory at a time. Pass a loaded BikeStates to resume: files
+    # at or before its last snapshot are skipped.
+    state = state if state is not None else BikeStates()
+    pending, count = [], 0
+    for path in paths:
+        when = snapshot_time(path)
+        if not np.isnat(state.time) and when <= state.time:
+            continue
+        trips = state.feed(when, *read_snapshot(path))
+        if len(trips["bike_number"]):
+            pending.append(trips)
+            count += len(trips["bike_number"])
+        if count >= batch_trips:
+            yield trip_table(pending, state.places, tz)
+            pending, count = [], 0
+    if count:
+        yield trip_table(pending, state.places, tz)
+
+
+def _pending_path(state_path):
+    return Path(state_path).with_suffix(".pending.npz")
+
+
+def load_state(state_path, store_dir=None):
+    # The saved per-bike states. A pending save left by append_to_store is
+    # kept if its batch reached the store, and dropped otherwise.
+    pending = _pending_path(state_path)
+    if pending.exists():
+        state = BikeStates.load(pending)
+        if store_dir is not None and state.batches <= len(appended_batches(store_source(store_dir))):
+            os.replace(pending, state_path)
+            return state
+        pending.unlink()
+    return BikeStates.load(state_path)
+
+
+def append_to_store(tables, store_dir, state=None, state_path=None):
+    # Appends each batch to the store as a batch of its source CSV (so rebuilds
+    # of the store replay it) and passes it on. With a state path, the states
+    # a batch was cut at are saved with it: as pending before the batch is
+    # written and promoted after, so a crash in between neither loses nor
+    # repeats trips on the next run (see load_state).
+    for table in tables:
+        if state_path is not None:
+            state.batches = len(appended_batches(store_source(store_dir))) + 1
+            state.save(_pending_path(state_path))
+        append_batch(table, store_dir)
+        if state_path is not None:
+            os.replace(_pending_path(state_path), state_path)
+        yield table
+
+
+def write_trips_csv(tables, csv_path):
+    # Writes the batches in the bike_journeys_noOutliers.csv layout (including
+    # its misspelled column), so read_trips_csv and utils.incremental accept the file.
+    export_names = {new: old for old, new in CSV_RENAMES.items()}
+    writer, rows = None, 0
+    try:
+        for table in tables:
+            table = table.rename_columns([export_names.get(name, name) for name in table.column_names])
+            for name in ("origin", "destination"):
+                i = table.schema.get_field_index(name)
+                table = table.set_column(i, name, table.column(name).cast(pa.string()))
+            if writer is None:
+                writer = pacsv.CSVWriter(str(csv_path), table.schema)
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild trips from Nextbike position snapshots.")
+    parser.add_argument("snapshots", type=Path, help="Directory of <YYYYmmddTHHMMSSZ>.json.gz snapshots for one city.")
+    parser.add_argument("--csv", type=Path, help="Write the trips to this CSV in the bike_journeys layout.")
+    parser.add_argument("--store", type=Path, help="Append the trips to this trip store as batches of the CSV it is built from.")
+    parser.add_argument("--state", type=Path, help="Resume from and save the per-bike states here.")
+    parser.add_argument("--batch-trips", type=int, default=BATCH_TRIPS)
+    args = parser.parse_args()
+    if not args.csv and not args.store:
+        parser.error("pass --csv and/or --store")
+    start = time.perf_counter()
+    if args.state:
+        args.state.parent.mkdir(parents=True, exist_ok=True)
+    state = load_state(args.state, args.store) if args.state else BikeStates()
+    tables = reconstruct(snapshot_files(args.snapshots), state, args.batch_trips)
+    if args.store:
+        tables = append_to_store(tables, args.store, state, args.state)
+    if args.csv:
+        rows = write_trips_csv(tables, args.csv)
+    else:
+        rows = sum(table.num_rows for table in tables)
+    if args.state:
+        state.save(args.state)
+    print(f"{rows:,} trips from {len(state.bike):,} bikes in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import functools
+import inspect
+import os
+import threading
+import time
+import types
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+class Registry:
+    # One copy per dataset and arguments for the whole process, shared by every
+    # session. Callers get read-only views (see view), so nothing is copied per
+    # session or per rerun. With `keep`, only that many argument sets of a
+    # dataset are held, newest first; versioned loaders keep 1, so a rebuilt
+    # store replaces the old dataset instead of adding to it.
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, key, build, keep=None, mapped=False):
+        entry = self._lookup(name, key)
+        if entry is not None:
+            return entry["value"]
+        with self._lock:
+            lock = self._locks.setdefault((name, key), threading.Lock())
+        # Concurrent callers of a missing dataset wait for one build.
+        with lock:
+            entry = self._lookup(name, key)
+            if entry is None:
+                start = time.perf_counter()
+                value = build()
+                entry = {"value": value, "mapped": mapped, "seconds": time.perf_counter() - start, "hits": 0}
+                with self._lock:
+                    self._entries[(name, key)] = entry
+                    if keep is not None:
+                        keys = [k for k in self._entries if k[0] == name]
+                        for old in keys[:-keep]:
+                            del self._entries[old]
+                            self._locks.pop(old, None)
+            return entry["value"]
+
+    def _lookup(self, name, key):
+        with self._lock:
+            entry = self._entries.get((name, key))
+            if entry is not None:
+                entry["hits"] += 1
+            return entry
+
+    def clear(self, name=None):
+        with self._lock:
+            for key in [k for k in self._entries if name is None or k[0] == name]:
+                del self._entries[key]
+                self._locks.pop(key, None)
+
+    def report(self):
+        # Size of every dataset as it is now (caches inside a dataset, such as
+        # a time cube's prefix sums, grow after it is built). Mapped datasets
+        # live in the page cache, shared with other processes and evictable,
+        # and are reported apart from heap memory. A dataset built from
+        # another shares its buffers, so the sizes may overlap.
+        with self._lock:
+            entries = list(self._entries.items())
+        rows = []
+        for (name, key), entry in entries:
+            size = nbytes(entry["value"]) / 1024 ** 2
+            rows.append({
+                "dataset": name, "args": _label(key), "heap_mb": 0.0 if entry["mapped"] else size,
+                "mapped_mb": size if entry["mapped"] else 0.0, "hits": entry["hits"], "build_s": entry["seconds"],
+            })
+        return pd.DataFrame(rows, columns=["dataset", "args", "heap_mb", "mapped_mb", "hits", "build_s"])
+
+
+_registry = Registry()
+
+
+def view(value):
+    # A read-only handle on a shared value. A frame gets a shallow copy: under
+    # copy-on-write (always on from pandas 3, hence the pin in requirements.txt)
+    # it shares every column until the caller writes to one, and columns
+    # assigned to it never reach the shared frame. Arrays become
+    # non-writeable views and dicts read-only proxies; bytes are immutable and
+    # the memory-mapped cube and rollups are read-only already.
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=False)
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+        return value
+    if isinstance(value, dict):
+        return types.MappingProxyType(value)
+    return value
+
+
+def nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, (np.ndarray, pa.Array, pa.ChunkedArray, pa.Table)):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    if hasattr(value, "__dict__"):
+        return sum(nbytes(v) for v in vars(value).values())
+    return 0
+
+
+def _key(signature, args, kwargs, ignore=()):
+    # Arguments by name with defaults filled in, so that load_bezirke(11) and
+    # load_bezirke(zoom=11) share an entry, as do load_bike_trips() and
+    # load_bike_trips(STORE_DIR).
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return tuple((name, value) for name, value in bound.arguments.items() if name not in ignore)
+
+
+def _label(key):
+    # Versions are long file listings; shown by their length only.
+    short = lambda v: f"<{len(v)} chars>" if isinstance(v, str) and len(v) > 40 else repr(v)
+    return ", ".join(f"{k}={short(v)}" for k, v in key)
+
+
+def shared(keep=None, mapped=False, ignore=()):
+    # Decorator for loaders: in place of st.cache_data, which unpickles a copy
+    # of the value for every call, the value is built once per process and
+    # every call gets a view of it. Usable as the cache of
+    # instrumentation.loader; `.clear()` drops the dataset. Arguments named in
+    # `ignore` (callbacks such as a progress bar's) reach the build but are
+    # not part of the key.
+    def wrap(fn):
+        name = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__qualname__}"
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            key = _key(signature, args, kwargs, ignore)
+            return view(_registry.get(name, key, lambda: fn(*args, **kwargs), keep, mapped))
+
+        call.clear = lambda: _registry.clear(name)
+        return call
+
+    return wrap
+
+
+def _rss_bytes():
+    # The process's resident memory (Linux); None elsewhere.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def show_panel(container):
+    # Every shared dataset with its size, plus the map cache and the process total.
+    import streamlit as st
+
+    from utils.map_cache import get_map_cache
+
+    report = _registry.report()
+    maps = get_map_cache()
+    rss = _rss_bytes()
+    total = f"{rss / 1024 ** 2:,.0f} MB resident, " if rss is not None else ""
+    container.caption(
+        f"{total}{report['heap_mb'].sum():,.1f} MB in datasets, {report['mapped_mb'].sum():,.1f} MB mapped, "
+        f"{maps.nbytes / 1024 ** 2:,.1f} MB in {len(maps)} cached maps"
+    )
+    if not report.empty:
+        number = st.column_config.NumberColumn(format="%.1f")
+        container.dataframe(report, hide_index=True, column_config={"heap_mb": number, "mapped_mb": number, "build_s": number})
@@ -0,0 +1,301 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.instrumentation import timed
+from utils.occupancy import OCCUPANCY_DIR, OccupancyStore, _read
+
+# Bucket lengths in minutes, finest first. Buckets are aligned to the Unix
+# epoch, so every coarser bucket is a whole number of finer ones. Minutes are
+# only computed on the way to 15 min: kept, they would take six float32 per
+# station-minute, hundreds of MB a month.
+LEVELS = {"15min": 15, "1h": 60, "1day": 1440}
+# A poll's value is assumed to hold until the next poll, but not longer than
+# this; longer gaps count as unobserved time.
+MAX_HOLD = np.timedelta64(5, "m")
+# Per (bucket, station): seconds observed, occupancy x seconds, seconds with
+# no bikes, seconds with no free racks, and the lowest and highest occupancy.
+STATS = np.dtype([(name, "<f4") for name in ("observed_s", "occupied_s", "empty_s", "full_s", "min", "max")])
+MINUTE_NS = 60 * 10 ** 9
+
+
+def _empty_stats(shape):
+    stats = np.zeros(shape, dtype=STATS)
+    stats["min"] = np.inf
+    stats["max"] = -np.inf
+    return stats
+
+
+def _reduce(stats, axis=0):
+    out = _empty_stats(np.delete(stats.shape, axis))
+    for name in ("observed_s", "occupied_s", "empty_s", "full_s"):
+        out[name] = stats[name].sum(axis=axis)
+    if stats.shape[axis]:
+        out["min"] = stats["min"].min(axis=axis)
+        out["max"] = stats["max"].max(axis=axis)
+    return out
+
+
+def _combine(into, stats):
+    for name in ("observed_s", "occupied_s", "empty_s", "full_s"):
+        into[name] += stats[name]
+    np.minimum(into["min"], stats["min"], out=into["min"])
+    np.maximum(into["max"], stats["max"], out=into["max"])
+
+
+def _minute_stats(times, ends, values, fields):
+    # Stats of the pieces of every poll's hold interval [times, ends), split
+    # at minute boundaries. Returns (first minute, (minutes, stations) stats).
+    t = times.view(np.int64)
+    e = ends.view(np.int64)
+    m0 = t // MINUTE_NS
+    pieces = np.where(e > t, -(-e // MINUTE_NS) - m0, 0)
+    poll = np.repeat(np.arange(len(t)), pieces)
+    minute = m0[poll] + np.arange(len(poll)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    seconds = (np.minimum(e[poll], (minute + 1) * MINUTE_NS) - np.maximum(t[poll], minute * MINUTE_NS)) / 1e9
+    bikes = values[poll, :, fields.index("bikes")].astype(np.float32)
+    free = values[poll, :, fields.index("free_racks")].astype(np.float32)
+    valid = (bikes >= 0) & (free >= 0) & (bikes + free > 0)
+    occupancy = np.divide(bikes, bikes + free, out=np.zeros_like(bikes), where=valid)
+    weight = seconds[:, None] * valid
+    first = int(minute[0]) if len(minute) else 0
+    stats = _empty_stats(((int(minute[-1]) - first + 1) if len(minute) else 0, values.shape[1]))
+    if len(minute) == 0:
+        return first, stats
+    starts = np.flatnonzero(np.diff(minute, prepend=minute[0] - 1))
+    rows = minute[starts] - first
+    stats["observed_s"][rows] = np.add.reduceat(weight, starts)
+    stats["occupied_s"][rows] = np.add.reduceat(weight * occupancy, starts)
+    stats["empty_s"][rows] = np.add.reduceat(weight * (bikes == 0), starts)
+    stats["full_s"][rows] = np.add.reduceat(weight * (free == 0), starts)
+    stats["min"][rows] = np.minimum.reduceat(np.where(valid, occupancy, np.inf), starts)
+    stats["max"][rows] = np.maximum.reduceat(np.where(valid, occupancy, -np.inf), starts)
+    return first, stats
+
+
+def _coarsen(fine, fine_start, factor, chunk=1440):
+    # Rolls a level up by an integer factor. Returns (start bucket, stats).
+    start = fine_start // factor
+    offset = fine_start - start * factor
+    total = -(-(offset + len(fine)) // factor)
+    out = _empty_stats((total, fine.shape[1]))
+    step = chunk * factor
+    for lo in range(-offset, len(fine), step):
+        rows = fine[max(lo, 0):lo + step]
+        pad = _empty_stats((max(-lo, 0), fine.shape[1]))
+        block = np.concatenate([pad, rows])
+        tail = -len(block) % factor
+        block = np.concatenate([block, _empty_stats((tail, fine.shape[1]))]).reshape(-1, factor, fine.shape[1])
+        coarse = _reduce(block, axis=1)
+        first = (lo + offset) // factor
+        out[first:first + len(coarse)] = coarse
+    return start, out
+
+
+def _utc_minute(when):
+    # Aware times are converted to UTC; naive ones are taken as UTC.
+    when = pd.Timestamp(when)
+    if when.tzinfo is not None:
+        when = when.tz_convert("UTC").tz_localize(None)
+    return np.datetime64(when, "m")
+
+
+class OccupancyRollups:
+    # Occupancy stats per station at every level in LEVELS, memory-mapped.
+    # A query covers its range with the coarsest buckets that fit and fills
+    # the edges with finer ones, so a month over all stations reads about a
+    # hundred rows rather than every poll.
+    #
+    # Each level is a raw file of STATS rows, one per bucket, appended by
+    # update_rollups. A level's last bucket can still receive the hold of the
+    # store's last poll, so it is kept apart in an open-NNNNN.npz until the
+    # next update. meta.json is written last and records the rows of every
+    # level, so an interrupted update is cut off and redone.
+
+    def __init__(self, path):
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text())
+        self.stations = np.array(meta["stations"], dtype=np.int64)
+        self.start = meta["start"]
+        self.first, self.last = meta["first"], meta["last"]
+        self.levels = {name: _read(path / f"{name}.bin", STATS, (len(self.stations),))[:meta["rows"][name]]
+                       for name in LEVELS}
+        with np.load(path / meta["open"]) as data:
+            self.open = {name: data[name] for name in LEVELS}
+
+    def time_range(self):
+        # (first, last) minute covered, as UTC datetime64.
+        return np.datetime64(self.first, "m"), np.datetime64(self.last, "m")
+
+    def _cover(self, lo, hi, names):
+        # [(level, first bucket, end bucket)] covering minutes [lo, hi), both
+        # multiples of the finest bucket.
+        if lo >= hi:
+            return []
+        name, size = names[0], LEVELS[names[0]]
+        a, z = -(-lo // size) * size, hi // size * size
+        if len(names) == 1 or a >= z:
+            return self._cover(lo, hi, names[1:]) if len(names) > 1 else [(name, lo // size, hi // size)]
+        return self._cover(lo, a, names[1:]) + [(name, a // size, z // size)] + self._cover(z, hi, names[1:])
+
+    def _rows(self, name, r0, r1, columns):
+        # Rows r0..r1 of a level, the open bucket being the one after the file.
+        data = self.levels[name]
+        rows = np.asarray(data[r0:min(r1, len(data))])[:, columns]
+        if r1 > len(data):
+            rows = np.concatenate([rows, self.open[name][:, columns]])
+        return rows
+
+    @timed("aggregate")
+    def query(self, start=None, end=None, stations=None):
+        # Time-weighted occupancy per station over [start, end), UTC. Times
+        # are rounded down to the quarter hour. `stations` is a list of
+        # station ids (default: all); ids the store has never seen are left
+        # out. Stations not observed in the range get NaN.
+        first, last = self.time_range()
+        size = LEVELS[next(iter(LEVELS))]
+        lo = first if start is None else _utc_minute(start)
+        hi = last + size if end is None else _utc_minute(end)
+        columns = np.arange(len(self.stations))
+        if stations is not None:
+            stations = np.asarray(stations, dtype=np.int64)
+            order = np.argsort(self.stations)
+            pos = order[np.minimum(np.searchsorted(self.stations[order], stations), max(len(order) - 1, 0))]
+            columns = pos[self.stations[pos] == stations]
+        total = _empty_stats(len(columns))
+        names = list(LEVELS)[::-1]
+        lo, hi = (int(t.astype(np.int64)) // size * size for t in (lo, hi))
+        for name, b0, b1 in self._cover(lo, hi, names):
+            if name not in self.start:
+                continue
+            r0 = max(b0 - self.start[name], 0)
+            r1 = min(max(b1 - self.start[name], 0), len(self.levels[name]) + 1)
+            if r0 < r1:
+                _combine(total, _reduce(self._rows(name, r0, r1, columns)))
+        observed = total["observed_s"].astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.DataFrame({
+                "station_id": self.stations[columns],
+                "mean": total["occupied_s"] / observed,
+                "min": np.where(observed > 0, total["min"], np.nan),
+                "max": np.where(observed > 0, total["max"], np.nan),
+                "empty_frac": total["empty_s"] / observed,
+                "full_frac": total["full_s"] / observed,
+                "observed_h": observed / 3600,
+            })
+
+
+def _read_meta(out_dir):
+    # None for missing rollups and for those of the older, rebuilt-on-read layout.
+    try:
+        meta = json.loads((Path(out_dir) / "meta.json").read_text())
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("open") else None
+
+
+def rollup_dir(store_dir=OCCUPANCY_DIR):
+    # Kept beside the store so that data_version(store_dir) only sees the store.
+    store_dir = Path(store_dir)
+    return store_dir.with_name(store_dir.name + ".rollups")
+
+
+ROLLUP_DIR = rollup_dir()
+
+
+def _segment_minutes(store, i):
+    # Minute stats of segment i, plus the hold of the previous segment's last
+    # poll, which is only known once this segment has been sealed. The
+    # segment's own last poll holds for nothing until the next segment.
+    times, values = store.segment_values(i)
+    first_poll = int(store.segments["first_poll"][i])
+    if first_poll > 0:
+        previous = store.poll_time[first_poll - 1]
+        times = np.append(previous, times)
+        values = np.concatenate([store.state_at(previous)[list(store.fields)].to_numpy()[None], values])
+    ends = np.minimum(np.append(times[1:], times[-1]), times + MAX_HOLD)
+    return _minute_stats(times, ends, values, store.fields)
+
+
+def _add_buckets(out_dir, meta, opened, name, start, stats):
+    # Combines a level's open bucket with stats of buckets start.. (never
+    # earlier: segments arrive in time order) and appends all but the last
+    # bucket, which becomes the open one.
+    if not len(stats):
+        return
+    if name not in meta["start"]:
+        meta["start"][name] = start
+    open_bucket = meta["start"][name] + meta["rows"][name]
+    combined = _empty_stats((start + len(stats) - open_bucket, stats.shape[1]))
+    combined[:1] = opened[name]
+    _combine(combined[start - open_bucket:], stats)
+    with open(Path(out_dir) / f"{name}.bin", "ab") as f:
+        f.write(combined[:-1].tobytes())
+    meta["rows"][name] += len(combined) - 1
+    opened[name] = combined[-1:]
+
+
+@timed("aggregate")
+def update_rollups(store_dir=OCCUPANCY_DIR, out_dir=None):
+    # Rolls up the store's segments that the rollups do not cover yet; run
+    # after every ingest (utils.occupancy). A new station changes the width of
+    # every row, so the rollups are then rebuilt from the first segment.
+    # Returns the number of segments added.
+    out_dir = Path(out_dir or rollup_dir(store_dir))
+    store = OccupancyStore(store_dir)
+    n = len(store.stations)
+    meta = _read_meta(out_dir)
+    if meta is None or meta["stations"] != store.stations.tolist():
+        if out_dir.exists():
+            shutil.rmtree(out_dir)
+        out_dir.mkdir(parents=True)
+        meta = {"stations": store.stations.tolist(), "segments": 0, "first": 0, "last": 0,
+                "start": {}, "rows": {name: 0 for name in LEVELS}, "open": None}
+        opened = {name: _empty_stats((1, n)) for name in LEVELS}
+    else:
+        with np.load(out_dir / meta["open"]) as data:
+            opened = {name: data[name] for name in LEVELS}
+    for name in LEVELS:
+        # Rows past the recorded end are from an interrupted update.
+        path = out_dir / f"{name}.bin"
+        if path.exists() and path.stat().st_size > meta["rows"][name] * n * STATS.itemsize:
+            os.truncate(path, meta["rows"][name] * n * STATS.itemsize)
+    added = len(store.segments) - meta["segments"]
+    if added <= 0 and meta["open"] is not None:
+        return 0
+    for i in range(meta["segments"], len(store.segments)):
+        first, stats = _segment_minutes(store, i)
+        if not len(stats):
+            continue
+        fine_start, fine_size = first, 1
+        for name, size in LEVELS.items():
+            fine_start, stats = _coarsen(stats, fine_start, size // fine_size)
+            fine_size = size
+            _add_buckets(out_dir, meta, opened, name, fine_start, stats)
+    if len(store):
+        meta["first"] = int(store.poll_time[0].astype("datetime64[m]").astype(np.int64))
+        meta["last"] = int(store.poll_time[-1].astype("datetime64[m]").astype(np.int64))
+    meta["segments"] = len(store.segments)
+    previous, meta["open"] = meta["open"], f"open-{meta['segments']:05d}.npz"
+    np.savez(out_dir / meta["open"], **opened)
+    tmp_path = out_dir / "meta.json.tmp"
+    tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, out_dir / "meta.json")
+    for stale in out_dir.glob("open-*.npz"):
+        if stale.name != meta["open"]:
+            stale.unlink()
+    return added
+
+
+def open_rollups(store_dir=OCCUPANCY_DIR):
+    # The rollups of a store as of its last ingest; None before the first
+    # that held a poll for any time, as there is nothing to query until then.
+    out_dir = rollup_dir(store_dir)
+    meta = _read_meta(out_dir)
+    if meta is None or not meta["start"]:
+        return None
+    return OccupancyRollups(out_dir)
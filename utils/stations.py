@@ -0,0 +1,98 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+# Free-floating bikes show up in the tracking export as "BIKE <number>"; they are not stations.
+FREE_BIKE_PREFIX = "BIKE"
+
+
+def _empty_frame():
+    return pd.DataFrame({
+        "station_id": np.zeros(0, dtype=np.int64),
+        "station": np.zeros(0, dtype=object),
+        "lat": np.zeros(0),
+        "lon": np.zeros(0),
+        "tracked": np.zeros(0, dtype=bool),
+    })
+
+
+class StationDimension:
+    # One row per station; a station's int32 code is its row position. Codes are
+    # never reassigned, new stations are appended. Stations that are only known
+    # from the tracking export have station_id -1 until a trip names them.
+
+    def __init__(self, frame=None):
+        self.frame = _empty_frame() if frame is None else frame
+
+    @classmethod
+    def load(cls, path):
+        try:
+            return cls(feather.read_feather(path))
+        except OSError:
+            return cls()
+
+    def save(self, path):
+        tmp_path = Path(path).with_name(Path(path).name + ".tmp")
+        feather.write_feather(self.frame, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def codes(self, station_id):
+        # -1 for ids the dimension has not seen.
+        ids = self.frame["station_id"].to_numpy()
+        station_id = np.asarray(station_id, dtype=np.int64)
+        known = np.flatnonzero(ids >= 0)
+        if len(known) == 0:
+            return np.full(len(station_id), -1, dtype=np.int32)
+        order = known[np.argsort(ids[known])]
+        pos = order[np.minimum(np.searchsorted(ids[order], station_id), len(order) - 1)]
+        return np.where(ids[pos] == station_id, pos, -1).astype(np.int32)
+
+    def encode(self, station_id, name, lat, lon):
+        # Codes for the given rows, adding any station id not seen before. The
+        # first row of an id supplies its name and coordinates.
+        ids, first, inverse = np.unique(np.asarray(station_id, dtype=np.int64), return_index=True, return_inverse=True)
+        codes = self.codes(ids)
+        new = np.flatnonzero(codes < 0)
+        if len(new):
+            added = pd.DataFrame({
+                "station_id": ids[new],
+                "station": pd.Series(np.asarray(name, dtype=object)[first[new]]).astype(str).str.strip().to_numpy(),
+                "lat": np.asarray(lat, dtype=np.float64)[first[new]].round(6),
+                "lon": np.asarray(lon, dtype=np.float64)[first[new]].round(6),
+                "tracked": False,
+            })
+            # A station already listed by the tracking export takes over its row.
+            pending = self.frame.index[self.frame["station_id"] < 0]
+            by_name = pd.Series(pending, index=self.frame.loc[pending, "station"]).groupby(level=0).first()
+            rows = by_name.reindex(added["station"]).to_numpy()
+            adopt = ~pd.isna(rows)
+            if adopt.any():
+                target = rows[adopt].astype(np.int64)
+                for column in ("station_id", "lat", "lon"):
+                    self.frame.loc[target, column] = added.loc[adopt, column].to_numpy()
+            self._append(added[~adopt])
+            codes = self.codes(ids)
+        return codes[inverse]
+
+    def add_tracked(self, names, lat, lon):
+        # Marks stations from the tracking export, appending the ones no trip has named yet.
+        listed = pd.DataFrame({
+            "station": pd.Series(names, dtype=object).astype(str).str.strip(),
+            "lat": np.asarray(lat, dtype=np.float64).round(6),
+            "lon": np.asarray(lon, dtype=np.float64).round(6),
+        })
+        listed = listed[~listed["station"].str.startswith(FREE_BIKE_PREFIX)].drop_duplicates("station")
+        known = listed["station"].isin(self.frame["station"]).to_numpy()
+        self.frame.loc[self.frame["station"].isin(listed["station"]), "tracked"] = True
+        self._append(listed[~known].assign(station_id=-1, tracked=True))
+
+    def _append(self, rows):
+        if len(rows):
+            rows = rows.sort_values("station", kind="stable")[self.frame.columns]
+            self.frame = pd.concat([self.frame, rows], ignore_index=True) if len(self.frame) else rows.reset_index(drop=True)
@@ -0,0 +1,273 @@
+import argparse
+import json
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy.spatial import cKDTree
+
+from utils.aggregations import PERIOD_OF_HOUR, PERIODS
+from utils.reconstruction import write_trips_csv
+from utils.stations import StationDimension
+from utils.trip_store import CSV_SCHEMA, STATIONS_FILE, TRIP_SCHEMA, source_fingerprint, write_coded_part
+
+# Stephansplatz; distances are measured from here on a local flat projection.
+CENTER = (48.2085, 16.3725)
+KM_PER_DEG = (111.2, 111.2 * np.cos(np.radians(CENTER[0])))
+# The shipped stations: 32% lie within 2.7 km of the centre (inside the
+# Gürtel), the rest thin out towards the city limit ~10.6 km away.
+CORE_KM = 2.7
+CITY_KM = 10.6
+CORE_SHARE = 0.32
+POPULARITY_KM = 4.5
+# Share of departures per hour of day (percent), from the shipped week.
+WEEKDAY_HOURS = np.array([2.2, 1.4, 0.7, 0.5, 0.4, 0.3, 1.0, 4.2, 4.9, 4.6, 3.6, 3.7,
+                          4.2, 4.8, 4.5, 6.1, 8.5, 9.9, 9.4, 8.3, 5.9, 4.1, 3.5, 3.3])
+WEEKEND_HOURS = np.array([3.3, 2.4, 1.2, 1.0, 0.7, 0.3, 0.5, 0.8, 1.7, 2.8, 5.0, 5.5,
+                          6.4, 7.5, 8.5, 7.0, 7.1, 8.8, 7.5, 7.4, 5.4, 3.8, 3.4, 2.2])
+# Trips per day of week, Monday first.
+WEEKDAY_TRIPS = np.array([2970, 1994, 2429, 2281, 3136, 3503, 2938])
+# Commuting: in the morning departures lean to the outer stations and
+# arrivals to the core, in the evening the other way round.
+COMMUTE_TILT = {"morning": 0.5, "midday": 0.0, "evening": -0.4, "night": 0.0}
+# Gravity model: destinations are drawn in CELL_KM cells with weight
+# attraction * exp(-distance / DECAY_KM).
+CELL_KM = 1.0
+DECAY_KM = 1.35
+# Ride time is distance * DETOUR at a lognormal speed plus an exponential
+# pause, a long one for LEISURE_SHARE of the trips; trips are seen at
+# SNAPSHOT_MIN snapshots, as in the shipped data.
+DETOUR = 1.3
+SPEED_KMH = 13.0
+PAUSE_MIN = 4.0
+LEISURE_SHARE = 0.25
+LEISURE_PAUSE_MIN = 30.0
+MAX_RIDE_MIN = 100.0
+SNAPSHOT_MIN = 5
+BIKES_PER_STATION = 12
+STATION_ID_BASE = 900_000_000
+BATCH_TRIPS = 1_000_000
+SPEC_FILE = "synthetic.json"
+
+
+def _cumulative(weights, groups, n_groups):
+    # Per-group normalised cumulative weights of rows sorted by group, offset
+    # by the group number, so searchsorted(table, group + u) samples a row of
+    # `group` in proportion to its weight.
+    totals = np.bincount(groups, weights, minlength=n_groups)
+    within = np.cumsum(weights) - np.repeat(np.cumsum(totals) - totals, np.bincount(groups, minlength=n_groups))
+    return groups + within / np.where(totals > 0, totals, 1)[groups]
+
+
+class SyntheticCity:
+    # Stations placed like Vienna's and per-period samplers for origins and
+    # destinations. Everything derives from the seed, so two cities with the
+    # same arguments generate the same trips.
+
+    def __init__(self, stations=254, seed=0):
+        rng = np.random.default_rng([seed, 0])
+        core = rng.random(stations) < CORE_SHARE
+        radius = np.where(core, CORE_KM * np.sqrt(rng.random(stations)),
+                          CORE_KM + (CITY_KM - CORE_KM) * (1 - rng.random(stations) ** (1 / 1.6)))
+        angle = rng.uniform(0, 2 * np.pi, stations)
+        self.x, self.y = radius * np.cos(angle), radius * np.sin(angle)
+        self.stations = pd.DataFrame({
+            "station_id": STATION_ID_BASE + np.arange(stations, dtype=np.int64),
+            "station": [f"Station {i:05d}" for i in range(stations)],
+            "lat": (CENTER[0] + self.y / KM_PER_DEG[0]).round(6),
+            "lon": (CENTER[1] + self.x / KM_PER_DEG[1]).round(6),
+            "tracked": True,
+        })
+        # Trip counts per station are roughly exponential in the shipped data,
+        # and their mean falls by e every POPULARITY_KM from the centre.
+        popularity = rng.gamma(2.0, 1.0, stations) * np.exp(-radius / POPULARITY_KM)
+        outer = np.clip((radius - CORE_KM) / (CITY_KM - CORE_KM), 0, 1) - 0.5
+        cell_x = np.floor(self.x / CELL_KM).astype(np.int64)
+        cell_y = np.floor(self.y / CELL_KM).astype(np.int64)
+        cells, self.cell = np.unique(np.stack([cell_x, cell_y], axis=1), axis=0, return_inverse=True)
+        self.cell = self.cell.ravel()
+        self.by_cell = np.argsort(self.cell, kind="stable")
+        centers = (cells + 0.5) * CELL_KM
+        gap = np.hypot(*(centers[:, None, :] - centers[None, :, :]).transpose(2, 0, 1))
+        # About the mean distance between two points of one cell.
+        np.fill_diagonal(gap, CELL_KM / 2)
+        deterrence = np.exp(-gap / DECAY_KM)
+        n_cells = self.n_cells = len(cells)
+        self.origins, self.destination_cells, self.destinations = [], [], []
+        for period in PERIODS:
+            tilt = COMMUTE_TILT[period]
+            departures = popularity * np.exp(tilt * outer)
+            arrivals = popularity * np.exp(-tilt * outer)
+            self.origins.append(np.cumsum(departures) / departures.sum())
+            attraction = np.bincount(self.cell, arrivals, minlength=n_cells)
+            rows = np.repeat(np.arange(n_cells), n_cells)
+            self.destination_cells.append(_cumulative((deterrence * attraction).ravel(), rows, n_cells))
+            self.destinations.append(_cumulative(arrivals[self.by_cell], self.cell[self.by_cell], n_cells))
+        # Fallback destination for the rare trip that keeps drawing its origin.
+        points = np.stack([self.x, self.y], axis=1)
+        self.neighbour = cKDTree(points).query(points, k=min(2, stations))[1][:, -1] if stations > 1 else np.zeros(1, np.int64)
+        self.bikes = BIKES_PER_STATION * stations
+        self._names = pa.array(self.stations["station"].to_numpy(), pa.string())
+
+    def _destination(self, origin, period, rng):
+        home = self.cell[origin]
+        cell = np.searchsorted(self.destination_cells[period], home + rng.random(len(origin)), "right") - home * self.n_cells
+        cell = np.minimum(cell, self.n_cells - 1)
+        pick = np.searchsorted(self.destinations[period], cell + rng.random(len(origin)), "right")
+        return self.by_cell[np.minimum(pick, len(self.by_cell) - 1)]
+
+    def trips(self, hour_start, count, rng, offsets, free_at):
+        # Columns of `count` trips departing in the hour from `hour_start`
+        # (naive local datetime64), sorted by departure. Departures and
+        # arrivals fall on snapshot times: slot * SNAPSHOT_MIN plus the
+        # slot's `offsets` entry in seconds. `free_at` holds the slot each
+        # bike is back from its last trip and is updated in place, so hours
+        # must be generated in order.
+        period = PERIOD_OF_HOUR[int(hour_start.astype("datetime64[h]").astype(np.int64) % 24)]
+        n = len(self.stations)
+        origin = np.minimum(np.searchsorted(self.origins[period], rng.random(count), "right"), n - 1)
+        destination = self._destination(origin, period, rng)
+        for _ in range(8):
+            again = np.flatnonzero(destination == origin)
+            if len(again) == 0:
+                break
+            destination[again] = self._destination(origin[again], period, rng)
+        destination = np.where(destination == origin, self.neighbour[origin], destination)
+        distance = np.hypot(self.x[origin] - self.x[destination], self.y[origin] - self.y[destination])
+        speed = SPEED_KMH * np.exp(0.25 * rng.standard_normal(count))
+        pause = rng.exponential(np.where(rng.random(count) < LEISURE_SHARE, LEISURE_PAUSE_MIN, PAUSE_MIN))
+        ride = np.minimum(distance * DETOUR / speed * 60 + pause, MAX_RIDE_MIN)
+        begin = rng.random(count) * 60
+        first_slot = int(hour_start.astype("datetime64[m]").astype(np.int64)) // SNAPSHOT_MIN
+        departure = first_slot + (begin // SNAPSHOT_MIN).astype(np.int64)
+        arrival = np.maximum(first_slot + np.ceil((begin + ride) / SNAPSHOT_MIN).astype(np.int64), departure + 1)
+        order = np.argsort(departure, kind="stable")
+        departure, arrival = departure[order], arrival[order]
+        # Each snapshot's departures take bikes that are back by then,
+        # consecutive ones of the free list from a random start, so a bike's
+        # trips follow one another in time (not in place: a bike may leave from
+        # another station than it arrived at, as if moved by the operator).
+        # Only when the whole fleet is out are the bikes back soonest taken early.
+        bike = np.empty(count, dtype=np.int64)
+        slots, first = np.unique(departure, return_index=True)
+        ends = np.append(first[1:], count)
+        for slot, lo, hi, at in zip(slots.tolist(), first.tolist(), ends.tolist(), rng.random(len(slots)).tolist()):
+            free = np.flatnonzero(free_at <= slot)
+            if hi - lo > len(free):
+                busy = np.flatnonzero(free_at > slot)
+                free = np.append(free, busy[np.argsort(free_at[busy], kind="stable")[:hi - lo - len(free)]])
+            bike[lo:hi] = free[(int(at * len(free)) + np.arange(hi - lo)) % len(free)]
+            free_at[bike[lo:hi]] = arrival[lo:hi]
+        slot_ns = SNAPSHOT_MIN * 60 * 10 ** 9
+        return {
+            "origin": origin[order],
+            "destination": destination[order],
+            "bike": bike,
+            "departure": departure * slot_ns + (offsets[departure % len(offsets)] * 1e9).astype(np.int64),
+            "arrival": arrival * slot_ns + (offsets[arrival % len(offsets)] * 1e9).astype(np.int64),
+        }
+
+    def table(self, block, first_row, coded=False):
+        # The block in the CSV layout, or with station codes (the stations'
+        # row positions) in the trip store layout.
+        schema = TRIP_SCHEMA if coded else CSV_SCHEMA
+        row = first_row + np.arange(len(block["origin"]), dtype=np.int64)
+        columns = {
+            "origin_index": pa.array(2 * row),
+            "destination_index": pa.array(2 * row + 1),
+            "bike_number": pa.array((100_000 + block["bike"]).astype(np.int32)),
+            "departure_time": pa.array(block["departure"].astype("datetime64[ns]")),
+            "arrival_time": pa.array(block["arrival"].astype("datetime64[ns]")),
+            "duration_min": pa.array(((block["arrival"] - block["departure"]) / 6e10).astype(np.float32)),
+        }
+        for end in ("origin", "destination"):
+            codes = block[end].astype(np.int32)
+            columns[f"{end}_station_id"] = pa.array(self.stations["station_id"].to_numpy()[codes])
+            columns[f"{end}_lat"] = pa.array(self.stations["lat"].to_numpy(np.float32)[codes])
+            columns[f"{end}_lon"] = pa.array(self.stations["lon"].to_numpy(np.float32)[codes])
+            columns[f"{end}_code"] = pa.array(codes)
+            columns[end] = pa.DictionaryArray.from_arrays(columns[f"{end}_code"], self._names)
+        return pa.Table.from_arrays([columns[name] for name in schema.names], schema=schema)
+
+
+def generate(trips, stations=254, days=28, start="2025-05-05", seed=0, batch_trips=BATCH_TRIPS, coded=False, city=None):
+    # Streams `trips` trips over `days` days from `start` in tables of about
+    # batch_trips rows, sorted by departure time. The output only depends on
+    # the arguments other than batch_trips.
+    city = city if city is not None else SyntheticCity(stations, seed)
+    dates = np.datetime64(start, "D") + np.arange(days)
+    # 1970-01-01 was a Thursday.
+    weekday = (dates.astype(np.int64) + 3) % 7
+    rng = np.random.default_rng([seed, 1])
+    per_day = rng.multinomial(trips, WEEKDAY_TRIPS[weekday] / WEEKDAY_TRIPS[weekday].sum())
+    counts = np.stack([
+        rng.multinomial(n, profile / profile.sum())
+        for n, profile in zip(per_day, np.where(weekday[:, None] >= 5, WEEKEND_HOURS, WEEKDAY_HOURS))
+    ]).ravel() if days else np.zeros(0, np.int64)
+    # Snapshots come a couple of seconds after the full minute, like the API's.
+    offsets = rng.uniform(1.7, 2.3, 4096)
+    free_at = np.zeros(city.bikes, dtype=np.int64)
+    first_rows = np.cumsum(counts) - counts
+    pending, pending_rows, first_row = [], 0, 0
+    for i in np.flatnonzero(counts):
+        day, hour = divmod(int(i), 24)
+        hour_start = dates[day] + np.timedelta64(hour, "h")
+        if not pending:
+            first_row = first_rows[i]
+        pending.append(city.trips(hour_start, int(counts[i]), np.random.default_rng([seed, 2, day, hour]), offsets, free_at))
+        pending_rows += int(counts[i])
+        if pending_rows >= batch_trips:
+            yield city.table({key: np.concatenate([b[key] for b in pending]) for key in pending[0]}, first_row, coded)
+            pending, pending_rows = [], 0
+    if pending:
+        yield city.table({key: np.concatenate([b[key] for b in pending]) for key in pending[0]}, first_row, coded)
+
+
+def write_store(tables, city, store_dir, spec):
+    # A trip store of generated parts. Its SOURCE is the spec file rather than
+    # a CSV, so open_trip_table keeps the store as long as the spec is unchanged.
+    store_dir = Path(store_dir)
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    store_dir.mkdir(parents=True)
+    StationDimension(city.stations).save(store_dir / STATIONS_FILE)
+    rows = 0
+    for table in tables:
+        write_coded_part(table, store_dir)
+        rows += table.num_rows
+    spec_path = store_dir / SPEC_FILE
+    spec_path.write_text(json.dumps(spec, indent=2))
+    (store_dir / "SOURCE").write_text(source_fingerprint(spec_path))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Vienna-like synthetic trips for scale tests.")
+    parser.add_argument("--trips", type=int, default=1_000_000)
+    parser.add_argument("--stations", type=int, default=254)
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument("--start", default="2025-05-05")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-trips", type=int, default=BATCH_TRIPS)
+    parser.add_argument("--csv", type=Path, help="Write the trips to this CSV in the bike_journeys layout.")
+    parser.add_argument("--store", type=Path, help="Write the trips as a trip store in this directory.")
+    args = parser.parse_args()
+    if bool(args.csv) == bool(args.store):
+        parser.error("pass one of --csv and --store")
+    start = time.perf_counter()
+    spec = {name: getattr(args, name) for name in ("trips", "stations", "days", "start", "seed")}
+    city = SyntheticCity(args.stations, args.seed)
+    tables = generate(**spec, batch_trips=args.batch_trips, coded=bool(args.store), city=city)
+    if args.store:
+        rows = write_store(tables, city, args.store, spec)
+    else:
+        rows = write_trips_csv(tables, args.csv)
+    seconds = time.perf_counter() - start
+    print(f"{rows:,} trips at {args.stations:,} stations in {seconds:.1f}s ({rows / seconds / 1e6:.2f} M rows/s)")
+
+
+if __name__ == "__main__":
+    main()
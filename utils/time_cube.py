@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils import aggregations
+from utils.instrumentation import timed
+from utils.trip_store import DATA_DIR
+
+CUBE_DIR = DATA_DIR / "cache" / "time_cube"
+HOURS = 24
+KINDS = ("dep", "arr")
+DAY_TYPES = ("all", "weekday", "weekend")
+
+
+def _day_hour(times, first_day):
+    values = times.to_numpy("datetime64[ns]")
+    day = (values.astype("datetime64[D]") - first_day).astype(np.int64)
+    hour = (values - values.astype("datetime64[D]")).astype("timedelta64[h]").astype(np.int64)
+    return day, hour
+
+
+class TimeCube:
+    # Trip counts by (day, hour of day, station), with departures and arrivals
+    # kept apart. Loaded cubes are memory-mapped, so an animation frame is a
+    # slice and a sum over the selected days rather than a groupby over trips.
+
+    def __init__(self, stations, days, dep, arr):
+        self.stations = stations
+        self.days = days
+        self.dep = dep
+        self.arr = arr
+        self._prefix = {}
+
+    @classmethod
+    def build(cls, trips, stations=None):
+        stations, origin, destination = aggregations.station_index(trips, stations)
+        n = len(stations)
+        times = pd.concat([trips["departure_time"], trips["arrival_time"]], ignore_index=True)
+        first_day = np.datetime64(times.min().normalize(), "D")
+        last_day = np.datetime64(times.max().normalize(), "D")
+        days = np.arange(first_day, last_day + 1)
+        size = len(days) * HOURS * n
+        cube = {}
+        for kind, column, codes in (("dep", "departure_time", origin), ("arr", "arrival_time", destination)):
+            day, hour = _day_hour(trips[column], first_day)
+            flat = (day * HOURS + hour) * n + codes
+            cube[kind] = np.bincount(flat, minlength=size).astype(np.int32).reshape(len(days), HOURS, n)
+        return cls(stations, days, cube["dep"], cube["arr"])
+
+    def save(self, out_dir=CUBE_DIR, version=""):
+        out_dir = Path(out_dir)
+        tmp_dir = out_dir.with_name(out_dir.name + ".tmp")
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+        np.save(tmp_dir / "dep.npy", self.dep)
+        np.save(tmp_dir / "arr.npy", self.arr)
+        self.stations.to_csv(tmp_dir / "stations.csv", index=False)
+        meta = {"version": version, "days": [str(day) for day in self.days]}
+        (tmp_dir / "meta.json").write_text(json.dumps(meta))
+        if out_dir.exists():
+            shutil.rmtree(out_dir)
+        os.replace(tmp_dir, out_dir)
+
+    @classmethod
+    def load(cls, out_dir=CUBE_DIR):
+        out_dir = Path(out_dir)
+        meta = json.loads((out_dir / "meta.json").read_text())
+        return cls(
+            pd.read_csv(out_dir / "stations.csv"),
+            np.array(meta["days"], dtype="datetime64[D]"),
+            np.load(out_dir / "dep.npy", mmap_mode="r"),
+            np.load(out_dir / "arr.npy", mmap_mode="r"),
+        )
+
+    def day_range(self, start=None, end=None):
+        # Inclusive calendar dates -> slice along the day axis.
+        lo = 0 if start is None else int(np.searchsorted(self.days, np.datetime64(start, "D")))
+        hi = len(self.days) if end is None else int(np.searchsorted(self.days, np.datetime64(end, "D"), "right"))
+        return slice(lo, hi)
+
+    def hourly(self, kind="dep", days=slice(None)):
+        # (24, stations) counts summed over the selected days.
+        return getattr(self, kind)[days].sum(axis=0, dtype=np.int64)
+
+    def day_mask(self, day_type="all"):
+        weekday = (self.days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday; Monday is 0.
+        if day_type == "weekday":
+            return weekday < 5
+        if day_type == "weekend":
+            return weekday >= 5
+        return np.ones(len(self.days), dtype=bool)
+
+    def hour_prefix(self, kind="dep", day_type="all"):
+        # (25, stations) running totals over the hours of the day, built once per
+        # kind and day type so that any window is a difference of two rows.
+        key = (kind, day_type)
+        if key not in self._prefix:
+            counts = self.hourly(kind, self.day_mask(day_type))
+            prefix = np.zeros((HOURS + 1, counts.shape[1]), dtype=np.int64)
+            np.cumsum(counts, axis=0, out=prefix[1:])
+            self._prefix[key] = prefix
+        return self._prefix[key]
+
+    @timed("aggregate")
+    def window(self, kind="dep", start=0, end=HOURS, day_type="all"):
+        # Counts per station for hours [start, end). A window with end <= start
+        # wraps past midnight, so (20, 7) is the notebook's night.
+        prefix = self.hour_prefix(kind, day_type)
+        if start < end:
+            return prefix[end] - prefix[start]
+        return prefix[HOURS] - prefix[start] + prefix[end]
+
+    @timed("aggregate")
+    def frames(self, kind="dep", days=slice(None)):
+        # One [[lat, lon, weight], ...] list per hour for HeatMapWithTime. Weights
+        # share one scale across hours so frames are comparable.
+        counts = self.hourly(kind, days)
+        peak = max(int(counts.max()), 1)
+        lat = self.stations["lat"].to_numpy()
+        lon = self.stations["lon"].to_numpy()
+        frames = []
+        for hour in range(HOURS):
+            active = np.flatnonzero(counts[hour])
+            frames.append(np.column_stack([
+                lat[active], lon[active], (counts[hour, active] / peak).round(4)
+            ]).tolist())
+        return frames
+
+
+def _read_version(out_dir):
+    try:
+        return json.loads((Path(out_dir) / "meta.json").read_text())["version"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def open_time_cube(trips, version, out_dir=CUBE_DIR, stations=None):
+    # `version` identifies the trips, e.g. map_cache.data_version(STORE_DIR);
+    # the cube is only rebuilt when it changes.
+    if _read_version(out_dir) != version:
+        TimeCube.build(trips, stations).save(out_dir, version)
+    return TimeCube.load(out_dir)
@@ -0,0 +1,274 @@
+import argparse
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.ipc as ipc
+
+from utils.stations import StationDimension
+
+DATA_DIR = Path(__file__).parent.parent / "data"
+TRIPS_CSV = DATA_DIR / "bike_journeys_noOutliers.csv"
+STATIONS_CSV = DATA_DIR / "bike_tracking_stations.csv"
+STORE_DIR = DATA_DIR / "cache" / "trips"
+# The station dimension lives with the parts whose codes refer to it.
+STATIONS_FILE = "stations.arrow"
+# Names of the appended batches a store holds, one per line.
+BATCHES_FILE = "BATCHES"
+
+# The CSV export misspells the destination id column; the store fixes it once.
+CSV_RENAMES = {"destination_staions_id": "destination_station_id"}
+
+# Trips as exported, with station names.
+CSV_SCHEMA = pa.schema([
+    ("origin_index", pa.int64()),
+    ("destination_index", pa.int64()),
+    ("bike_number", pa.int32()),
+    ("origin", pa.dictionary(pa.int32(), pa.string())),
+    ("destination", pa.dictionary(pa.int32(), pa.string())),
+    ("departure_time", pa.timestamp("ns")),
+    ("arrival_time", pa.timestamp("ns")),
+    ("origin_station_id", pa.int64()),
+    ("origin_lat", pa.float32()),
+    ("origin_lon", pa.float32()),
+    ("destination_station_id", pa.int64()),
+    ("destination_lat", pa.float32()),
+    ("destination_lon", pa.float32()),
+    ("duration_min", pa.float32()),
+])
+
+# Trips as stored: names are replaced by int32 codes into the station dimension.
+TRIP_SCHEMA = pa.schema(
+    [field for field in CSV_SCHEMA if field.name not in ("origin", "destination")]
+    + [("origin_code", pa.int32()), ("destination_code", pa.int32())]
+)
+
+
+def source_fingerprint(csv_path):
+    stat = Path(csv_path).stat()
+    return f"{Path(csv_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def appended_dir(csv_path):
+    # Batches appended to a CSV's store (utils.incremental) are kept next to the
+    # CSV rather than in the rebuildable store, and replayed on every rebuild.
+    csv_path = Path(csv_path)
+    return csv_path.with_name(csv_path.stem + ".appended")
+
+
+def appended_batches(csv_path):
+    return sorted(appended_dir(csv_path).glob("batch-*.arrow"))
+
+
+def store_source(store_dir=STORE_DIR):
+    marker = Path(store_dir) / "SOURCE"
+    if not marker.exists():
+        return TRIPS_CSV
+    return Path(marker.read_text().rsplit(":", 2)[0])
+
+
+def conform_table(table, schema=CSV_SCHEMA):
+    table = table.rename_columns([CSV_RENAMES.get(name, name) for name in table.column_names])
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if pa.types.is_dictionary(field.type) and not pa.types.is_dictionary(column.type):
+            column = column.cast(pa.string()).dictionary_encode()
+        columns.append(column.cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _both_ends(table, suffix):
+    # Origin values followed by destination values, e.g. suffix "_lat".
+    columns = []
+    for end in ("origin", "destination"):
+        column = table.column(f"{end}{suffix}")
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(pa.string())
+        columns.append(column.to_numpy(zero_copy_only=False))
+    return np.concatenate(columns)
+
+
+def with_station_codes(table, dimension):
+    # Swaps the name columns of an exported batch for station codes, adding
+    # stations the dimension has not seen yet.
+    table = conform_table(table)
+    codes = dimension.encode(
+        _both_ends(table, "_station_id"), _both_ends(table, ""), _both_ends(table, "_lat"), _both_ends(table, "_lon")
+    )
+    n = table.num_rows
+    table = table.append_column("origin_code", pa.array(codes[:n], pa.int32()))
+    table = table.append_column("destination_code", pa.array(codes[n:], pa.int32()))
+    return table.select(TRIP_SCHEMA.names)
+
+
+def build_dimension(table, stations_csv=STATIONS_CSV):
+    dimension = StationDimension()
+    with_station_codes(table, dimension)
+    if Path(stations_csv).exists():
+        listed = pacsv.read_csv(stations_csv).to_pandas()
+        dimension.add_tracked(listed["place_name"], listed["lat"], listed["long"])
+    return dimension
+
+
+def read_stations(store_dir=STORE_DIR):
+    path = Path(store_dir) / STATIONS_FILE
+    if path.exists():
+        return StationDimension.load(path).frame
+    # Same codes open_trip_table hands out when the store cannot be written.
+    return build_dimension(_source_table(store_source(store_dir))).frame
+
+
+def _csv_convert_options():
+    csv_names = {new: old for old, new in CSV_RENAMES.items()}
+    include_columns = [csv_names.get(f.name, f.name) for f in CSV_SCHEMA]
+    # Integer-valued floats like "26103.0" are parsed as float and cast afterwards.
+    column_types = {name: pa.string() for name in ("origin", "destination")}
+    column_types.update({name: pa.timestamp("ns") for name in ("departure_time", "arrival_time")})
+    column_types.update({name: pa.float64() for name in ("origin_index", "destination_index")})
+    return pacsv.ConvertOptions(column_types=column_types, include_columns=include_columns)
+
+
+def read_trips_csv(csv_path=TRIPS_CSV):
+    return conform_table(pacsv.read_csv(csv_path, convert_options=_csv_convert_options()))
+
+
+def _source_table(csv_path):
+    # The CSV and the batches appended to it, as one exported table.
+    return pa.concat_tables([read_trips_csv(csv_path)] + [read_part(batch) for batch in appended_batches(csv_path)])
+
+
+def iter_trips_csv(csv_path=TRIPS_CSV, block_size=64 << 20):
+    # The CSV as a stream of conformed tables of about block_size bytes each,
+    # for files that do not fit in memory.
+    reader = pacsv.open_csv(
+        csv_path, read_options=pacsv.ReadOptions(block_size=block_size), convert_options=_csv_convert_options()
+    )
+    for batch in reader:
+        yield conform_table(pa.Table.from_batches([batch]))
+
+
+def write_part(table, store_dir=STORE_DIR):
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    dimension = StationDimension.load(store_dir / STATIONS_FILE)
+    table = with_station_codes(table, dimension)
+    dimension.save(store_dir / STATIONS_FILE)
+    return write_coded_part(table, store_dir)
+
+
+def _write_ipc(table, schema, directory, prefix):
+    # Writes the next <prefix>-NNNNN.arrow in `directory` atomically.
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    index = len(list(directory.glob(f"{prefix}-*.arrow")))
+    path = directory / f"{prefix}-{index:05d}.arrow"
+    tmp_path = path.with_suffix(".tmp")
+    # Uncompressed IPC so that reads can map the buffers straight from disk.
+    with pa.OSFile(str(tmp_path), "wb") as sink:
+        with ipc.new_file(sink, schema) as writer:
+            writer.write_table(table.combine_chunks())
+    tmp_path.replace(path)
+    return path
+
+
+def write_coded_part(table, store_dir=STORE_DIR):
+    # A TRIP_SCHEMA table whose codes already refer to the store's dimension.
+    return _write_ipc(table, TRIP_SCHEMA, store_dir, "part")
+
+
+def _write_batches(names, store_dir):
+    path = Path(store_dir) / BATCHES_FILE
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text("".join(f"{name}\n" for name in names))
+    tmp_path.replace(path)
+
+
+def _store_batches(store_dir):
+    path = Path(store_dir) / BATCHES_FILE
+    return path.read_text().split() if path.exists() else []
+
+
+def append_batch(table, store_dir=STORE_DIR):
+    # Appends exported trips to the store of a CSV. The batch is kept in the
+    # CSV's appended directory first, so that a crash before the store records
+    # it, or any later rebuild of the store, replays it rather than losing it.
+    open_trip_table(store_dir=store_dir)
+    batch = _write_ipc(conform_table(table), CSV_SCHEMA, appended_dir(store_source(store_dir)), "batch")
+    part = write_part(table, store_dir)
+    _write_batches(_store_batches(store_dir) + [batch.name], store_dir)
+    return part
+
+
+def build_trip_store(csv_path=TRIPS_CSV, store_dir=STORE_DIR):
+    store_dir = Path(store_dir)
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    store_dir.mkdir(parents=True)
+    table = read_trips_csv(csv_path)
+    build_dimension(table).save(store_dir / STATIONS_FILE)
+    write_part(table, store_dir)
+    batches = appended_batches(csv_path)
+    for batch in batches:
+        write_part(read_part(batch), store_dir)
+    _write_batches([batch.name for batch in batches], store_dir)
+    # Written last: a store without it is rebuilt.
+    (store_dir / "SOURCE").write_text(source_fingerprint(csv_path))
+    return store_dir
+
+
+def store_is_current(csv_path=TRIPS_CSV, store_dir=STORE_DIR):
+    marker = Path(store_dir) / "SOURCE"
+    if not marker.exists() or marker.read_text() != source_fingerprint(csv_path):
+        return False
+    if _store_batches(store_dir) != [batch.name for batch in appended_batches(csv_path)]:
+        return False
+    # Stores written before a schema change are rebuilt rather than misread.
+    parts = sorted(Path(store_dir).glob("part-*.arrow"))
+    return not parts or ipc.open_file(pa.memory_map(str(parts[0]), "r")).schema.equals(TRIP_SCHEMA)
+
+
+def read_part(path):
+    return ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+
+
+def read_trip_table(store_dir=STORE_DIR):
+    tables = [read_part(p) for p in sorted(Path(store_dir).glob("part-*.arrow"))]
+    if not tables:
+        return TRIP_SCHEMA.empty_table()
+    return pa.concat_tables(tables)
+
+
+def open_trip_table(csv_path=None, store_dir=STORE_DIR):
+    # Without an explicit CSV the store is checked against the file it was built from.
+    csv_path = csv_path or store_source(store_dir)
+    if not store_is_current(csv_path, store_dir):
+        try:
+            build_trip_store(csv_path, store_dir)
+        except OSError:
+            # Read-only deployments still work, they just pay the CSV parse.
+            table = _source_table(csv_path)
+            return with_station_codes(table, build_dimension(table))
+    return read_trip_table(store_dir)
+
+
+def trips_to_frame(table):
+    # split_blocks keeps each numeric column as its own block so pandas can wrap
+    # the mapped Arrow buffers instead of consolidating them into a copy.
+    return table.to_pandas(split_blocks=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the trip CSV into the columnar trip store.")
+    parser.add_argument("--csv", type=Path, default=TRIPS_CSV)
+    parser.add_argument("--store", type=Path, default=STORE_DIR)
+    args = parser.parse_args()
+    build_trip_store(args.csv, args.store)
+    table = read_trip_table(args.store)
+    print(f"Wrote {table.num_rows:,} trips to {args.store}")
+
+
+if __name__ == "__main__":
+    main()
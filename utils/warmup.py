@@ -0,0 +1,97 @@
+import importlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import instrumentation
+
+# Sidebar label -> the page's module. Each page lists what its first render
+# loads in its WARMUP, called as the page calls them so that they land on the
+# same cache keys.
+PAGES = {
+    "Introduction": "last_try.introduction",
+    "Analysis: Heatmap": "last_try.heatmap",
+    "Analysis: Network": "last_try.network",
+    "Analysis: Balance": "last_try.balance",
+    "Analysis: Trajectories": "last_try.trajectories",
+    "Analysis: Autocorrelation": "last_try.autocorrelation",
+    "Conclusion": "last_try.conclusion",
+}
+# One background thread for the whole server, at the lowest CPU priority, so a
+# session rendering a page gets a free core first. The priority is the OS
+# scheduler's and does nothing about the GIL: while the warm-up runs Python
+# code it still takes turns with the page's thread; only the time it spends in
+# file reads and in pyarrow or numpy calls that release the GIL is free.
+WORKERS = 1
+NICE = 19
+
+
+def _lower_priority():
+    # Linux applies priorities per thread; elsewhere the warm-up just runs at
+    # normal priority.
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+_pool = ThreadPoolExecutor(WORKERS, thread_name_prefix="warmup", initializer=_lower_priority)
+
+
+def warm_page(page, cancelled=None):
+    # Imports the page and loads its datasets into the shared caches, stopping
+    # between datasets once `cancelled` is set. Timings go to the rerun log as
+    # page "warm-up: <page>". Returns whether every dataset was loaded.
+    with instrumentation.rerun(f"warm-up: {page}"):
+        with instrumentation.span("warmup", PAGES[page]):
+            module = importlib.import_module(PAGES[page])
+        for load in module.WARMUP:
+            if cancelled is not None and cancelled.is_set():
+                return False
+            load()
+    return True
+
+
+class Warmup:
+    # A session's warm-up: after a page has rendered, the pages the session
+    # has neither visited nor warmed are queued, the ones after it in the
+    # sidebar first. Cancelling skips every page and dataset not started yet;
+    # a load in progress runs to the end, since it fills the same cache the
+    # next page will read. A failed load is left for the page to raise.
+
+    def __init__(self, pool=_pool):
+        self.pool = pool
+        self.cancelled = threading.Event()
+        self.futures = []
+        self.warm = set()
+
+    def schedule(self, page):
+        self.cancel()
+        self.cancelled = threading.Event()
+        self.warm.add(page)
+        labels = list(PAGES)
+        at = labels.index(page)
+        for other in labels[at + 1:] + labels[:at]:
+            if other not in self.warm:
+                future = self.pool.submit(warm_page, other, self.cancelled)
+                future.add_done_callback(lambda future, other=other: self._done(other, future))
+                self.futures.append(future)
+
+    def _done(self, page, future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.warm.add(page)
+
+    def cancel(self):
+        self.cancelled.set()
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+
+
+def session_warmup():
+    # The current session's Warmup, kept in its session state.
+    import streamlit as st
+
+    if "warmup" not in st.session_state:
+        st.session_state["warmup"] = Warmup()
+    return st.session_state["warmup"]
@@ -0,0 +1,20 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def process_pool(workers):
+    # One pool of spawned workers per process, shared by every caller
+    # (betweenness, local Moran's I): forking a threaded server such as
+    # Streamlit's on each rerun is slow and unsafe. A different worker count
+    # replaces the pool; work already submitted to the old one still finishes.
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool[0] != workers:
+            if _pool is not None:
+                _pool[1].shutdown(wait=False)
+            _pool = (workers, ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")))
+        return _pool[1]